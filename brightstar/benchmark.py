@@ -0,0 +1,674 @@
+"""
+benchmarks for brightpearl.API against a local stand-in server
+
+the stand-in answers the brightpearl endpoints API uses (OPTIONS chunking,
+order, product, price, supplier, stock level and goods-note GETs and
+filtered searches) with generated data, and can add latency and rate limit
+headers/throttling; run() serves it from a child process so that only the
+client's allocations count towards peak memory
+
+usage: python benchmark.py --orders 2000 --latency 0.02 --workers 4
+       python benchmark.py --compression --ids 300000 --density 0.05
+"""
+
+import argparse
+import json
+import multiprocessing
+import random
+import re
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import islice
+from urllib.parse import parse_qs, urlsplit
+
+from brightpearl import (
+    API,
+    NEXT_THROTTLE_PERIOD_HEADER,
+    REQUESTS_REMAINING_HEADER,
+    THROTTLED_STATUS,
+    RateLimiter,
+    Tools,
+    Transport,
+    )
+
+BENCHMARK_CONFIG = {
+    'datacentre': 'eu1',
+    'api_version': 'public-api',
+    'account_code': 'benchmark',
+    'brightpearl_app_ref': 'benchmark_app',
+    'brightpearl_account_token': 'benchmark-token',
+    }
+
+SEARCH_COLUMNS = ("productId", "productName", "SKU", "EAN", "productGroupId")
+
+
+def parse_ids(request_range):
+    """
+    returns the ids of a request range such as "1-200", "1,5,7" or "1-3,7"
+    """
+
+    ids = list()
+    for part in request_range.split(","):
+        if "-" in part:
+            start, end = part.split("-")
+            ids.extend(range(int(start), int(end) + 1))
+        elif part:
+            ids.append(int(part))
+    return ids
+
+
+def fake_order(order_id, rows):
+
+    return {
+        "id": order_id,
+        "orderTypeCode": "SO",
+        "reference": "ORDER-{}".format(order_id),
+        "orderStatus": {"orderStatusId": 4, "name": "Shipped"},
+        "placedOn": "2026-10-{:02d}T10:00:00.000+01:00".format(order_id % 28 + 1),
+        "updatedOn": "2026-10-{:02d}T12:00:00.000+01:00".format(order_id % 28 + 1),
+        "assignment": {"current": {"channelId": order_id % 3 + 1}},
+        "currency": {"orderCurrencyCode": "EUR"},
+        "totalValue": {"net": "{}.00".format(10 * rows), "taxAmount": "1.90",
+                       "total": "{}.90".format(10 * rows)},
+        "parties": {"customer": {"contactId": order_id % 500 + 1,
+                                 "addressFullName": "Customer {}".format(order_id)}},
+        "orderRows": {
+            str(order_id * 100 + row): {
+                "productId": 1000 + (order_id + row) % 500,
+                "productName": "Product {}".format((order_id + row) % 500),
+                "productSku": "SKU-{}".format((order_id + row) % 500),
+                "quantity": {"magnitude": "{}.0000".format(row + 1)},
+                "rowValue": {"taxCode": "T20", "rowNet": {"value": "10.00"},
+                             "rowTax": {"value": "1.90"}},
+                "nominalCode": "4000",
+                }
+            for row in range(rows)},
+        }
+
+
+def fake_product(product_id, custom=False):
+
+    product = {
+        "id": product_id,
+        "identity": {"sku": "SKU-{}".format(product_id), "ean": str(4000000 + product_id)},
+        "productGroupId": product_id % 10,
+        "brandId": product_id % 7,
+        "status": "LIVE",
+        "stock": {"stockTracked": True},
+        "salesChannels": [{"productName": "Product {}".format(product_id)}],
+        }
+    if custom:
+        product["customFields"] = {"PCF_COLOUR": "blue"}
+    return product
+
+
+def fake_prices(product_id, price_lists, price_list=None):
+
+    price_list_ids = range(price_lists) if price_list is None else [int(price_list)]
+    return {
+        "productId": product_id,
+        "priceLists": [
+            {"priceListId": each_list, "currencyCode": "EUR",
+             "quantityPrice": {"1": "{}.{:02d}".format(product_id % 100, each_list)}}
+            for each_list in price_list_ids],
+        }
+
+
+def fake_availability(product_id):
+
+    in_stock = product_id % 50
+    return {
+        "total": {"inStock": in_stock, "onHand": in_stock + 2, "allocated": 2, "inTransit": 0},
+        "warehouses": {"2": {"inStock": in_stock, "onHand": in_stock + 2, "allocated": 2}},
+        }
+
+
+class StandInServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, stand_in):
+
+        self.stand_in = stand_in
+        ThreadingHTTPServer.__init__(self, address, StandInHandler)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    """
+    routes brightpearl requests to BrightpearlStandIn
+    """
+
+    def do_GET(self):
+        self.server.stand_in.handle(self, "GET")
+
+    def do_OPTIONS(self):
+        self.server.stand_in.handle(self, "OPTIONS")
+
+    def do_POST(self):
+        self.server.stand_in.handle(self, "POST")
+
+    def do_PUT(self):
+        self.server.stand_in.handle(self, "PUT")
+
+    def log_message(self, *args):
+        pass
+
+
+class BrightpearlStandIn(object):
+
+    """
+    local http server emulating the brightpearl endpoints used by API
+    """
+
+    def __init__(self, latency=0.0, order_rows=3, price_lists=3, search_results=2000,
+            rate_limit=None, rate_period=60.0, host="127.0.0.1", port=0):
+        """
+        Parameters
+        ----------
+        latency: float (seconds) added to every response
+        order_rows: integer for the rows per generated order (payload size)
+        price_lists: integer for the price lists per generated product price
+        search_results: integer for the rows available to every search
+        rate_limit: integer for the requests allowed per rate_period,
+            answered with brightpearl's rate limit headers and 503s
+            default: None (no limit, no headers)
+        host, port: address to listen on, port 0 picks a free port
+        """
+
+        self.latency = latency
+        self.order_rows = order_rows
+        self.price_lists = price_lists
+        self.search_results = search_results
+        self.rate_limit = rate_limit
+        self.rate_period = rate_period
+        self.address = (host, port)
+        self.server = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.window_start = time.monotonic()
+        self.window_requests = 0
+        self.requests = 0
+        self.throttled = 0
+
+    @property
+    def base_uri(self):
+
+        host, port = self.server.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def start(self):
+
+        self.server = StandInServer(self.address, self)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def rate_limit_headers(self):
+        """
+        counts the request against the current window
+        returns (throttled, headers)
+        """
+
+        if self.rate_limit is None:
+            return False, {}
+
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= self.rate_period:
+                self.window_start = now
+                self.window_requests = 0
+            self.window_requests += 1
+            remaining = self.rate_limit - self.window_requests
+            next_period = self.rate_period - (now - self.window_start)
+
+        headers = {
+            REQUESTS_REMAINING_HEADER: str(max(remaining, 0)),
+            NEXT_THROTTLE_PERIOD_HEADER: str(int(next_period * 1000)),
+            }
+        return remaining < 0, headers
+
+    def handle(self, handler, method):
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self.lock:
+            self.requests += 1
+
+        throttled, headers = self.rate_limit_headers()
+        if throttled:
+            with self.lock:
+                self.throttled += 1
+            status, body = THROTTLED_STATUS, {"errors": [{"code": "GWYB-001"}]}
+        else:
+            status, body = self.route(method, handler.path)
+
+        content = json.dumps(body).encode('utf-8')
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(content)))
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(content)
+
+    def route(self, method, path):
+        """
+        returns (status, body) for a request path such as
+        /public-api/benchmark/order-service/order/1-200
+        """
+
+        parts = urlsplit(path)
+        query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+        match = re.match(r"/[^/]+/[^/]+/([\w-]+)-service/(.*)", parts.path)
+        if match is None:
+            return 404, {"errors": [{"message": "unknown path"}]}
+        service, resource = match.groups()
+        resource = resource.rstrip("/")
+
+        if method == "OPTIONS":
+            kind, request_range = resource.split("/", 1)
+            return 200, {"response": {"getUris": [
+                "/{}/{}".format(kind, chunk)
+                for chunk in Tools.plan_request_ranges(request_range)]}}
+
+        if method in ("POST", "PUT"):
+            return 200, {"response": [1]}
+
+        if resource.endswith("-search"):
+            return 200, self.search(query)
+
+        match = re.match(r"order/([\d,-]+)/goods-note/goods-(\w+)$", resource)
+        if service == "warehouse" and match:
+            return 200, {"response": {
+                str(order_id * 10): {"orderId": order_id, "warehouseId": 1,
+                                     "type": match.group(2)}
+                for order_id in parse_ids(match.group(1))}}
+
+        match = re.match(r"([\w-]+)/([\d,-]+)(?:/(.*))?$", resource)
+        if match is None:
+            return 404, {"errors": [{"message": "unknown resource"}]}
+        kind, request_range, rest = match.groups()
+        ids = parse_ids(request_range)
+
+        if kind == "order":
+            return 200, {"response": [fake_order(order_id, self.order_rows) for order_id in ids]}
+        if kind == "product" and rest == "supplier":
+            return 200, {"response": {str(product_id): [product_id % 20 + 1]
+                                      for product_id in ids}}
+        if kind == "product":
+            custom = query.get("includeOptional") == "customFields"
+            return 200, {"response": [fake_product(product_id, custom) for product_id in ids]}
+        if kind == "product-availability":
+            return 200, {"response": {str(product_id): fake_availability(product_id)
+                                      for product_id in ids}}
+        if kind == "product-price":
+            price_list = rest.split("/")[-1] if rest else None
+            return 200, {"response": [fake_prices(product_id, self.price_lists, price_list)
+                                      for product_id in ids]}
+        return 404, {"errors": [{"message": "unknown resource"}]}
+
+    def search_row(self, product_id):
+
+        return {"productId": product_id, "orderId": product_id,
+                "productName": "Product {}".format(product_id),
+                "SKU": "SKU-{}".format(product_id), "EAN": str(4000000 + product_id),
+                "productGroupId": product_id % 10}
+
+    def search(self, query):
+        """
+        pages through search_results generated rows, keeping only those
+        whose columns equal every filter in query (i.e. SKU=SKU-12)
+        """
+
+        page_size = int(query.pop("pageSize", 500))
+        first_result = int(query.pop("firstResult", 1))
+        columns = query.pop("columns").split(",") if "columns" in query else list(SEARCH_COLUMNS)
+
+        rows = (self.search_row(product_id) for product_id in range(1, self.search_results + 1))
+        if query:
+            rows = [row for row in rows
+                    if all(str(row.get(name)) == value for name, value in query.items())]
+            results_available = len(rows)
+        else:
+            results_available = self.search_results
+
+        last_result = min(first_result + page_size - 1, results_available)
+        results = [[row.get(column) for column in columns]
+                   for row in islice(rows, first_result - 1, last_result)]
+
+        return {"response": {
+            "metaData": {
+                "resultsAvailable": results_available,
+                "resultsReturned": len(results),
+                "firstResult": first_result,
+                "lastResult": last_result,
+                "morePagesAvailable": last_result < results_available,
+                "columns": [{"name": column} for column in columns],
+                },
+            "results": results}}
+
+
+def serve_stand_in(options, connection):
+    """
+    runs a BrightpearlStandIn, sending its base uri over connection
+    and serving until anything is received back
+    """
+
+    with BrightpearlStandIn(**options) as stand_in:
+        connection.send(stand_in.base_uri)
+        connection.recv()
+
+
+class StandInProcess(object):
+
+    """
+    BrightpearlStandIn running in a child process, so that building and
+    serialising its payloads is not traced or timed with the client
+    """
+
+    def __init__(self, **options):
+        """
+        options: BrightpearlStandIn keyword arguments
+        """
+
+        self.options = options
+        self.process = None
+        self.connection = None
+        self.base_uri = None
+
+    def start(self):
+
+        self.connection, child_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=serve_stand_in, args=(self.options, child_connection), daemon=True)
+        self.process.start()
+        self.base_uri = self.connection.recv()
+        return self
+
+    def stop(self):
+
+        if self.process is not None:
+            self.connection.send(None)
+            self.process.join()
+            self.connection.close()
+            self.process = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class LocalTransport(Transport):
+
+    """
+    Transport that sends brightpearl uris to a stand-in server
+    and records the latency of every request
+    """
+
+    def __init__(self, base_uri, pool_size=10, timeout=None):
+
+        Transport.__init__(self, pool_size=pool_size, timeout=timeout)
+        self.base_uri = base_uri
+        self.latencies = list()
+
+    def request(self, method, the_uri, headers=None, data=None, stream=False):
+
+        local_uri = re.sub(r"^https://[^/]+", self.base_uri, the_uri)
+        start = time.perf_counter()
+        response = Transport.request(
+            self, method, local_uri, headers=headers, data=data, stream=stream)
+        self.latencies.append(time.perf_counter() - start)
+        return response
+
+
+def percentile(values, fraction):
+
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def benchmark_methods(orders, products, workers):
+    """
+    returns (name, function taking an API) for every benchmarked method
+    """
+
+    order_range = "1-{}".format(orders)
+    product_range = "1-{}".format(products)
+    order_ids = list(range(1, min(orders, 1000) + 1))
+    lookup_ids = range(1, min(products, 100) + 1)
+
+    return [
+        ("get_order_data", lambda api: api.get_order_data(order_range, workers=workers)),
+        ("iter_order_data", lambda api: sum(
+            1 for order in api.iter_order_data(order_range, workers=workers))),
+        ("get_order_frame", lambda api: api.get_order_frame(order_range, workers=workers)),
+        ("get_products_data", lambda api: api.get_products_data(product_range, workers=workers)),
+        ("iter_products_data", lambda api: sum(
+            1 for product in api.iter_products_data(product_range, workers=workers))),
+        ("get_product_prices", lambda api: api.get_product_prices(product_range)),
+        ("iter_product_prices", lambda api: sum(
+            1 for prices in api.iter_product_prices(product_range, workers=workers))),
+        ("get_price_matrix", lambda api: api.get_price_matrix(product_range, workers=workers)),
+        ("get_product_suppliers", lambda api: api.get_product_suppliers(product_range)),
+        ("get_goods_notes", lambda api: api.get_goods_notes(order_ids)),
+        ("iter_goods_notes", lambda api: sum(
+            1 for note in api.iter_goods_notes(order_ids, workers=workers))),
+        ("get_stock_levels", lambda api: api.get_stock_levels(product_range, workers=workers)),
+        ("iter_search", lambda api: sum(
+            1 for row in api.iter_search("product", workers=workers))),
+        ("lookup_service", lambda api: api.lookup_service("product", productGroupId=3)),
+        ("product_lookup", lambda api: api.product_lookup({"productGroupId": 3})),
+        ("order_lookup", lambda api: api.order_lookup({"orderId": 1})),
+        ("sku_lookup", lambda api: [
+            api.sku_lookup("SKU-{}".format(product_id)) for product_id in lookup_ids]),
+        ("ean_lookup", lambda api: [
+            api.ean_lookup(str(4000000 + product_id)) for product_id in lookup_ids]),
+        ]
+
+
+def run_benchmark(name, method, make_api, repeat=3):
+    """
+    times method(api) repeat times, then runs it once more under
+    tracemalloc for the peak memory
+
+    Returns
+    -------
+    dictionary of name, requests, seconds, rps, p50/p99 latency (ms)
+    and peak_memory (bytes)
+    """
+
+    latencies = list()
+    seconds = 0.0
+    for each_run in range(repeat):
+        with make_api() as api:
+            start = time.perf_counter()
+            method(api)
+            seconds += time.perf_counter() - start
+            latencies.extend(api.transport.latencies)
+
+    with make_api() as api:
+        tracemalloc.start()
+        try:
+            method(api)
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return {
+        "name": name,
+        "requests": len(latencies),
+        "seconds": seconds,
+        "rps": len(latencies) / seconds if seconds else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "peak_memory": peak_memory,
+        }
+
+
+def run(orders=1000, products=1000, workers=4, repeat=3, latency=0.0, order_rows=3,
+        price_lists=3, search_results=2000, rate_limit=None, rate_period=60.0, methods=None,
+        config=None):
+    """
+    starts a StandInProcess and benchmarks every API method against it
+    methods: list of method names to run, default: all of them
+    config: extra API config, i.e. {'json_loads': True}
+    returns a list of run_benchmark results
+    """
+
+    results = list()
+    with StandInProcess(latency=latency, order_rows=order_rows, price_lists=price_lists,
+            search_results=search_results, rate_limit=rate_limit,
+            rate_period=rate_period) as stand_in:
+
+        def make_api():
+            api_config = dict(BENCHMARK_CONFIG, **(config or {}))
+            api_config.setdefault('rate_limit', RateLimiter() if rate_limit else False)
+            return API(api_config, transport=LocalTransport(
+                stand_in.base_uri, pool_size=max(workers or 1, 10)))
+
+        for name, method in benchmark_methods(orders, products, workers):
+            if methods and name not in methods:
+                continue
+            results.append(run_benchmark(name, method, make_api, repeat=repeat))
+    return results
+
+
+def compression_baseline(ids):
+    """
+    the straightforward Tools.compress_ids, kept to benchmark it against
+    """
+
+    pieces = list()
+    start = previous = None
+    for each_id in sorted(set(int(each_id) for each_id in ids)):
+        if previous is not None and each_id == previous + 1:
+            previous = each_id
+            continue
+        if start is not None:
+            pieces.append(str(start) if start == previous else "{}-{}".format(start, previous))
+        start = previous = each_id
+    if start is not None:
+        pieces.append(str(start) if start == previous else "{}-{}".format(start, previous))
+    return pieces
+
+
+def run_compression(count=200000, density=0.1, repeat=3, seed=1):
+    """
+    times the id chunking helpers on count ids drawn at random from
+    count / density possible ids (density 1.0 is one contiguous range)
+
+    Returns
+    -------
+    list of dictionaries of name, seconds (best of repeat) and ids
+    """
+
+    generator = random.Random(seed)
+    ids = generator.sample(range(1, int(count / density) + 1), count)
+    sorted_ids = sorted(ids)
+    cases = [
+        ("compress_ids_baseline", lambda: compression_baseline(ids)),
+        ("compress_ids", lambda: Tools.compress_ids(ids)),
+        ("compress_ids_sorted", lambda: Tools.compress_ids(sorted_ids)),
+        ("batch_ids", lambda: Tools.batch_ids(ids)),
+        ("grouper", lambda: Tools.grouper(ids, chunksize=200)),
+        ("chunked", lambda: sum(1 for chunk in Tools.chunked(iter(ids), 200))),
+        ]
+
+    results = list()
+    for name, case in cases:
+        best = None
+        for each_run in range(repeat):
+            start = time.perf_counter()
+            case()
+            seconds = time.perf_counter() - start
+            best = seconds if best is None else min(best, seconds)
+        results.append({"name": name, "seconds": best, "ids": count})
+    return results
+
+
+def report_compression(results):
+
+    lines = ["{:<24}{:>12}{:>14}".format("helper", "ms", "ids/s")]
+    for result in results:
+        lines.append("{:<24}{:>12.2f}{:>14.0f}".format(
+            result["name"], result["seconds"] * 1000, result["ids"] / result["seconds"]))
+    return "\n".join(lines)
+
+
+def report(results):
+
+    lines = ["{:<24}{:>10}{:>10}{:>10}{:>10}{:>12}".format(
+        "method", "requests", "rps", "p50 ms", "p99 ms", "peak KiB")]
+    for result in results:
+        lines.append("{:<24}{:>10}{:>10.1f}{:>10.2f}{:>10.2f}{:>12.0f}".format(
+            result["name"], result["requests"], result["rps"], result["p50_ms"],
+            result["p99_ms"], result["peak_memory"] / 1024))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--orders", type=int, default=1000)
+    parser.add_argument("--products", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.0,
+        help="seconds added to every stand-in response")
+    parser.add_argument("--order-rows", type=int, default=3)
+    parser.add_argument("--price-lists", type=int, default=3)
+    parser.add_argument("--search-results", type=int, default=2000)
+    parser.add_argument("--rate-limit", type=int, default=None,
+        help="requests per rate period before the stand-in answers 503")
+    parser.add_argument("--rate-period", type=float, default=60.0,
+        help="seconds per rate limit window")
+    parser.add_argument("--method", action="append", dest="methods",
+        help="only run this method, may be repeated")
+    parser.add_argument("--json", action="store_true", help="print results as json")
+    parser.add_argument("--compression", action="store_true",
+        help="benchmark the id chunking helpers instead of the API methods")
+    parser.add_argument("--ids", type=int, default=200000,
+        help="ids for --compression")
+    parser.add_argument("--density", type=float, default=0.1,
+        help="share of possible ids present for --compression, 1.0 is contiguous")
+    args = parser.parse_args(argv)
+
+    if args.compression:
+        results = run_compression(count=args.ids, density=args.density, repeat=args.repeat)
+        print(json.dumps(results, indent=2) if args.json else report_compression(results))
+        return
+
+    results = run(orders=args.orders, products=args.products, workers=args.workers,
+        repeat=args.repeat, latency=args.latency, order_rows=args.order_rows,
+        price_lists=args.price_lists, search_results=args.search_results,
+        rate_limit=args.rate_limit, rate_period=args.rate_period, methods=args.methods)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(report(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,44 @@
+import asyncio
+import base64
+import bisect
+import codecs
+import contextvars
+import functools
+import gzip
+import hashlib
+import inspect
+import io
 import json
+import math
+import os
+import re
 import requests
-from itertools import zip_longest
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from itertools import islice
 from math import ceil
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlencode
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 ALL_SERVICES = {
     "order": ("order", "order"),
@@ -11,402 +48,4441 @@ ALL_SERVICES = {
     "prices": ("product", "product-price")
     }
 
-class API(object):
+DEFAULT_POOL_SIZE = 10
+
+# brightpearl allows 200 requests per account per minute
+DEFAULT_RATE_LIMIT = 200
+DEFAULT_RATE_PERIOD = 60.0
+DEFAULT_MAX_RETRIES = 5
+THROTTLED_STATUS = 503
+REQUESTS_REMAINING_HEADER = "brightpearl-requests-remaining"
+NEXT_THROTTLE_PERIOD_HEADER = "brightpearl-next-throttle-period"
+PLANS = ("options", "local")
+DEFAULT_PLAN_CACHE_SIZE = 256
+DEFAULT_PLAN_CACHE_TTL = 300.0
+# brightpearl returns at most 200 resources per GET
+MAX_IDS_PER_REQUEST = 200
+# keeps the id part of a uri well below common 2k url limits
+MAX_ID_STRING_LENGTH = 1500
+DEFAULT_RESPONSE_CACHE_TTL = 60.0
+DEFAULT_RESPONSE_CACHE_SIZE = 1024
+DEFAULT_RESPONSE_CACHE_BYTES = 64 * 1024 * 1024
+# brightpearl search returns at most 500 rows per page
+DEFAULT_SEARCH_PAGE_SIZE = 500
+# initial number of product rows allocated by a PriceMatrix while streaming
+DEFAULT_PRICE_MATRIX_ROWS = 1024
+# bytes read at a time when decoding a response incrementally
+STREAM_CHUNK_SIZE = 64 * 1024
+JSON_NUMBER_CHARACTERS = frozenset(".eE+-0123456789")
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+# upper bounds (seconds) of the latency histogram buckets, 0.5ms to ~65s
+LATENCY_BUCKETS = tuple(0.0005 * 2 ** exponent for exponent in range(18))
+SERVICE_URI = re.compile(r'/([\w-]+)-service/([\w-]+)')
+SERVICE_NAMES = {value: key for key, value in ALL_SERVICES.items()}
+# name of the public API method a request is made for, see operation
+OPERATION = contextvars.ContextVar("brightstar_operation", default=None)
+# innermost open tracing span, parent of the spans started under it
+CURRENT_SPAN = contextvars.ContextVar("brightstar_span", default=None)
+# seconds a request waited for a fan-out worker thread, see API.submit
+QUEUE_WAIT = contextvars.ContextVar("brightstar_queue_wait", default=0.0)
+# kept out of cassettes, see RecordingTransport
+SECRET_HEADERS = ("brightpearl-account-token", "brightpearl-staff-token")
+REDACTED = "<redacted>"
+# (key returned by SKU/EAN lookups, product-search column, fallback index)
+PRODUCT_SUMMARY_COLUMNS = (
+    ('product_id', 'productId', 0),
+    ('product_name', 'productName', 1),
+    ('sku', 'SKU', 2),
+    ('EAN', 'EAN', 4),
+    ('stock_tracked', 'stockTracked', 7),
+    ('category_code', 'brightpearlCategoryCode', 11),
+    ('product_group_id', 'productGroupId', 12),
+    )
+DEFAULT_RESOLVER_WINDOW = 0.005
+DEFAULT_NEGATIVE_CACHE_TTL = 300.0
+DEFAULT_NEGATIVE_CACHE_SIZE = 100000
+DEFAULT_NEGATIVE_SEED_MAX_AGE = 3600.0
+DEFAULT_NEGATIVE_REFRESH_INTERVAL = 60.0
+
+
+class LRUCache(object):
 
     """
-    creates API calls to brightpearl
-    and creates the beginning of the URI
-    as well as the headers based on config parameters
+    thread safe least recently used cache with an optional time to live
+    keeps hit/miss counters so callers can see how well it works
     """
 
-    def __init__(self, config):
+    def __init__(self, maxsize=128, ttl=None, maxbytes=None, clock=time.monotonic):
+        """
+        Parameters
+        ----------
+        maxsize: integer for the max number of entries kept
+        ttl: float for seconds an entry stays valid
+            default: None (entries only leave by eviction)
+        maxbytes: integer for the max total size of the entries,
+            as given to set()
+            default: None (only maxsize applies)
+        clock: time function, replaceable for testing
+        """
 
-        self.datacentre = config['datacentre']
-        self.api_version = config['api_version']
-        self.account_code = config['account_code']
-        self.app_ref = config['brightpearl_app_ref']
-        self.authentication_token = None
-        self.staff_authentication_token = None
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
 
-        if 'brightpearl_account_token' in config:
-            self.authentication_token = config['brightpearl_account_token']
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
 
-        self.staff_authentication_headers = {
-                "brightpearl-app-ref": self.app_ref,
-                "Content-Type": "application/json"
-        }
+    def get(self, key, default=None):
 
-        self.uri = "https://ws-{}.brightpearl.com/{}/{}/".format(
-            self.datacentre, self.api_version, self.account_code)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, expires, size = entry
+                if expires is None or expires > self.clock():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self.remove(key)
 
-        self.authentication_uri = "https://ws-{}.brightpearl.com/{}/authorise".format(
-            self.datacentre, self.account_code)
+            self.misses += 1
+            return default
 
-        self.headers = {
-            "brightpearl-app-ref": self.app_ref,
-            "brightpearl-account-token": self.authentication_token
-        }
+    def set(self, key, value, ttl=None, size=0):
+        """
+        stores value under key, ttl overrides the cache-wide ttl
+        size counts towards maxbytes
+        """
 
+        if ttl is None:
+            ttl = self.ttl
+        expires = None if ttl is None else self.clock() + ttl
 
-    def get_brightpearl_staff_token(self, username, password):
+        with self.lock:
+            self.remove(key)
+            self.entries[key] = (value, expires, size)
+            self.size += size
+            while len(self.entries) > self.maxsize or (
+                    self.maxbytes is not None and self.size > self.maxbytes):
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        # caller holds the lock
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def delete(self, key):
+
+        with self.lock:
+            self.remove(key)
+
+    def keys(self):
+
+        with self.lock:
+            return list(self.entries)
+
+    def clear(self):
+
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
         """
-        calls the API to get the staff token
+        returns the counters as a dictionary
         """
 
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries),
+                "bytes": self.size}
 
-        authentication_string = json.dumps(
-                {"apiAccountCredentials" :
-                    {"emailAddress":username, "password":password }
-                }
-                    )
-        authentication_data = authentication_string.encode('utf-8')
 
-        response = requests.post(self.authentication_uri, data=authentication_data, headers=self.staff_authentication_headers)
+class BloomFilter(object):
 
-        decoded_data = response.json()
+    """
+    set membership in a fixed bit array
+    never gives false negatives, gives false positives at about error_rate
+    """
 
-        self.staff_authentication_token = decoded_data['response']
+    def __init__(self, capacity, error_rate=0.001):
+        """
+        Parameters
+        ----------
+        capacity: integer for the number of items expected
+        error_rate: float for the acceptable false positive rate
+        """
 
-        self.headers = {
-            "brightpearl-app-ref": self.app_ref,
-            "brightpearl-staff-token": self.staff_authentication_token,
-        }
+        capacity = max(capacity, 1)
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
 
+    def positions(self, item):
+        # double hashing, two 64 bit halves of one digest
+        digest = hashlib.blake2b(str(item).encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + each_hash * second) % self.size for each_hash in range(self.hashes)]
 
-    def get_uri(self, service, resource, reference_number=None):
+    def add(self, item):
+
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                for position in self.positions(item))
+
+
+class NegativeLookupCache(object):
+
+    """
+    remembers SKUs/EANs that brightpearl does not know so they can be
+    rejected without a product-search call
+    misses are kept in a bounded LRUCache with a ttl, and once seeded
+    from a full catalogue a BloomFilter of the known codes rejects any
+    code it has never seen
+    products created elsewhere (in brightpearl itself, by another client
+    or another worker process) are added by API.refresh_negative_cache,
+    a createdOn search run at most every refresh_interval seconds, so
+    they can be rejected for up to that long; the filter is dropped
+    after max_age seconds, lookups going back to the network until
+    the next seed
+    """
+
+    def __init__(self, ttl=DEFAULT_NEGATIVE_CACHE_TTL, maxsize=DEFAULT_NEGATIVE_CACHE_SIZE,
+            max_age=DEFAULT_NEGATIVE_SEED_MAX_AGE,
+            refresh_interval=DEFAULT_NEGATIVE_REFRESH_INTERVAL,
+            overlap=timedelta(minutes=5), clock=time.monotonic, now=None):
         """
-        service/resource as string: i.e. "orders", "products"
-        allows custom uris for calls not included in self.process_uri
-        only returns a single uri
+        Parameters
+        ----------
+        ttl: float for seconds a network miss is remembered
+        maxsize: integer for the max number of misses remembered
+        max_age: float for seconds a seeded filter is trusted,
+            None to keep it until invalidate or the next seed
+        refresh_interval: float for seconds between searches for
+            products created since the seed or the last refresh
+        overlap: timedelta subtracted from each createdOn timestamp to
+            cover clock skew, as in OrderSync
+        clock: time function, replaceable for testing
+        now: function returning an aware utc datetime, replaceable for testing
         """
-        resource_fragment = "{}-service/{}/".format(service, resource)
 
-        if reference_number is None:
-            return "{}{}".format(self.uri, resource_fragment)
+        self.misses = LRUCache(maxsize=maxsize, ttl=ttl, clock=clock)
+        self.max_age = max_age
+        self.refresh_interval = refresh_interval
+        self.overlap = overlap
+        self.clock = clock
+        self.now = now or (lambda: datetime.now(timezone.utc))
+        self.seeded_at = None
+        self.refreshed_at = None
+        self.created_since = None
+        self.known = None
+        self.rejected = 0
+        self.lock = threading.Lock()
 
-        return "{}{}{}".format(self.uri, resource_fragment, reference_number)
+    def seed(self, products, error_rate=0.001, seeded_on=None):
+        """
+        builds the filter of known codes from a full catalogue dump
+        products: list of product-service products, i.e. API.get_products_data
+        seeded_on: aware datetime the catalogue was read at, refreshes
+            search for products created after it, default: now
+        """
 
+        codes = list()
+        for product in products:
+            identity = product.get('identity', {})
+            if identity.get('sku'):
+                codes.append(("SKU", identity['sku']))
+            if identity.get('ean'):
+                codes.append(("EAN", identity['ean']))
 
-    def get_service_uri(self, service, reference_number=None):
+        known = BloomFilter(len(codes), error_rate)
+        for kind, code in codes:
+            known.add("{}:{}".format(kind, code))
+
+        created_since = (seeded_on or self.now()) - self.overlap
+        with self.lock:
+            self.known = known
+            self.seeded_at = self.refreshed_at = self.clock()
+            self.created_since = created_since
+            self.misses.clear()
+
+    def start_refresh(self):
         """
-        generate uri for certain services in ALL_SERVICE
-        service and order_numbers must be strings.
-        This method is essentially a shortcut for get_uri above.
+        returns (created_since, started) when the seeded filter is due a
+        refresh, otherwise None; the refresh is claimed, so concurrent
+        lookups do not repeat it, and completed by finish_refresh(started)
         """
 
-        return self.get_uri(ALL_SERVICES[service][0], ALL_SERVICES[service][1], reference_number)
+        if self.seeded_filter() is None:
+            return None
+        with self.lock:
+            if self.clock() - self.refreshed_at < self.refresh_interval:
+                return None
+            self.refreshed_at = self.clock()
+            return self.created_since, self.now() - self.overlap
+
+    def finish_refresh(self, started):
+        """
+        moves the next refresh's createdOn timestamp up to started,
+        a failed refresh leaves it alone so the next one covers it
+        """
 
+        with self.lock:
+            self.created_since = started
 
-    def get(self, the_uri):
+    def seeded_filter(self):
         """
-        the function that actually sends the request
-        and returns the data
+        returns the seeded filter, None once it is older than max_age
         """
 
-        response = requests.get(the_uri, headers=self.headers)
-        return response.json()
+        with self.lock:
+            if (self.known is not None and self.max_age is not None
+                    and self.clock() - self.seeded_at >= self.max_age):
+                self.known = None
+            return self.known
 
-    def put(self, the_uri, data):
+    def is_absent(self, kind, code):
         """
-        the function that puts stuff in
+        True when code is known not to exist as kind ("SKU" or "EAN")
         """
 
-        response = requests.put(the_uri, headers=self.headers, data=data)
-        return response.json()
+        absent = self.misses.get("{}:{}".format(kind, code)) is not None
+        known = self.seeded_filter()
+        if not absent and known is not None:
+            absent = "{}:{}".format(kind, code) not in known
+        if absent:
+            self.rejected += 1
+        return absent
 
-    def post(self, the_uri, data):
+    def add_miss(self, kind, code):
+
+        self.misses.set("{}:{}".format(kind, code), True)
+
+    def add_known(self, kind, code):
         """
-        the function that posts stuff
+        called when a product is created so its codes stop being rejected
         """
 
-        response = requests.post(the_uri, headers=self.headers, data=data)
-        return response.json()
+        key = "{}:{}".format(kind, code)
+        self.misses.delete(key)
+        with self.lock:
+            if self.known is not None:
+                self.known.add(key)
 
+    def add_product(self, product):
 
-    def options(self, the_uri):
+        identity = product.get('identity', {})
+        if identity.get('sku'):
+            self.add_known("SKU", identity['sku'])
+        if identity.get('ean'):
+            self.add_known("EAN", identity['ean'])
+
+    def invalidate(self):
         """
-        options function
-        used to request custom uris for orders and contacts:
-        input range, output: range of uris for minimal number of
-        api calls
+        forgets every miss and the seeded filter, seed again to restore it
         """
 
-        response = requests.options(the_uri, headers=self.headers)
-        return response.json()
+        with self.lock:
+            self.known = None
+            self.misses.clear()
 
-    def post_by_service(self, service, data):
+
+class SQLiteCache(object):
+
+    """
+    LRUCache lookalike stored in a SQLite database (WAL mode),
+    so every worker process on a host shares the same entries
+    values must be json serialisable
+    """
+
+    name_pattern = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+    def __init__(self, path, namespace="cache", maxsize=10000, ttl=None,
+            maxbytes=None, clock=time.time):
         """
-        shortcut method to post via different services
+        Parameters
+        ----------
+        path: string for the database file, shared by all processes
+        namespace: string for the table name, so several caches
+            (i.e. plans and responses) can share one file
+        maxsize: integer for the max number of entries kept
+        ttl: float for seconds an entry stays valid
+            default: None (entries only leave by eviction)
+        maxbytes: integer for the max total size of the entries
+            default: None (only maxsize applies)
+        clock: wall clock function, must agree across processes
         """
 
-        service_uri = "{0}{1}-service/{1}".format(self.uri, service)
-        return self.post(service_uri, data)
+        if not self.name_pattern.match(namespace):
+            raise ValueError("namespace must be a valid table name: {}".format(namespace))
 
-    def post_goods_out(self, order, data):
+        self.path = path
+        self.table = namespace
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.local = threading.local()
+
+        connection = self.connection()
+        with connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS {} ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL, "
+                "accessed REAL NOT NULL, size INTEGER NOT NULL)".format(self.table))
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS {0}_accessed ON {0} (accessed)".format(self.table))
+
+    def connection(self):
         """
-        shortcut to post a new goods out note
-        response is goods out note reference number
+        one connection per thread and per process,
+        connections must not survive a fork
         """
 
-        goods_out_note_uri = "{}warehouse-service/order/{}/goods-note/goods-out".format(
-                self.uri, order
-                )
-        response = self.post(goods_out_note_uri, data)
-        return response['response'][0]
+        pid = os.getpid()
+        if getattr(self.local, "pid", None) != pid:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+            self.local.pid = pid
+        return self.local.connection
 
+    def get(self, key, default=None):
 
-    def get_options_uris_by_service(self, service, reference_number):
+        connection = self.connection()
+        now = self.clock()
+        row = connection.execute(
+            "SELECT value, expires FROM {} WHERE key = ?".format(self.table), (key,)
+            ).fetchone()
+
+        if row is not None and (row[1] is None or row[1] > now):
+            connection.execute(
+                "UPDATE {} SET accessed = ? WHERE key = ?".format(self.table), (now, key))
+            self.hits += 1
+            return json.loads(row[0])
+
+        if row is not None:
+            self.delete(key)
+        self.misses += 1
+        return default
+
+    def set(self, key, value, ttl=None, size=0):
         """
-        Builds a list_of_uris when passed data and pre-defined service type.
-        Only needs service name and reference number(s) as string.
+        stores value under key, ttl overrides the cache-wide ttl
+        size counts towards maxbytes
         """
-        # service uri also serves as stub for uri building at end of method
-        service_uri = "{}{}-service".format(self.uri, ALL_SERVICES[service][0])
 
-        options_uri = "{}/{}/{}".format(service_uri, ALL_SERVICES[service][1], reference_number)
-        options_data = self.options(options_uri)
-        response_data = options_data['response']['getUris']
+        if ttl is None:
+            ttl = self.ttl
+        now = self.clock()
+        expires = None if ttl is None else now + ttl
 
-        list_of_uris = list()
-        for uri_segment in response_data:
-            list_of_uris.append("{}{}".format(service_uri, uri_segment))
-        return list_of_uris
+        connection = self.connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute(
+                "INSERT OR REPLACE INTO {} (key, value, expires, accessed, size) "
+                "VALUES (?, ?, ?, ?, ?)".format(self.table),
+                (key, json.dumps(value), expires, now, size))
+            self.evict(connection, now)
 
-    def get_order_data(self, request_range):
+    def evict(self, connection, now):
+        # caller holds the write transaction
+        connection.execute(
+            "DELETE FROM {} WHERE expires IS NOT NULL AND expires <= ?".format(self.table),
+            (now,))
 
-        sales_uris = self.get_options_uris_by_service("order", request_range
-            )
+        count, total = connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM {}".format(self.table)).fetchone()
+        if count <= self.maxsize and (self.maxbytes is None or total <= self.maxbytes):
+            return
 
-        orders_data = list()
+        oldest = connection.execute(
+            "SELECT key, size FROM {} ORDER BY accessed".format(self.table))
+        doomed = list()
+        for key, size in oldest:
+            if count <= self.maxsize and (self.maxbytes is None or total <= self.maxbytes):
+                break
+            doomed.append((key,))
+            count -= 1
+            total -= size
+        connection.executemany("DELETE FROM {} WHERE key = ?".format(self.table), doomed)
 
-        for each_uri in sales_uris:
-            response_data = self.get(each_uri)
-            for each_set_of_sales in range(len(response_data['response'])):
-                orders_data.append(response_data['response'][each_set_of_sales])
+    def delete(self, key):
 
-        return orders_data
+        self.connection().execute("DELETE FROM {} WHERE key = ?".format(self.table), (key,))
 
-    def get_products_data(self, request_range, custom=False):
+    def keys(self):
 
-        sales_uris = self.get_options_uris_by_service("products", request_range
-            )
-        products_data = list()
+        return [row[0] for row in self.connection().execute(
+            "SELECT key FROM {}".format(self.table))]
 
-        for each_uri in sales_uris:
-            if custom is True:
-                each_uri += "?includeOptional=customFields"
-            response_data = self.get(each_uri)
-            for each_set_of_products in range(len(response_data['response'])):
-                products_data.append(response_data['response'][each_set_of_products])
+    def clear(self):
 
-        return products_data
+        self.connection().execute("DELETE FROM {}".format(self.table))
+
+    def __len__(self):
+        return self.connection().execute(
+            "SELECT COUNT(*) FROM {}".format(self.table)).fetchone()[0]
+
+    def stats(self):
+        """
+        returns the counters of this process and the shared size
+        """
+
+        count, total = self.connection().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM {}".format(self.table)).fetchone()
+        return {"hits": self.hits, "misses": self.misses, "size": count, "bytes": total}
+
+    def close(self):
 
-    def get_product_prices(self, request_range, price_list=None):
+        if getattr(self.local, "pid", None) == os.getpid():
+            self.local.connection.close()
+        self.local = threading.local()
+
+
+class ResponseCache(object):
+
+    """
+    caches the bodies of GET responses per uri and authentication identity
+    fresh entries are served locally, stale ones are revalidated with
+    If-None-Match when brightpearl sent an ETag
+    """
+
+    # e.g. product-service/product-price in .../product-service/product-price/1001
+    resource_pattern = re.compile(r"([a-z-]+-service/[a-z-]+)")
+
+    def __init__(self, ttl=DEFAULT_RESPONSE_CACHE_TTL, service_ttls=None,
+            maxsize=DEFAULT_RESPONSE_CACHE_SIZE, maxbytes=DEFAULT_RESPONSE_CACHE_BYTES,
+            backend=None, clock=time.time):
         """
         Parameters
         ----------
-        request_range: string with product ids in the format "1-100" or "1,10"
-        price_list: integer for price list code
+        ttl: float for seconds a response is served without revalidation
+        service_ttls: dictionary of ttls per resource, keyed by ALL_SERVICES
+            names or "<service>-service/<resource>" paths, i.e.
+            {"prices": 300, "warehouse-service/product-availability": 5}
+        maxsize: integer for the max number of responses kept
+        maxbytes: integer for the max total size of the cached bodies
+        backend: object with get/set/delete/keys/clear, such as LRUCache
+            default: None (an LRUCache bounded by maxsize and maxbytes)
+        clock: time function, replaceable for testing
+        """
 
-        Returns
-        -------
-        prices_data: dictionary of product ids and prices
+        self.ttl = ttl
+        self.service_ttls = dict()
+        for resource, resource_ttl in (service_ttls or {}).items():
+            if resource in ALL_SERVICES:
+                resource = "{}-service/{}".format(*ALL_SERVICES[resource])
+            self.service_ttls[resource] = resource_ttl
+
+        if backend is None:
+            backend = LRUCache(maxsize=maxsize, maxbytes=maxbytes)
+        self.backend = backend
+        self.clock = clock
+        self.revalidated = 0
+
+    def key(self, the_uri, headers):
+        """
+        keys on the uri and a hash of the token, so staff and account
+        tokens never share entries and tokens are not kept in the cache
         """
 
-        prices_uris = self.get_options_uris_by_service("prices", request_range)
+        token = headers.get("brightpearl-staff-token") or headers.get("brightpearl-account-token")
+        identity = hashlib.sha1(str(token).encode('utf-8')).hexdigest()[:16]
+        return "{}:{}".format(identity, the_uri)
 
-        prices_data = dict()
-        for each_uri in prices_uris:
-            if price_list is not None:
-                print(price_list)
-                each_uri += "/price-list/{}".format(price_list)
-                print(each_uri)
-            response_data = self.get(each_uri)
-            if 'errors' in response_data:
-                # return empty set if single item called with no prices
-                pass
-            else:
-                for each_product in response_data['response']:
-                    product_id = each_product['productId']
-                    prices_data.setdefault(product_id, {})
-                    for each_price in each_product['priceLists']:
-                        price_list_code = each_price.get("priceListId")
-                        price = each_price.get("quantityPrice", {}).get("1")
-                        prices_data[product_id][price_list_code] = price
-        return prices_data
+    def resource(self, the_uri):
 
-    def get_product_suppliers(self, request_range=""):
-        # code smell
-        suppliers_uri = self.get_options_uris_by_service("products", request_range
-            )
-        suppliers_data = dict()
+        match = self.resource_pattern.search(the_uri)
+        return match.group(1) if match else None
 
-        for each_uri in suppliers_uri:
-            response_data = self.get(each_uri + "/supplier")
-            suppliers_data.update(response_data['response'])
+    def ttl_for(self, the_uri):
 
-        return suppliers_data
+        return self.service_ttls.get(self.resource(the_uri), self.ttl)
 
-    def get_goods_notes(self, orders, note_type="in"):
+    def lookup(self, key):
         """
-        Parameter
-        ---------
-        orders: list of orders to get goods notes for
-        note_type: string for goods note type
-            "in": (default value) returns goods-in notes
-            "out": returns goods-out notes
+        Returns
+        -------
+        (entry, fresh): the cached entry or None, and whether it can be
+            served without asking brightpearl
         """
 
-        goods_note_uri_start ="{}warehouse-service/order/".format(self.uri)
-        goods_note_uri_end = "/goods-note/goods-{}/".format(note_type)
-        if len(orders) > 200:
-            order_chunks = Tools.grouper(orders, chunksize=200)
-        else:
-            order_chunks = [orders]
-
-        all_responses = {}
-        for chunk in order_chunks:
-            response = self.get(
-                "{}{}{}".format(
-                    goods_note_uri_start,
-                    Tools.searchstringifier(chunk),
-                    goods_note_uri_end
-                    )
-                )
-            all_responses.update(response.get('response', {}))
-        return all_responses
+        entry = self.backend.get(key)
+        if entry is None:
+            return None, False
+        return entry, entry["fresh_until"] > self.clock()
 
-    def lookup_service(self, service, **kwargs):
-        """
-        calls on the search functionality to lookup a product
-        and return all information including product ID
-        Will lookup sku by default
-        """
-        methods = set()
-        the_uri = '{0}{1}-service/{1}-search?'.format(self.uri, service)
+    def conditional_headers(self, entry):
 
-        for key, value in kwargs.items():
-            the_uri += '{}={}'.format(key, value)
-            if len(kwargs) > 1:
-                the_uri += '&'
-        print(key)
-        methods.add(key)
-        response = self.get(the_uri)
+        if entry is not None and entry.get("etag"):
+            return {"If-None-Match": entry["etag"]}
+        return None
 
-        if response['response']['results'] != []:
+    def store(self, key, the_uri, response, entry=None):
+        """
+        stores a 200 response, or renews entry on a 304
 
-            line_items = response['response']['results'][0]
+        Returns
+        -------
+        the body to decode, or None if the response was not cacheable
+        """
 
-            if "SKU" in methods or "EAN" in methods:
-                data = {
-                    'product_id': line_items[0],
-                    'product_name': line_items[1],
-                    'sku': line_items[2],
-                    'EAN': line_items[4],
-                    'stock_tracked': line_items[7],
-                    'category_code': line_items[11],
-                    'product_group_id': line_items[12],
+        ttl = self.ttl_for(the_uri)
+
+        if response.status_code == 304 and entry is not None:
+            self.revalidated += 1
+            entry = dict(entry, fresh_until=self.clock() + ttl)
+        elif response.status_code == 200:
+            entry = {
+                "body": response.content.decode('utf-8'),
+                "etag": response.headers.get("ETag"),
+                "fresh_until": self.clock() + ttl,
                 }
-                return data
         else:
-            return []
+            return None
 
-        return response['response']['results']
+        # maxbytes counts encoded bytes, not characters
+        self.backend.set(key, entry, size=len(entry["body"].encode('utf-8')))
+        return entry["body"]
 
+    def invalidate(self, prefix=None):
+        """
+        drops every cached response whose uri starts with prefix,
+        or everything when no prefix is given
+        """
 
-    def sku_lookup(self, sku_number):
-        return self.lookup_service("product", SKU=sku_number)
+        if prefix is None:
+            self.backend.clear()
+            return
 
-    def ean_lookup(self, ean_number):
-        return self.lookup_service("product", EAN=ean_number)
+        for key in self.backend.keys():
+            if key.split(":", 1)[1].startswith(prefix):
+                self.backend.delete(key)
 
-    def order_lookup(self, kwargs):
-        return self.lookup_service("order", **kwargs)
+    def stats(self):
 
-    def product_lookup(self, kwargs):
-        return self.lookup_service("product", **kwargs)
+        return dict(self.backend.stats(), revalidated=self.revalidated)
+
+
+class RateLimiter(object):
+
+    """
+    token bucket for one brightpearl account
+    counts down locally between responses and resyncs with the
+    requests-remaining / next-throttle-period headers brightpearl
+    sends back, so calls run at full speed until the bucket is empty
+    and then wait for the next period instead of getting 503s
+    """
+
+    accounts = dict()
+    accounts_lock = threading.Lock()
 
-    def get_stock_levels(self, request_range):
+    def __init__(self, capacity=DEFAULT_RATE_LIMIT, period=DEFAULT_RATE_PERIOD,
+            reserve=0, clock=time.monotonic, sleep=time.sleep):
         """
-        returns stock levels for products
-        comma separated or range
+        Parameters
+        ----------
+        capacity: integer for the number of requests allowed per period
+        period: float for the length of a throttle period in seconds
+        reserve: integer for requests to leave unused in each period
+            as head room for other clients of the same account
+        clock, sleep: time functions, replaceable for testing
         """
 
-        warehouse_service_uri = "{}warehouse-service/product-availability/{}".format(self.uri, request_range)
-        return self.get(warehouse_service_uri)
+        self.capacity = capacity
+        self.period = period
+        self.reserve = reserve
+        self.clock = clock
+        self.sleep = sleep
 
+        self.remaining = capacity
+        self.reset_at = None
+        self.lock = threading.Lock()
 
-class Tools(object):
+    @staticmethod
+    def for_account(key, **kwargs):
+        """
+        returns the RateLimiter shared by every API on the same account
+        """
 
-    def list_of_request_ranges(self, request_range):
+        with RateLimiter.accounts_lock:
+            if key not in RateLimiter.accounts:
+                RateLimiter.accounts[key] = RateLimiter(**kwargs)
+            return RateLimiter.accounts[key]
+
+    @staticmethod
+    def reset_accounts():
         """
-        Used when OPTIONS cannot be requested.
-        Splits request range into 200 item chunks for use within
-        brightpearl request limit.
+        forgets the shared RateLimiters of for_account, i.e. between tests
         """
 
-        request_numbers = request_range.split("-")
+        with RateLimiter.accounts_lock:
+            RateLimiter.accounts.clear()
 
-        #for single item requests
-        if len(request_numbers) == 1:
-            return [request_range]
+    def reserve_token(self):
+        """
+        takes a token if one is available
 
-        begin = int(request_numbers[0])
-        end = int(request_numbers[1])
+        Returns
+        -------
+        float: 0 if a token was taken, otherwise seconds until the bucket refills
+        """
 
+        with self.lock:
+            now = self.clock()
+            if self.reset_at is None or now >= self.reset_at:
+                self.remaining = self.capacity
+                self.reset_at = now + self.period
 
-        request_ranges = list()
-        while begin < end:
-            uri_request = "-".join((str(begin), str(begin+199)))
-            begin += 200
-            request_ranges.append(uri_request)
+            if self.remaining > self.reserve:
+                self.remaining -= 1
+                return 0
 
-        request_ranges.pop()
+            return self.reset_at - now
 
-        if begin == end:
-            last = str(begin)
+    def acquire(self):
+        """
+        blocks until a request may be sent
+        """
 
-        else:
-            last = "-".join((str(begin-200), str(end)))
+        wait = self.reserve_token()
+        while wait > 0:
+            self.sleep(wait)
+            wait = self.reserve_token()
 
-        request_ranges.append(last)
+    def update(self, headers):
+        """
+        resyncs the bucket from brightpearl's response headers
+        """
 
-        return request_ranges
+        remaining = headers.get(REQUESTS_REMAINING_HEADER)
+        next_period = headers.get(NEXT_THROTTLE_PERIOD_HEADER)
 
-    def grouper(iterable, chunks=None, chunksize=None, fillvalue=None):
+        with self.lock:
+            if next_period is not None:
+                self.reset_at = self.clock() + int(next_period) / 1000.0
+            if remaining is not None:
+                self.remaining = int(remaining)
+
+    def throttle_delay(self, headers, attempt):
         """
-        Parameters
-        ----------
-        iterable: iterable oblect to be split up
-        chunks: integer denoting how many chunks to produce
-            default: None
-            notes: overrides chunksize if listed
-        chunksize: integer denoting max size of each chunk
-            default: None
-        fillvalue: string or integer to fill extra places in list with
-            default: None
+        empties the bucket after a throttled response
 
         Returns
         -------
-        cleaned_list: list of cleaned lists with None fillvalue removed
+        float: seconds to wait before retrying
+        """
+
+        next_period = headers.get(NEXT_THROTTLE_PERIOD_HEADER)
+
+        with self.lock:
+            self.remaining = 0
+            if next_period is not None:
+                delay = int(next_period) / 1000.0
+            else:
+                # no hint from brightpearl, back off exponentially
+                delay = min(2 ** attempt, self.period)
+            self.reset_at = self.clock() + delay
+            return delay
+
+    def throttled(self, headers, attempt):
+        """
+        waits out a throttled response before it is retried
+        """
 
-        Source
-        ------
-        https://docs.python.org/3/library/itertools.html#itertools-recipes
+        self.sleep(self.throttle_delay(headers, attempt))
+
+
+def lazy_section(name):
+    """
+    property for a nested section of a Record that may be stored as
+    compact json and is only decoded (and converted) on first access
+    """
+
+    slot = "_" + name
+
+    def get_section(self):
+        value = getattr(self, slot)
+        if isinstance(value, str):
+            value = self.convert_section(name, json.loads(value))
+            setattr(self, slot, value)
+        return value
+
+    return property(get_section)
+
+
+class Record(object):
+
+    """
+    base for compact, typed records of brightpearl resources
+    subclasses list their scalar fields as (attribute, path into the json)
+    and their nested sections as (attribute, json key); nested sections
+    are kept as compact json strings in lazy mode and decoded on first access
+    """
+
+    __slots__ = ()
+    fields = ()
+    sections = ()
+
+    @classmethod
+    def from_json(cls, data, lazy=False):
+        """
+        Parameters
+        ----------
+        data: dictionary as returned by brightpearl
+        lazy: boolean, keep nested sections as json until first access
+        """
+
+        record = cls.__new__(cls)
+        for attribute, path in cls.fields:
+            value = data
+            for key in path:
+                if not isinstance(value, dict):
+                    value = None
+                    break
+                value = value.get(key)
+            setattr(record, attribute, value)
+
+        for attribute, key in cls.sections:
+            section = data.get(key)
+            if lazy and section is not None:
+                section = json.dumps(section, separators=(',', ':'))
+            else:
+                section = record.convert_section(attribute, section)
+            setattr(record, "_" + attribute, section)
+        return record
+
+    def convert_section(self, name, section):
+        """
+        hook to turn a decoded section into typed records
+        """
+
+        return section
+
+    def __repr__(self):
+        return "{}(id={!r})".format(type(self).__name__, getattr(self, "id", None))
+
+
+class OrderRow(Record):
+
+    """
+    one row of an order, from the orderRows section
+    """
+
+    fields = (
+        ('product_id', ('productId',)),
+        ('product_name', ('productName',)),
+        ('sku', ('productSku',)),
+        ('quantity', ('quantity', 'magnitude')),
+        ('net', ('rowValue', 'rowNet', 'value')),
+        ('tax', ('rowValue', 'rowTax', 'value')),
+        ('tax_code', ('rowValue', 'taxCode')),
+        ('nominal_code', ('nominalCode',)),
+        )
+    __slots__ = ('row_id',) + tuple(attribute for attribute, path in fields)
+
+    def __repr__(self):
+        return "OrderRow(row_id={!r}, product_id={!r})".format(self.row_id, self.product_id)
+
+
+class Order(Record):
+
+    """
+    compact order from the order service
+    rows, parties, delivery, invoices and custom_fields are nested sections
+    """
+
+    fields = (
+        ('id', ('id',)),
+        ('parent_order_id', ('parentOrderId',)),
+        ('order_type_code', ('orderTypeCode',)),
+        ('reference', ('reference',)),
+        ('order_status_id', ('orderStatus', 'orderStatusId')),
+        ('order_payment_status', ('orderPaymentStatus',)),
+        ('stock_status_code', ('stockStatusCode',)),
+        ('allocation_status_code', ('allocationStatusCode',)),
+        ('shipping_status_code', ('shippingStatusCode',)),
+        ('placed_on', ('placedOn',)),
+        ('created_on', ('createdOn',)),
+        ('updated_on', ('updatedOn',)),
+        ('price_list_id', ('priceListId',)),
+        ('warehouse_id', ('warehouseId',)),
+        ('channel_id', ('assignment', 'current', 'channelId')),
+        ('currency_code', ('currency', 'orderCurrencyCode')),
+        ('total_net', ('totalValue', 'net')),
+        ('total_tax', ('totalValue', 'taxAmount')),
+        ('total_value', ('totalValue', 'total')),
+        )
+    sections = (
+        ('rows', 'orderRows'),
+        ('parties', 'parties'),
+        ('delivery', 'delivery'),
+        ('invoices', 'invoices'),
+        ('custom_fields', 'customFields'),
+        )
+    __slots__ = (tuple(attribute for attribute, path in fields)
+            + tuple("_" + attribute for attribute, key in sections))
+
+    rows = lazy_section('rows')
+    parties = lazy_section('parties')
+    delivery = lazy_section('delivery')
+    invoices = lazy_section('invoices')
+    custom_fields = lazy_section('custom_fields')
+
+    def convert_section(self, name, section):
+
+        if name != 'rows' or section is None:
+            return section
+
+        rows = list()
+        for row_id, row in section.items():
+            order_row = OrderRow.from_json(row)
+            order_row.row_id = int(row_id) if str(row_id).isdigit() else row_id
+            rows.append(order_row)
+        return rows
+
+
+class Product(Record):
+
+    """
+    compact product from the product service
+    sales_channels, stock, financial_details, variations and
+    custom_fields are nested sections
+    """
+
+    fields = (
+        ('id', ('id',)),
+        ('sku', ('identity', 'sku')),
+        ('ean', ('identity', 'ean')),
+        ('barcode', ('identity', 'barcode')),
+        ('product_group_id', ('productGroupId',)),
+        ('brand_id', ('brandId',)),
+        ('product_type_id', ('productTypeId',)),
+        ('status', ('status',)),
+        ('created_on', ('createdOn',)),
+        ('updated_on', ('updatedOn',)),
+        )
+    sections = (
+        ('sales_channels', 'salesChannels'),
+        ('stock', 'stock'),
+        ('financial_details', 'financialDetails'),
+        ('variations', 'variations'),
+        ('custom_fields', 'customFields'),
+        )
+    __slots__ = (tuple(attribute for attribute, path in fields)
+            + tuple("_" + attribute for attribute, key in sections))
+
+    sales_channels = lazy_section('sales_channels')
+    stock = lazy_section('stock')
+    financial_details = lazy_section('financial_details')
+    variations = lazy_section('variations')
+    custom_fields = lazy_section('custom_fields')
+
+
+class PriceMatrix(object):
+
+    """
+    columnar table of product prices
+    product_ids: array of product ids, one per row
+    price_list_ids: array of price list ids, one per column
+    prices: float matrix of shape (products, price lists), NaN for missing
+    """
+
+    def __init__(self, product_ids, price_list_ids, prices):
+
+        if numpy is None:
+            raise ImportError("PriceMatrix requires numpy to be installed")
+
+        self.product_ids = numpy.asarray(product_ids, dtype=numpy.int64)
+        self.price_list_ids = numpy.asarray(price_list_ids, dtype=numpy.int64)
+        self.prices = numpy.asarray(prices, dtype=numpy.float64).reshape(
+            len(self.product_ids), len(self.price_list_ids))
+        self._order = numpy.argsort(self.product_ids, kind="stable")
+        self._sorted_ids = self.product_ids[self._order]
+
+    @classmethod
+    def from_prices(cls, product_prices, rows=DEFAULT_PRICE_MATRIX_ROWS):
+        """
+        Parameters
+        ----------
+        product_prices: iterable of (product_id, {price_list_id: price})
+            as yielded by API.iter_product_prices
+        rows: integer, initial row allocation, doubled whenever it runs out
+
+        Returns
+        -------
+        PriceMatrix filled while the iterable is consumed, so that
+        no per-product dictionaries are kept around
+        """
+
+        builder = PriceMatrixBuilder(rows)
+        for product_id, product_price in product_prices:
+            builder.append(product_id, product_price)
+        return builder.finish()
+
+    def __len__(self):
+        return len(self.product_ids)
+
+    def rows_of(self, product_ids):
+        """
+        returns the row index of each product id, -1 for unknown products
+        """
+
+        product_ids = numpy.asarray(product_ids, dtype=numpy.int64)
+        if not len(self.product_ids):
+            return numpy.full(product_ids.shape, -1)
+        positions = numpy.searchsorted(self._sorted_ids, product_ids)
+        positions = numpy.minimum(positions, len(self._sorted_ids) - 1)
+        found = self._sorted_ids[positions] == product_ids
+        return numpy.where(found, self._order[positions], -1)
+
+    def column(self, price_list_id):
+        """
+        returns the prices of every product for one price list
+        """
+
+        columns = numpy.flatnonzero(self.price_list_ids == price_list_id)
+        if not len(columns):
+            raise KeyError("Unknown price list: {}".format(price_list_id))
+        return self.prices[:, columns[0]]
+
+    def lookup(self, product_ids, price_list_id):
+        """
+        returns the prices of the given products for one price list,
+        NaN for unknown products or missing prices
+        """
+
+        rows = self.rows_of(product_ids)
+        column = self.column(price_list_id)
+        return numpy.where(rows >= 0, column[rows], numpy.nan)
+
+    def align(self, other):
+        """
+        returns other's prices rearranged to this matrix's rows and columns,
+        NaN where other has no such product or price list
+        """
+
+        aligned = numpy.full(self.prices.shape, numpy.nan)
+        rows = other.rows_of(self.product_ids)
+        known_rows = rows >= 0
+        for column, price_list_id in enumerate(self.price_list_ids):
+            other_columns = numpy.flatnonzero(other.price_list_ids == price_list_id)
+            if len(other_columns):
+                aligned[known_rows, column] = other.prices[rows[known_rows], other_columns[0]]
+        return aligned
+
+    def diff(self, other):
+        """
+        returns a PriceMatrix of this matrix's prices minus other's,
+        NaN where either side has no price
+        """
+
+        return PriceMatrix(self.product_ids, self.price_list_ids,
+                self.prices - self.align(other))
+
+    def changed(self, other):
+        """
+        returns the product ids whose prices differ from other's,
+        including prices that were added or removed
+        """
+
+        theirs = self.align(other)
+        missing = numpy.isnan(self.prices) != numpy.isnan(theirs)
+        different = ~numpy.isnan(self.prices) & ~numpy.isnan(theirs) & (self.prices != theirs)
+        return self.product_ids[(missing | different).any(axis=1)]
+
+    def margin(self, price_list_id, cost_list_id):
+        """
+        returns (price - cost) / price of every product,
+        NaN where either price is missing or the price is zero
+        """
+
+        price = self.column(price_list_id)
+        cost = self.column(cost_list_id)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            margin = (price - cost) / price
+        return numpy.where(price == 0, numpy.nan, margin)
+
+    def to_dict(self):
+        """
+        returns the {product_id: {price_list_id: price}} form of get_product_prices,
+        leaving out missing prices
+        """
+
+        price_list_ids = self.price_list_ids.tolist()
+        prices_data = dict()
+        for product_id, row in zip(self.product_ids.tolist(), self.prices.tolist()):
+            prices_data[product_id] = {price_list_id: price
+                    for price_list_id, price in zip(price_list_ids, row)
+                    if price == price}
+        return prices_data
+
+
+class PriceMatrixBuilder(object):
+
+    """
+    fills the rows of a PriceMatrix one product at a time,
+    so that price pages can be dropped as soon as they are appended
+    (i.e. while an async generator is still yielding them)
+    """
+
+    def __init__(self, rows=DEFAULT_PRICE_MATRIX_ROWS):
+        """
+        rows: integer, initial row allocation, doubled whenever it runs out
+        """
+
+        if numpy is None:
+            raise ImportError("PriceMatrix requires numpy to be installed")
+
+        self.product_ids = numpy.empty(max(rows, 1), dtype=numpy.int64)
+        self.prices = numpy.full((max(rows, 1), 0), numpy.nan)
+        self.product_rows = dict()
+        self.price_list_columns = dict()
+        self.count = 0
+
+    def append(self, product_id, product_price):
+        """
+        product_price: {price_list_id: price}, merged into the row of
+            product_id when it was appended before
+        """
+
+        row = self.product_rows.get(product_id)
+        if row is None:
+            count = self.count
+            if count == len(self.product_ids):
+                self.product_ids = numpy.resize(self.product_ids, 2 * count)
+                grown = numpy.full((2 * count, self.prices.shape[1]), numpy.nan)
+                grown[:count] = self.prices
+                self.prices = grown
+            row = self.product_rows[product_id] = count
+            self.product_ids[row] = product_id
+            self.count += 1
+
+        for price_list_id, price in product_price.items():
+            column = self.price_list_columns.get(price_list_id)
+            if column is None:
+                column = self.price_list_columns[price_list_id] = len(self.price_list_columns)
+                self.prices = numpy.hstack(
+                    [self.prices, numpy.full((len(self.prices), 1), numpy.nan)])
+            if price is not None:
+                self.prices[row, column] = float(price)
+
+    def finish(self):
+        """
+        returns the PriceMatrix of every price appended so far
+        """
+
+        return PriceMatrix(self.product_ids[:self.count], list(self.price_list_columns),
+                self.prices[:self.count])
+
+
+def to_float(value):
+    return numpy.nan if value is None else float(value)
+
+
+def to_int(value):
+    return -1 if value is None else int(value)
+
+
+class OrderFrame(object):
+
+    """
+    columnar table of order rows, one entry per row of every order
+    columns: dictionary of numpy arrays, see COLUMNS
+    ids are -1 and amounts NaN where brightpearl returned nothing
+    """
+
+    # (column, array typecode while streaming or None for strings, numpy dtype)
+    COLUMNS = (
+        ('order_id', 'q', 'int64'),
+        ('row_id', 'q', 'int64'),
+        ('product_id', 'q', 'int64'),
+        ('sku', None, 'str'),
+        ('quantity', 'd', 'float64'),
+        ('net', 'd', 'float64'),
+        ('tax', 'd', 'float64'),
+        ('placed_on', None, 'datetime64[D]'),
+        ('channel_id', 'q', 'int64'),
+        ('order_status_id', 'q', 'int64'),
+        ('order_type_code', None, 'str'),
+        )
+
+    def __init__(self, columns):
+
+        if numpy is None:
+            raise ImportError("OrderFrame requires numpy to be installed")
+
+        self.columns = columns
+
+    @classmethod
+    def from_orders(cls, orders):
+        """
+        Parameters
+        ----------
+        orders: iterable of order dictionaries or Order records,
+            i.e. API.iter_order_data; consumed one order at a time
+
+        Returns
+        -------
+        OrderFrame with one entry per order row
+        """
+
+        builder = OrderFrameBuilder()
+        for order in orders:
+            builder.append(order)
+        return builder.finish()
+
+    def __len__(self):
+        return len(self.columns['order_id'])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def select(self, mask):
+        """
+        returns a new OrderFrame with the rows where mask is True
+        """
+
+        return OrderFrame({name: column[mask] for name, column in self.columns.items()})
+
+    def aggregate(self, by, sums=('quantity', 'net', 'tax')):
+        """
+        grouped aggregation over the order rows
+
+        Parameters
+        ----------
+        by: list of column names to group by, i.e. ('sku', 'placed_on')
+        sums: list of numeric column names to add up per group,
+            missing (NaN) amounts count as zero
+
+        Returns
+        -------
+        dictionary of arrays, one entry per group: the group key columns,
+        the summed columns and 'rows' with the number of order rows
+        """
+
+        codes = numpy.zeros(len(self), dtype=numpy.int64)
+        for name in by:
+            uniques, inverse = numpy.unique(self.columns[name], return_inverse=True)
+            codes = codes * len(uniques) + inverse.reshape(-1)
+
+        groups, first, inverse = numpy.unique(codes, return_index=True, return_inverse=True)
+        inverse = inverse.reshape(-1)
+
+        result = {name: self.columns[name][first] for name in by}
+        for name in sums:
+            result[name] = numpy.bincount(inverse, weights=numpy.nan_to_num(self.columns[name]),
+                    minlength=len(groups))
+        result['rows'] = numpy.bincount(inverse, minlength=len(groups))
+        return result
+
+    def sales_per_sku_per_day(self):
+        """
+        quantity, net and tax per SKU and day the order was placed on
+        """
+
+        return self.aggregate(('sku', 'placed_on'))
+
+
+class OrderFrameBuilder(object):
+
+    """
+    fills the columns of an OrderFrame one order at a time,
+    so that orders can be dropped as soon as they are appended
+    (i.e. while an async generator is still yielding them)
+    """
+
+    def __init__(self):
+
+        if numpy is None:
+            raise ImportError("OrderFrame requires numpy to be installed")
+
+        self.buffers = {name: array(typecode) if typecode else list()
+                        for name, typecode, dtype in OrderFrame.COLUMNS}
+
+    def append(self, order):
+        """
+        order: order dictionary or Order record
+        """
+
+        if not isinstance(order, Order):
+            order = Order.from_json(order)
+        buffers = self.buffers
+        placed_on = order.placed_on[:10] if order.placed_on else "NaT"
+        for row in order.rows or ():
+            buffers['order_id'].append(to_int(order.id))
+            buffers['row_id'].append(to_int(row.row_id))
+            buffers['product_id'].append(to_int(row.product_id))
+            buffers['sku'].append(row.sku or "")
+            buffers['quantity'].append(to_float(row.quantity))
+            buffers['net'].append(to_float(row.net))
+            buffers['tax'].append(to_float(row.tax))
+            buffers['placed_on'].append(placed_on)
+            buffers['channel_id'].append(to_int(order.channel_id))
+            buffers['order_status_id'].append(to_int(order.order_status_id))
+            buffers['order_type_code'].append(order.order_type_code or "")
+
+    def finish(self):
+        """
+        returns the OrderFrame of every order appended so far
+        """
+
+        return OrderFrame({name: numpy.array(self.buffers[name], dtype=dtype)
+                           for name, typecode, dtype in OrderFrame.COLUMNS})
+
+
+class JSONArrayStream(object):
+
+    """
+    iterates over the items of one array inside a json object
+    while the bytes of the object are still arriving, i.e.
+    the orders of {"response": [{...}, {...}]}, so that a whole page
+    is never held in memory as text or as decoded objects
+    """
+
+    def __init__(self, chunks, key="response"):
+        """
+        Parameters
+        ----------
+        chunks: iterable of bytes, i.e. requests.Response.iter_content()
+        key: string, the key of the array whose items are yielded;
+            other keys of the object are decoded and skipped
+        """
+
+        self.chunks = iter(chunks)
+        self.key = key
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ""
+        self.position = 0
+        self.eof = False
+
+    def read_more(self):
+        """
+        appends the next chunk to the buffer, dropping what has been parsed
+        returns False once the chunks are exhausted
+        """
+
+        if self.eof:
+            return False
+
+        for chunk in self.chunks:
+            text = self.utf8.decode(chunk)
+            if text:
+                self.buffer = self.buffer[self.position:] + text
+                self.position = 0
+                return True
+
+        self.buffer = self.buffer[self.position:] + self.utf8.decode(b"", final=True)
+        self.position = 0
+        self.eof = True
+        return False
+
+    def peek(self):
+        """
+        skips whitespace and returns the next character, None at the end
+        """
+
+        while True:
+            self.position = JSON_WHITESPACE.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.read_more():
+                return None
+
+    def expect(self, character):
+
+        if self.peek() != character:
+            raise ValueError("Expected {!r} at position {}".format(character, self.position))
+        self.position += 1
+
+    def value(self):
+        """
+        decodes the next complete json value, reading more chunks until
+        it is complete (a number ending at the end of the buffer, or
+        followed by the start of a fraction or exponent such as "1." or
+        "1e", may still continue in the next chunk)
+        """
+
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                if self.eof or not (
+                        end == len(self.buffer)
+                        or (isinstance(value, (int, float)) and not isinstance(value, bool)
+                            and self.buffer[end] in JSON_NUMBER_CHARACTERS)):
+                    self.position = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.read_more()
+
+    def __iter__(self):
+
+        self.expect("{")
+        while True:
+            character = self.peek()
+            if character == "}":
+                return
+            if character == ",":
+                self.position += 1
+                continue
+            if character is None:
+                raise ValueError("Unterminated json object")
+
+            name = self.value()
+            self.expect(":")
+            if name == self.key and self.peek() == "[":
+                self.position += 1
+                for item in self.items():
+                    yield item
+            else:
+                self.value()
+
+    def items(self):
+
+        while True:
+            character = self.peek()
+            if character == "]":
+                self.position += 1
+                return
+            if character == ",":
+                self.position += 1
+                continue
+            if character is None:
+                raise ValueError("Unterminated json array")
+            yield self.value()
+
+
+class Histogram(object):
+
+    """
+    fixed bucket histogram, cheap enough to update on every request
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def observe(self, value):
+
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+
+    def quantile(self, fraction):
+        """
+        returns the upper bound of the bucket holding the fraction
+        quantile, or the maximum for values above the last bucket
+        """
+
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(bound, self.maximum)
+        return self.maximum
+
+    def snapshot(self):
+
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "min": self.minimum,
+            "max": self.maximum,
+            "p50": self.quantile(0.50),
+            "p99": self.quantile(0.99),
+            "buckets": dict(zip(self.buckets + (float("inf"),), self.counts)),
+            }
+
+
+class Metrics(object):
+
+    """
+    counters and histograms for every request API makes, keyed by the
+    operation (public API method), service and resource of the request
+    exporters are callables that receive snapshot() on export()
+    """
+
+    def __init__(self, exporters=None):
+
+        self.exporters = list(exporters or ())
+        self.lock = threading.Lock()
+        self.entries = dict()
+
+    def entry(self, operation, service, resource):
+
+        key = (operation, service, resource)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = {
+                "methods": dict(),
+                "statuses": dict(),
+                "bytes": 0,
+                "latency": Histogram(),
+                "decode": Histogram(),
+                }
+        return entry
+
+    def record_request(self, operation, service, resource, method, status, size, latency):
+
+        with self.lock:
+            entry = self.entry(operation, service, resource)
+            entry["methods"][method] = entry["methods"].get(method, 0) + 1
+            entry["statuses"][status] = entry["statuses"].get(status, 0) + 1
+            entry["bytes"] += size
+            entry["latency"].observe(latency)
+
+    def record_decode(self, operation, service, resource, seconds):
+
+        with self.lock:
+            self.entry(operation, service, resource)["decode"].observe(seconds)
+
+    def snapshot(self):
+        """
+        returns {"operation service/resource": counters and histograms}
+        """
+
+        with self.lock:
+            return {
+                "{} {}/{}".format(operation, service, resource): {
+                    "operation": operation,
+                    "service": service,
+                    "resource": resource,
+                    "requests": sum(entry["methods"].values()),
+                    "methods": dict(entry["methods"]),
+                    "statuses": dict(entry["statuses"]),
+                    "bytes": entry["bytes"],
+                    "latency": entry["latency"].snapshot(),
+                    "decode": entry["decode"].snapshot(),
+                    }
+                for (operation, service, resource), entry in self.entries.items()}
+
+    def export(self):
+        """
+        hands a snapshot to every exporter
+        """
+
+        snapshot = self.snapshot()
+        for exporter in self.exporters:
+            exporter(snapshot)
+        return snapshot
+
+    def reset(self):
+
+        with self.lock:
+            self.entries.clear()
+
+
+class JSONLinesExporter(object):
+
+    """
+    metrics exporter appending each snapshot as one json line to a file
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, snapshot):
+
+        line = json.dumps({"time": time.time(), "metrics": snapshot}, default=str)
+        with open(self.path, "a") as export_file:
+            export_file.write(line + "\n")
+
+
+class Span(object):
+
+    """
+    one timed step of a trace: a public API method or one http request
+    start is a unix timestamp, end is None while the span is open
+    """
+
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'start', 'end',
+                 'attributes', 'error')
+
+    def __init__(self, name, trace_id, span_id, parent_id=None, start=None, attributes=None):
+
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.start = time.time() if start is None else start
+        self.end = None
+        self.attributes = attributes or {}
+        self.error = None
+
+    @property
+    def duration(self):
+
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+    def to_dict(self):
+
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "duration": self.duration,
+            "attributes": self.attributes,
+            "error": None if self.error is None else repr(self.error),
+            }
+
+    def __repr__(self):
+        return "Span({!r}, span_id={!r}, parent_id={!r})".format(
+            self.name, self.span_id, self.parent_id)
+
+
+class Tracer(object):
+
+    """
+    starts and ends spans and hands them to hooks
+    a hook is any object with on_start(span) and/or on_end(span)
+    """
+
+    def __init__(self, hooks=None):
+
+        self.hooks = list(hooks or ())
+
+    def start_span(self, name, parent=None, start=None, **attributes):
+        """
+        Parameters
+        ----------
+        name: string, i.e. "get_order_data" or "GET order/order"
+        parent: Span this one is part of, None starts a new trace
+        start: unix timestamp, default: now
+        attributes: extra details kept on the span
+        """
+
+        trace_id = parent.trace_id if parent is not None else os.urandom(16).hex()
+        span = Span(name, trace_id, os.urandom(8).hex(),
+                    parent_id=None if parent is None else parent.span_id,
+                    start=start, attributes=attributes)
+        for hook in self.hooks:
+            on_start = getattr(hook, "on_start", None)
+            if on_start is not None:
+                on_start(span)
+        return span
+
+    def end_span(self, span, error=None):
+
+        span.end = time.time()
+        span.error = error
+        for hook in self.hooks:
+            on_end = getattr(hook, "on_end", None)
+            if on_end is not None:
+                on_end(span)
+
+
+class SpanFileExporter(object):
+
+    """
+    tracer hook appending every finished span as one json line to a file
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        self.lock = threading.Lock()
+
+    def on_end(self, span):
+
+        line = json.dumps(span.to_dict(), default=str)
+        with self.lock:
+            with open(self.path, "a") as export_file:
+                export_file.write(line + "\n")
+
+
+class OperationScope(object):
+
+    """
+    what a marked API method sets while it runs: its operation name,
+    unless an outer method has already set one, and its own span
+    when the API has a tracer
+    """
+
+    __slots__ = ('name', 'outer', 'tracer', 'span')
+
+    def __init__(self, api, name):
+
+        self.name = name
+        self.outer = OPERATION.get() is not None
+        self.tracer = api.tracer
+        self.span = None
+        if self.tracer is not None:
+            self.span = self.tracer.start_span(name, parent=CURRENT_SPAN.get(), kind="operation")
+
+    def enter(self):
+
+        operation_token = None if self.outer else OPERATION.set(self.name)
+        span_token = None if self.span is None else CURRENT_SPAN.set(self.span)
+        return operation_token, span_token
+
+    def exit(self, tokens):
+
+        operation_token, span_token = tokens
+        if span_token is not None:
+            CURRENT_SPAN.reset(span_token)
+        if operation_token is not None:
+            OPERATION.reset(operation_token)
+
+    def finish(self, error=None):
+
+        if self.span is not None:
+            self.tracer.end_span(self.span, error)
+
+
+def operation(function):
+    """
+    marks a public API method as an operation: its requests are recorded
+    under the outermost marked method (i.e. sku_lookup rather than the
+    lookup_service it calls) and each call gets a span when tracing
+    does nothing unless the API has metrics or a tracer
+    """
+
+    name = function.__name__
+
+    if inspect.isasyncgenfunction(function):
+        @functools.wraps(function)
+        async def wrapper(self, *args, **kwargs):
+            generator = function(self, *args, **kwargs)
+            if not self.instrumented():
+                async for item in generator:
+                    yield item
+                return
+            scope = OperationScope(self, name)
+            error = None
+            try:
+                while True:
+                    tokens = scope.enter()
+                    try:
+                        item = await generator.__anext__()
+                    except StopAsyncIteration:
+                        return
+                    finally:
+                        scope.exit(tokens)
+                    yield item
+            except Exception as exception:
+                error = exception
+                raise
+            finally:
+                scope.finish(error)
+
+    elif inspect.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def wrapper(self, *args, **kwargs):
+            if not self.instrumented():
+                return await function(self, *args, **kwargs)
+            scope = OperationScope(self, name)
+            tokens = scope.enter()
+            error = None
+            try:
+                return await function(self, *args, **kwargs)
+            except Exception as exception:
+                error = exception
+                raise
+            finally:
+                scope.exit(tokens)
+                scope.finish(error)
+
+    elif inspect.isgeneratorfunction(function):
+        @functools.wraps(function)
+        def wrapper(self, *args, **kwargs):
+            generator = function(self, *args, **kwargs)
+            if not self.instrumented():
+                return generator
+            return operation_generator(OperationScope(self, name), generator)
+
+    else:
+        @functools.wraps(function)
+        def wrapper(self, *args, **kwargs):
+            if not self.instrumented():
+                return function(self, *args, **kwargs)
+            scope = OperationScope(self, name)
+            tokens = scope.enter()
+            error = None
+            try:
+                return function(self, *args, **kwargs)
+            except Exception as exception:
+                error = exception
+                raise
+            finally:
+                scope.exit(tokens)
+                scope.finish(error)
+
+    return wrapper
+
+
+def operation_generator(scope, generator):
+    """
+    runs each step of generator inside scope,
+    finishing it once the generator is exhausted or closed
+    """
+
+    error = None
+    try:
+        while True:
+            tokens = scope.enter()
+            try:
+                item = next(generator)
+            except StopIteration:
+                return
+            finally:
+                scope.exit(tokens)
+            yield item
+    except Exception as exception:
+        error = exception
+        raise
+    finally:
+        scope.finish(error)
+
+
+class Transport(object):
+
+    """
+    sends the actual http requests for API
+    keeps a pool of persistent connections so that repeated calls
+    to the same datacentre reuse warm TCP/TLS connections
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=None):
+        """
+        Parameters
+        ----------
+        pool_size: integer for the max number of connections kept
+            alive per host
+            default: DEFAULT_POOL_SIZE
+        timeout: float (seconds) or (connect, read) tuple passed on
+            to every request
+            default: None (wait forever)
+        """
+
+        self.pool_size = pool_size
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method, the_uri, headers=None, data=None, stream=False):
+        """
+        sends a single request over the pooled session
+        and returns the requests.Response
+        stream: boolean, leave the body unread for Response.iter_content
+        """
+
+        return self.session.request(
+            method, the_uri, headers=headers, data=data, timeout=self.timeout,
+            stream=stream,
+            )
+
+    def close(self):
+        """
+        closes all pooled connections
+        """
+
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class RecordingTransport(object):
+
+    """
+    wraps a transport and appends every request and response
+    (headers, body and timing) to a gzipped json lines cassette
+    that ReplayTransport can serve back; tokens and the credentials
+    of the authorise call are not recorded
+    """
+
+    def __init__(self, transport, path):
+        """
+        Parameters
+        ----------
+        transport: the Transport (or compatible object) that sends the requests
+        path: string, cassette file, appended to if it exists
+        """
+
+        self.transport = transport
+        self.path = path
+        self.lock = threading.Lock()
+        self.archive = gzip.open(path, "at", encoding="utf-8")
+
+    def request(self, method, the_uri, headers=None, data=None, stream=False):
+
+        options = {"stream": True} if stream else {}
+        start = time.perf_counter()
+        response = self.transport.request(method, the_uri, headers=headers, data=data, **options)
+        # reads a streamed body too, iter_content then serves it from memory
+        content = response.content
+        elapsed = time.perf_counter() - start
+
+        self.write({
+            "method": method,
+            "uri": the_uri,
+            "request_headers": {name: (REDACTED if name.lower() in SECRET_HEADERS else value)
+                                for name, value in (headers or {}).items()},
+            "data": self.encode_data(the_uri, data),
+            "status": response.status_code,
+            "headers": dict(response.headers),
+            "body": content.decode('utf-8', 'replace') if self.is_text(content) else None,
+            "body_base64": None if self.is_text(content) else base64.b64encode(content).decode(),
+            "elapsed": elapsed,
+            })
+        return response
+
+    def encode_data(self, the_uri, data):
+
+        if data is None:
+            return None
+        if the_uri.endswith("/authorise"):
+            return REDACTED
+        if isinstance(data, bytes):
+            return data.decode('utf-8', 'replace')
+        return data
+
+    def is_text(self, content):
+
+        try:
+            content.decode('utf-8')
+        except UnicodeDecodeError:
+            return False
+        return True
+
+    def write(self, interaction):
+
+        line = json.dumps(interaction, separators=(',', ':'))
+        with self.lock:
+            self.archive.write(line + "\n")
+
+    def close(self):
+
+        with self.lock:
+            self.archive.close()
+        self.transport.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ReplayTransport(object):
+
+    """
+    serves the responses of a RecordingTransport cassette as
+    requests.Response objects, without any network access
+    repeated requests are answered in recorded order, the last
+    recording being reused once they run out
+    """
+
+    def __init__(self, path, latency=1.0, sleep=time.sleep):
+        """
+        Parameters
+        ----------
+        path: string, cassette written by RecordingTransport
+        latency: float, multiplies the recorded time of each response,
+            1.0 replays the original latencies, 0 answers at once
+        sleep: function used to wait, for tests
+        """
+
+        self.latency = latency
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.interactions = dict()
+        self.replayed = 0
+
+        with gzip.open(path, "rt", encoding="utf-8") as archive:
+            for line in archive:
+                if line.strip():
+                    interaction = json.loads(line)
+                    self.interactions.setdefault(
+                        self.key(interaction["method"], interaction["uri"], interaction["data"]),
+                        deque()).append(interaction)
+
+    def key(self, method, the_uri, data):
+
+        if isinstance(data, bytes):
+            data = data.decode('utf-8', 'replace')
+        if the_uri.endswith("/authorise"):
+            data = REDACTED if data is not None else None
+        return method, the_uri, data
+
+    def request(self, method, the_uri, headers=None, data=None, stream=False):
+
+        key = self.key(method, the_uri, data)
+        with self.lock:
+            recorded = self.interactions.get(key)
+            if not recorded:
+                raise KeyError("No recorded response for {} {}".format(method, the_uri))
+            interaction = recorded.popleft() if len(recorded) > 1 else recorded[0]
+            self.replayed += 1
+
+        if self.latency:
+            self.sleep(interaction["elapsed"] * self.latency)
+        return self.response(interaction)
+
+    def response(self, interaction):
+
+        response = requests.Response()
+        response.status_code = interaction["status"]
+        response.headers = requests.structures.CaseInsensitiveDict(interaction["headers"])
+        response.url = interaction["uri"]
+        response.encoding = 'utf-8'
+        if interaction["body"] is not None:
+            response._content = interaction["body"].encode('utf-8')
+        else:
+            response._content = base64.b64decode(interaction["body_base64"])
+        # the body is already in memory, so iter_content and close
+        # (used by streamed requests) must not touch a connection
+        response._content_consumed = True
+        response.raw = io.BytesIO(response._content)
+        return response
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class API(object):
+
+    """
+    creates API calls to brightpearl
+    and creates the beginning of the URI
+    as well as the headers based on config parameters
+    """
+
+    def __init__(self, config, transport=None):
+        """
+        config: dictionary of brightpearl settings, optionally with
+            'pool_size' and 'timeout' for the default Transport,
+            'workers' for the default fan-out concurrency,
+            'prefetch' for the default read-ahead depth of iter_* methods,
+            'rate_limit' (True for the RateLimiter shared by every API on
+            the account, or a RateLimiter) to pace requests, default: off,
+            'plan' ("options" or "local") for how bulk getters chunk ranges,
+            'plan_cache' (True, or any cache object) to cache OPTIONS uri
+            plans, default: off; a cached plan does not see records created
+            after it was made, so a range may miss them for up to
+            'plan_cache_ttl' seconds (default 300),
+            'plan_cache_size' for the plans kept (size 0 turns it off),
+            'response_cache' (True or a ResponseCache) to cache GETs
+            'cache_path' to keep both caches in a SQLiteCache shared
+            by every process on the host
+            'product_mirror' (a ProductMirror) to answer SKU/EAN
+            lookups locally
+            and 'negative_cache' (True or a NegativeLookupCache) to reject
+            unknown SKUs/EANs without a search; once seeded, products
+            created outside this API are picked up by a createdOn search
+            every refresh_interval (60 s), and rejected until then
+            and 'max_retries' for retrying throttled (503) responses
+            'json_loads' (True for orjson when installed, or any callable
+            taking bytes) to replace the stdlib json decoder
+            and 'incremental' (True) to decode the orders and products of each
+            page one at a time from the byte stream in iter_order_data and
+            iter_products_data (serially, one page at a time; the get_*
+            methods still decode whole pages fetched by workers)
+            and 'metrics' (True or a Metrics) to record every request
+            and 'tracer' (a Tracer) or 'trace_path' (a file for a
+            SpanFileExporter) to trace every public method and request
+            and 'record_path' to record every request and response to a
+            cassette (see RecordingTransport) or 'replay_path' to answer
+            them from one (see ReplayTransport, 'replay_latency' scales
+            the recorded latencies, default 1.0)
+        transport: object with request() and close() methods,
+            replaces the default pooled Transport when given
+        """
+
+        self.datacentre = config['datacentre']
+        self.api_version = config['api_version']
+        self.account_code = config['account_code']
+        self.app_ref = config['brightpearl_app_ref']
+        self.authentication_token = None
+        self.staff_authentication_token = None
+
+        if 'brightpearl_account_token' in config:
+            self.authentication_token = config['brightpearl_account_token']
+
+        self.staff_authentication_headers = {
+                "brightpearl-app-ref": self.app_ref,
+                "Content-Type": "application/json"
+        }
+
+        self.uri = "https://ws-{}.brightpearl.com/{}/{}/".format(
+            self.datacentre, self.api_version, self.account_code)
+
+        self.authentication_uri = "https://ws-{}.brightpearl.com/{}/authorise".format(
+            self.datacentre, self.account_code)
+
+        self.headers = {
+            "brightpearl-app-ref": self.app_ref,
+            "brightpearl-account-token": self.authentication_token
+        }
+
+        if transport is None and config.get('replay_path'):
+            transport = ReplayTransport(
+                config['replay_path'], latency=config.get('replay_latency', 1.0))
+        if transport is None:
+            transport = Transport(
+                pool_size=config.get('pool_size', DEFAULT_POOL_SIZE),
+                timeout=config.get('timeout'),
+                )
+        if config.get('record_path'):
+            transport = RecordingTransport(transport, config['record_path'])
+        self.transport = transport
+        self.workers = config.get('workers')
+        self.prefetch = config.get('prefetch')
+
+        rate_limit = config.get('rate_limit', False)
+        if rate_limit is True:
+            rate_limit = RateLimiter.for_account((self.datacentre, self.account_code))
+        self.rate_limiter = rate_limit or None
+        self.max_retries = config.get('max_retries', DEFAULT_MAX_RETRIES)
+
+        self.plan = config.get('plan', "options")
+        self.resolve_plan()
+        cache_path = config.get('cache_path')
+        plan_cache = config.get('plan_cache')
+        plan_cache_size = config.get('plan_cache_size', DEFAULT_PLAN_CACHE_SIZE)
+        plan_cache_ttl = config.get('plan_cache_ttl', DEFAULT_PLAN_CACHE_TTL)
+        if plan_cache is True:
+            if not plan_cache_size:
+                plan_cache = None
+            elif cache_path is not None:
+                plan_cache = SQLiteCache(
+                    cache_path, namespace="plans", maxsize=plan_cache_size, ttl=plan_cache_ttl)
+            else:
+                plan_cache = LRUCache(maxsize=plan_cache_size, ttl=plan_cache_ttl)
+        self.plan_cache = plan_cache
+
+        response_cache = config.get('response_cache')
+        if response_cache is True:
+            backend = None
+            if cache_path is not None:
+                backend = SQLiteCache(
+                    cache_path, namespace="responses", maxsize=DEFAULT_RESPONSE_CACHE_SIZE,
+                    maxbytes=DEFAULT_RESPONSE_CACHE_BYTES)
+            response_cache = ResponseCache(backend=backend)
+        self.response_cache = response_cache or None
+        self.product_mirror = config.get('product_mirror')
+
+        negative_cache = config.get('negative_cache')
+        if negative_cache is True:
+            negative_cache = NegativeLookupCache()
+        self.negative_cache = negative_cache or None
+
+        json_loads = config.get('json_loads')
+        if json_loads is True:
+            json_loads = orjson.loads if orjson is not None else json.loads
+        self.json_loads = json_loads or None
+        self.incremental = config.get('incremental', False)
+
+        metrics = config.get('metrics')
+        if metrics is True:
+            metrics = Metrics()
+        self.metrics = metrics or None
+
+        self.tracer = config.get('tracer')
+        if self.tracer is None and config.get('trace_path'):
+            self.tracer = Tracer(hooks=[SpanFileExporter(config['trace_path'])])
+
+    def instrumented(self):
+        """
+        True when requests are recorded in metrics or traced
+        """
+
+        return self.metrics is not None or self.tracer is not None
+
+    def close(self):
+        """
+        releases the connections held by the transport
+        """
+
+        self.transport.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @operation
+    def get_brightpearl_staff_token(self, username, password):
+        """
+        calls the API to get the staff token
+        """
+
+
+        authentication_data = self.staff_authentication_data(username, password)
+
+        response = self.send(
+            "POST", self.authentication_uri,
+            self.staff_authentication_headers, authentication_data, {}
+            )
+
+        self.set_staff_token(self.decode(response, self.authentication_uri))
+
+    def decode(self, response, the_uri=None, body=None):
+        """
+        decodes a response body with self.json_loads when one is set,
+        or body instead when given (i.e. a cached body on a 304)
+        the decode time is recorded in self.metrics under the_uri
+        and ends the request's span
+        """
+
+        if not self.instrumented():
+            return self.decode_body(response, body)
+
+        start = time.perf_counter()
+        try:
+            return self.decode_body(response, body)
+        finally:
+            decode_time = time.perf_counter() - start
+            if self.metrics is not None:
+                self.metrics.record_decode(*self.metrics_key(the_uri), decode_time)
+            self.finish_request(response, decode_time)
+
+    def decode_body(self, response, body=None):
+
+        if body is not None:
+            return self.loads(body)
+        if self.json_loads is None:
+            return response.json()
+        return self.json_loads(response.content)
+
+    def metrics_key(self, the_uri, method="GET"):
+        """
+        returns (operation, service, resource) for a request,
+        service being the ALL_SERVICES name when there is one
+        """
+
+        operation_name = OPERATION.get() or method.lower()
+        match = SERVICE_URI.search(the_uri or "")
+        if match is None:
+            return operation_name, "auth" if the_uri == self.authentication_uri else "", ""
+        service, resource = match.groups()
+        return operation_name, SERVICE_NAMES.get((service, resource), service), resource
+
+    def record_request(self, method, the_uri, response, start, stream=False, waited=0.0):
+        """
+        records a finished request in self.metrics and starts its span,
+        which stays open until the response is decoded
+        start: perf_counter when the request went to the transport
+        waited: seconds spent waiting for the rate limiter first
+        streamed bodies are counted by their Content-Length
+        """
+
+        latency = time.perf_counter() - start
+        if stream:
+            size = int(response.headers.get("Content-Length") or 0)
+        else:
+            size = len(getattr(response, "content", None) or b"")
+        operation_name, service, resource = self.metrics_key(the_uri, method)
+
+        if self.metrics is not None:
+            self.metrics.record_request(operation_name, service, resource, method,
+                    response.status_code, size, latency)
+
+        if self.tracer is None:
+            return
+
+        queue_wait = QUEUE_WAIT.get()
+        span = self.tracer.start_span(
+            "{} {}/{}".format(method, service, resource), parent=CURRENT_SPAN.get(),
+            start=time.time() - latency - waited - queue_wait, kind="request",
+            method=method, uri=the_uri, status=response.status_code, bytes=size,
+            queue_wait=queue_wait, rate_limit_wait=waited, network=latency)
+        try:
+            response.trace_span = span
+        except AttributeError:
+            stream = True
+        if stream:
+            self.tracer.end_span(span)
+
+    def finish_request(self, response, decode_time=None):
+        """
+        ends the span of a response that is not going to be decoded further
+        """
+
+        span = getattr(response, "trace_span", None)
+        if span is None:
+            return
+        response.trace_span = None
+        if decode_time is not None:
+            span.attributes["decode"] = decode_time
+        self.tracer.end_span(span)
+
+    def loads(self, body):
+        """
+        decodes a cached body with self.json_loads when one is set
+        """
+
+        if self.json_loads is None:
+            return json.loads(body)
+        return self.json_loads(body)
+
+    def staff_authentication_data(self, username, password):
+        """
+        encodes the credentials for the staff token request
+        """
+
+        authentication_string = json.dumps(
+                {"apiAccountCredentials" :
+                    {"emailAddress":username, "password":password }
+                }
+                    )
+        return authentication_string.encode('utf-8')
+
+    def set_staff_token(self, decoded_data):
+        """
+        switches the headers over to the staff token
+        returned by the authorise call
+        """
+
+        self.staff_authentication_token = decoded_data['response']
+
+        self.headers = {
+            "brightpearl-app-ref": self.app_ref,
+            "brightpearl-staff-token": self.staff_authentication_token,
+        }
+
+
+    def get_uri(self, service, resource, reference_number=None):
+        """
+        service/resource as string: i.e. "orders", "products"
+        allows custom uris for calls not included in self.process_uri
+        only returns a single uri
+        """
+        resource_fragment = "{}-service/{}/".format(service, resource)
+
+        if reference_number is None:
+            return "{}{}".format(self.uri, resource_fragment)
+
+        return "{}{}{}".format(self.uri, resource_fragment, reference_number)
+
+
+    def get_service_uri(self, service, reference_number=None):
+        """
+        generate uri for certain services in ALL_SERVICE
+        service and order_numbers must be strings.
+        This method is essentially a shortcut for get_uri above.
+        """
+
+        return self.get_uri(ALL_SERVICES[service][0], ALL_SERVICES[service][1], reference_number)
+
+
+    def request(self, method, the_uri, data=None, headers=None, stream=False):
+        """
+        sends a request through the transport with the current headers
+        (plus any extra headers) and returns the raw response
+        waits for the rate limiter first and retries throttled responses
+        stream: boolean, passed on to the transport only when True
+        """
+
+        if headers:
+            headers = dict(self.headers, **headers)
+        else:
+            headers = self.headers
+        options = {"stream": True} if stream else {}
+
+        if self.rate_limiter is None:
+            return self.send(method, the_uri, headers, data, options)
+
+        attempt = 0
+        wait_start = time.perf_counter()
+        while True:
+            self.rate_limiter.acquire()
+            response = self.send(method, the_uri, headers, data, options,
+                    waited=time.perf_counter() - wait_start)
+            self.rate_limiter.update(response.headers)
+
+            if response.status_code != THROTTLED_STATUS or attempt >= self.max_retries:
+                return response
+
+            self.finish_request(response)
+            # a streamed response holds its pooled connection until closed
+            response.close()
+            wait_start = time.perf_counter()
+            self.rate_limiter.throttled(response.headers, attempt)
+            attempt += 1
+
+    def send(self, method, the_uri, headers, data, options, waited=0.0):
+        """
+        one transport request, recorded in self.metrics and traced when set
+        waited: seconds spent waiting for the rate limiter
+        """
+
+        if not self.instrumented():
+            return self.transport.request(method, the_uri, headers=headers, data=data, **options)
+
+        start = time.perf_counter()
+        response = self.transport.request(method, the_uri, headers=headers, data=data, **options)
+        self.record_request(method, the_uri, response, start, stream=bool(options), waited=waited)
+        return response
+
+    def get(self, the_uri):
+        """
+        the function that actually sends the request
+        and returns the data
+        answered from self.response_cache when one is set
+        """
+
+        if self.response_cache is None:
+            response = self.request("GET", the_uri)
+            return self.decode(response, the_uri)
+
+        key = self.response_cache.key(the_uri, self.headers)
+        entry, fresh = self.response_cache.lookup(key)
+        if fresh:
+            return self.loads(entry["body"])
+
+        response = self.request(
+            "GET", the_uri, headers=self.response_cache.conditional_headers(entry))
+        body = self.response_cache.store(key, the_uri, response, entry)
+        return self.decode(response, the_uri, body)
+
+    def stream_items(self, the_uri, key="response"):
+        """
+        GETs the_uri and yields the items of its key array one at a time,
+        decoded from the byte stream with JSONArrayStream
+        cached and non-200 responses are decoded whole, as in get
+        """
+
+        if self.response_cache is not None:
+            for item in self.get(the_uri)[key]:
+                yield item
+            return
+
+        response = self.request("GET", the_uri, stream=True)
+        try:
+            if response.status_code != 200:
+                items = self.decode(response, the_uri)[key]
+            else:
+                items = JSONArrayStream(response.iter_content(STREAM_CHUNK_SIZE), key)
+            for item in items:
+                yield item
+        finally:
+            response.close()
+
+    def put(self, the_uri, data):
+        """
+        the function that puts stuff in
+        """
+
+        self.invalidate_cache(the_uri)
+        self.note_product_write(the_uri, data)
+        response = self.request("PUT", the_uri, data=data)
+        return self.decode(response, the_uri)
+
+    def post(self, the_uri, data):
+        """
+        the function that posts stuff
+        """
+
+        self.invalidate_cache(the_uri)
+        self.note_product_write(the_uri, data)
+        response = self.request("POST", the_uri, data=data)
+        return self.decode(response, the_uri)
+
+    def note_product_write(self, the_uri, data):
+        """
+        keeps the negative cache honest when products are created or changed:
+        their SKU/EAN stop being rejected, and if the body cannot be read
+        the whole negative cache is dropped
+        """
+
+        if self.negative_cache is None or "product-service/product" not in the_uri:
+            return
+
+        try:
+            product = json.loads(data)
+            self.negative_cache.add_product(product)
+        except (TypeError, ValueError, AttributeError):
+            self.negative_cache.invalidate()
+
+    def invalidate_cache(self, the_uri=None):
+        """
+        drops cached GET responses for the resource the_uri belongs to,
+        i.e. a PUT to .../product-service/product/1001 drops every cached
+        .../product-service/product response; everything when the_uri is None
+        """
+
+        if self.response_cache is None:
+            return
+
+        if the_uri is None:
+            self.response_cache.invalidate()
+            return
+
+        resource = self.response_cache.resource(the_uri)
+        if resource is None:
+            self.response_cache.invalidate(the_uri)
+        else:
+            self.response_cache.invalidate(the_uri[:the_uri.index(resource) + len(resource)])
+
+
+    def options(self, the_uri):
+        """
+        options function
+        used to request custom uris for orders and contacts:
+        input range, output: range of uris for minimal number of
+        api calls
+        """
+
+        response = self.request("OPTIONS", the_uri)
+        return self.decode(response, the_uri)
+
+    @operation
+    def post_by_service(self, service, data):
+        """
+        shortcut method to post via different services
+        """
+
+        service_uri = "{0}{1}-service/{1}".format(self.uri, service)
+        return self.post(service_uri, data)
+
+    @operation
+    def post_goods_out(self, order, data):
+        """
+        shortcut to post a new goods out note
+        response is goods out note reference number
+        """
+
+        response = self.post(self.goods_out_note_uri(order), data)
+        return response['response'][0]
+
+    def goods_out_note_uri(self, order):
+
+        return "{}warehouse-service/order/{}/goods-note/goods-out".format(
+                self.uri, order
+                )
+
+
+    def fetch_all(self, uris, workers=None, prefetch=None):
+        """
+        Parameters
+        ----------
+        uris: iterable of uris to GET
+        workers: integer for the number of requests in flight at once
+            default: None (uses self.workers, serial if that is None too)
+            notes: keep pool_size >= workers so connections are reused
+        prefetch: integer for how many responses may be fetched ahead
+            of the one the caller is consuming
+            default: None (uses self.prefetch, or workers if that is None)
+            notes: bounds the buffer of finished but unconsumed responses
+
+        Returns
+        -------
+        generator of decoded responses, in the same order as uris
+        """
+
+        if workers is None:
+            workers = self.workers
+        if prefetch is None:
+            prefetch = self.prefetch
+        if prefetch is None:
+            prefetch = workers
+        if workers is None:
+            workers = prefetch
+
+        if not prefetch or not workers:
+            for each_uri in uris:
+                yield self.get(each_uri)
+            return
+
+        uris = iter(uris)
+        in_flight = deque()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            try:
+                # one more is submitted as each response is handed over,
+                # so prefetch stay in flight while the caller consumes
+                for each_uri in uris:
+                    in_flight.append(self.submit(executor, self.get, each_uri))
+                    if len(in_flight) >= prefetch:
+                        break
+
+                while in_flight:
+                    response_data = in_flight.popleft().result()
+                    for each_uri in uris:
+                        in_flight.append(self.submit(executor, self.get, each_uri))
+                        break
+                    yield response_data
+            finally:
+                for future in in_flight:
+                    future.cancel()
+
+    def submit(self, executor, function, *args):
+        """
+        executor.submit that carries the current operation and span over
+        to the worker thread, and notes how long the call was queued,
+        when metrics are recorded or traced
+        """
+
+        if not self.instrumented():
+            return executor.submit(function, *args)
+        return executor.submit(contextvars.copy_context().run,
+                self.run_queued, time.perf_counter(), function, *args)
+
+    def run_queued(self, submitted, function, *args):
+
+        QUEUE_WAIT.set(time.perf_counter() - submitted)
+        return function(*args)
+
+    def fetch_items(self, uris, workers=None, prefetch=None, incremental=None):
+        """
+        yields the items of the 'response' array of every uri, in order
+        incremental: boolean, decode each page item by item from the byte
+            stream with stream_items, one page at a time (workers and
+            prefetch are not used then)
+            default: None (uses self.incremental)
+        """
+
+        if incremental is None:
+            incremental = self.incremental
+
+        if incremental:
+            for each_uri in uris:
+                for item in self.stream_items(each_uri):
+                    yield item
+            return
+
+        for response_data in self.fetch_all(uris, workers=workers, prefetch=prefetch):
+            for item in response_data['response']:
+                yield item
+
+    def batch_uris(self, ids, uri_for, chunksize=MAX_IDS_PER_REQUEST,
+            max_length=MAX_ID_STRING_LENGTH):
+        """
+        Parameters
+        ----------
+        ids: iterable of ids in any order and with repeats,
+            or an id string such as "1-100,105"
+        uri_for: function returning the uri for one id string
+        chunksize, max_length: limits per chunk, see Tools.batch_ids
+
+        Returns
+        -------
+        list of uris, one per chunk of deduplicated, sorted ids
+        """
+
+        return [uri_for(chunk) for chunk in Tools.batch_ids(ids, chunksize, max_length)]
+
+    def get_batched(self, ids, uri_for, workers=None, prefetch=None, errors=None):
+        """
+        fetches the chunks of batch_uris concurrently (see fetch_all)
+        and returns their 'response' parts merged, see merge_responses
+        """
+
+        return self.merge_responses(self.fetch_all(
+            self.batch_uris(ids, uri_for), workers=workers, prefetch=prefetch), errors)
+
+    def merge_responses(self, responses, errors=None):
+        """
+        merges the 'response' part of chunked responses:
+        dictionaries (i.e. keyed by id) are updated, lists extended
+        errors: list the 'errors' of failed chunks are added to
+            default: None (raises ValueError with them instead)
+        """
+
+        merged = None
+        chunk_errors = list()
+        for response_data in responses:
+            chunk_errors.extend(response_data.get('errors', ()))
+            part = response_data.get('response')
+            if part is None:
+                continue
+            if merged is None:
+                merged = type(part)()
+            if isinstance(part, dict):
+                merged.update(part)
+            else:
+                merged.extend(part)
+
+        if errors is not None:
+            errors.extend(chunk_errors)
+        elif chunk_errors:
+            raise ValueError("Brightpearl returned errors: {}".format(chunk_errors))
+        return {} if merged is None else merged
+
+    def get_uris_by_service(self, service, reference_number, plan=None):
+        """
+        Builds the list of chunked uris for a range of ids.
+        reference_number: id string such as "1-100,105", or any iterable
+            of ids, which is always planned locally (see Tools.batch_ids)
+        plan: "options" asks brightpearl with an OPTIONS call,
+            "local" computes the chunks client side without a round-trip
+            default: None (uses self.plan)
+        """
+
+        if self.resolve_plan(plan) == "local" or not Tools.is_id_string(reference_number):
+            return self.local_uris_by_service(service, reference_number)
+        return self.get_options_uris_by_service(service, reference_number)
+
+    def resolve_plan(self, plan=None):
+        """
+        returns plan, or self.plan when None, raising ValueError for
+        anything other than "options" or "local"
+        """
+
+        plan = plan or self.plan
+        if plan not in PLANS:
+            raise ValueError("plan must be 'options' or 'local': {}".format(plan))
+        return plan
+
+    def local_uris_by_service(self, service, reference_number):
+        """
+        Same uris as get_options_uris_by_service, planned with
+        Tools.plan_request_ranges instead of an OPTIONS call.
+        """
+
+        return self.batch_uris(
+            reference_number, lambda request_range: self.options_uri(service, request_range))
+
+    def get_options_uris_by_service(self, service, reference_number):
+        """
+        Builds a list_of_uris when passed data and pre-defined service type.
+        Only needs service name and reference number(s) as string.
+        Plans are kept in self.plan_cache so repeated ranges skip the OPTIONS call.
+        """
+        list_of_uris = self.cached_plan(service, reference_number)
+        if list_of_uris is not None:
+            return list_of_uris
+
+        options_data = self.options(self.options_uri(service, reference_number))
+        list_of_uris = self.uris_from_options(service, options_data)
+        self.store_plan(service, reference_number, list_of_uris)
+        return list_of_uris
+
+    def plan_key(self, service, reference_number):
+        """
+        plans are full uris, so the key includes self.uri (datacentre, version
+        and account) to keep accounts sharing a cache_path apart
+        """
+
+        return "{}{}/{}".format(self.uri, service, reference_number)
+
+    def cached_plan(self, service, reference_number):
+
+        if self.plan_cache is None:
+            return None
+        list_of_uris = self.plan_cache.get(self.plan_key(service, reference_number))
+        if list_of_uris is None:
+            return None
+        return list(list_of_uris)
+
+    def store_plan(self, service, reference_number, list_of_uris):
+
+        if self.plan_cache is not None:
+            self.plan_cache.set(self.plan_key(service, reference_number), list(list_of_uris))
+
+    def options_uri(self, service, reference_number):
+
+        return "{}{}-service/{}/{}".format(
+            self.uri, ALL_SERVICES[service][0], ALL_SERVICES[service][1],
+            reference_number)
+
+    def uris_from_options(self, service, options_data):
+        """
+        turns the getUris segments of an OPTIONS response into full uris
+        """
+        # service uri also serves as stub for uri building
+        service_uri = "{}{}-service".format(self.uri, ALL_SERVICES[service][0])
+        response_data = options_data['response']['getUris']
+
+        list_of_uris = list()
+        for uri_segment in response_data:
+            list_of_uris.append("{}{}".format(service_uri, uri_segment))
+        return list_of_uris
+
+    @operation
+    def get_order_data(self, request_range, workers=None, plan=None, records=None):
+        """
+        request_range: string with order ids in the format "1-100" or "1,10"
+        workers: integer for concurrent chunk requests, see fetch_all
+        plan: "options" or "local", see get_uris_by_service
+        records: None for plain dictionaries, "eager" for Order records,
+            "lazy" for Order records that decode their nested sections
+            (rows, parties, ...) on first access
+        """
+
+        return list(self.iter_order_data(
+            request_range, workers=workers, plan=plan, records=records, incremental=False))
+
+    @operation
+    def iter_order_data(self, request_range, workers=None, prefetch=None, plan=None,
+            records=None, incremental=None):
+        """
+        generator version of get_order_data
+        yields orders one at a time as each chunk arrives,
+        while up to prefetch further chunks are fetched in the background
+        incremental: see fetch_items, default: None (uses self.incremental)
+        """
+
+        sales_uris = self.get_uris_by_service("order", request_range, plan=plan)
+
+        for each_order in self.fetch_items(
+                sales_uris, workers=workers, prefetch=prefetch, incremental=incremental):
+            yield self.to_record(Order, each_order, records)
+
+    @operation
+    def get_products_data(self, request_range, custom=False, workers=None, plan=None,
+            records=None):
+        """
+        request_range: string with product ids in the format "1-100" or "1,10"
+        custom: boolean, also fetch custom fields when True
+        workers: integer for concurrent chunk requests, see fetch_all
+        plan: "options" or "local", see get_uris_by_service
+        records: None, "eager" or "lazy" for Product records, see get_order_data
+        """
+
+        return list(self.iter_products_data(request_range, custom=custom, workers=workers,
+            plan=plan, records=records, incremental=False))
+
+    @operation
+    def iter_products_data(self, request_range, custom=False, workers=None, prefetch=None,
+            plan=None, records=None, incremental=None):
+        """
+        generator version of get_products_data
+        yields products one at a time as each chunk arrives
+        incremental: see fetch_items, default: None (uses self.incremental)
+        """
+
+        sales_uris = self.get_uris_by_service("products", request_range, plan=plan)
+
+        for each_product in self.fetch_items(self.products_uris(sales_uris, custom),
+                workers=workers, prefetch=prefetch, incremental=incremental):
+            yield self.to_record(Product, each_product, records)
+
+    @operation
+    def get_order_frame(self, request_range, workers=None, prefetch=None, plan=None):
+        """
+        columnar version of get_order_data, see OrderFrame
+        orders are turned into column entries as each chunk arrives
+        """
+
+        return OrderFrame.from_orders(self.iter_order_data(
+            request_range, workers=workers, prefetch=prefetch, plan=plan, incremental=False))
+
+    def to_record(self, record_class, data, records=None):
+        """
+        records: None returns data untouched, "eager" or "lazy"
+            builds a record_class, see get_order_data
+        """
+
+        if records is None:
+            return data
+        if records not in ("eager", "lazy"):
+            raise ValueError("records must be None, 'eager' or 'lazy': {}".format(records))
+        return record_class.from_json(data, lazy=records == "lazy")
+
+    def products_uris(self, sales_uris, custom=False):
+
+        if custom is True:
+            return [each_uri + "?includeOptional=customFields"
+                    for each_uri in sales_uris]
+        return sales_uris
+
+    @operation
+    def get_product_prices(self, request_range, price_list=None, plan=None):
+        """
+        Parameters
+        ----------
+        request_range: string with product ids in the format "1-100" or "1,10"
+        price_list: integer for price list code
+        plan: "options" or "local", see get_uris_by_service
+
+        Returns
+        -------
+        prices_data: dictionary of product ids and prices
+        """
+
+        prices_data = dict()
+        for product_id, prices in self.iter_product_prices(request_range, price_list, plan=plan):
+            prices_data.setdefault(product_id, {}).update(prices)
+        return prices_data
+
+    @operation
+    def get_price_matrix(self, request_range, price_list=None, workers=None, prefetch=None,
+            plan=None):
+        """
+        columnar version of get_product_prices, see PriceMatrix
+        the matrix is filled while the price pages stream in
+        """
+
+        return PriceMatrix.from_prices(self.iter_product_prices(
+            request_range, price_list, workers=workers, prefetch=prefetch, plan=plan))
+
+    @operation
+    def iter_product_prices(self, request_range, price_list=None, workers=None, prefetch=None,
+            plan=None):
+        """
+        generator version of get_product_prices
+        yields (product_id, {price_list_id: price}) as each chunk arrives
+        """
+
+        prices_uris = self.get_uris_by_service("prices", request_range, plan=plan)
+        prices_uris = self.price_list_uris(prices_uris, price_list)
+
+        for response_data in self.fetch_all(prices_uris, workers=workers, prefetch=prefetch):
+            for product_prices in self.parse_prices(response_data):
+                yield product_prices
+
+    def price_list_uris(self, prices_uris, price_list=None):
+
+        if price_list is None:
+            return prices_uris
+        return ["{}/price-list/{}".format(each_uri, price_list)
+                for each_uri in prices_uris]
+
+    def parse_prices(self, response_data):
+        """
+        yields (product_id, {price_list_id: price})
+        for each product in one product-price response
+        """
+
+        if 'errors' in response_data:
+            # return empty set if single item called with no prices
+            return
+
+        for each_product in response_data['response']:
+            prices = dict()
+            for each_price in each_product['priceLists']:
+                price_list_code = each_price.get("priceListId")
+                prices[price_list_code] = each_price.get("quantityPrice", {}).get("1")
+            yield each_product['productId'], prices
+
+    @operation
+    def get_product_suppliers(self, request_range="", plan=None, workers=None):
+        """
+        request_range: id string or iterable of product ids
+        returns the supplier ids of each product, merged over every chunk
+        raises ValueError when brightpearl returns errors for any chunk
+        """
+
+        suppliers_uri = self.get_uris_by_service("products", request_range, plan=plan)
+        suppliers_uri = [each_uri + "/supplier" for each_uri in suppliers_uri]
+        return self.merge_responses(self.fetch_all(suppliers_uri, workers=workers))
+
+    @operation
+    def get_goods_notes(self, orders, note_type="in"):
+        """
+        Parameter
+        ---------
+        orders: list of orders to get goods notes for
+        note_type: string for goods note type
+            "in": (default value) returns goods-in notes
+            "out": returns goods-out notes
+        """
+
+        return dict(self.iter_goods_notes(orders, note_type))
+
+    @operation
+    def iter_goods_notes(self, orders, note_type="in", workers=None, prefetch=None):
+        """
+        generator version of get_goods_notes
+        yields (goods_note_id, goods_note) as each chunk of orders arrives
+        """
+
+        for response in self.fetch_all(
+                self.goods_note_uris(orders, note_type), workers=workers, prefetch=prefetch):
+            for goods_note in response.get('response', {}).items():
+                yield goods_note
+
+    def goods_note_uris(self, orders, note_type="in"):
+        """
+        splits orders into chunks (see batch_uris) and returns one uri per chunk
+        """
+
+        return self.batch_uris(orders, lambda chunk:
+            "{}warehouse-service/order/{}/goods-note/goods-{}/".format(self.uri, chunk, note_type))
+
+    @operation
+    def lookup_service(self, service, **kwargs):
+        """
+        calls on the search functionality to lookup a product
+        and return all information including product ID
+        Will lookup sku by default
+        SKU/EAN lookups go through self.negative_cache when one is set
+        """
+        negative_key = self.negative_key(service, kwargs)
+        if negative_key is not None:
+            self.refresh_negative_cache()
+            if self.negative_cache.is_absent(*negative_key):
+                return []
+
+        response = self.get(self.lookup_uri(service, **kwargs))
+        data = self.parse_lookup(response, kwargs)
+
+        if negative_key is not None and data == []:
+            self.negative_cache.add_miss(*negative_key)
+        return data
+
+    def refresh_negative_cache(self):
+        """
+        adds the SKUs/EANs of products created since the negative cache was
+        seeded or last refreshed, see NegativeLookupCache.start_refresh
+        """
+
+        refresh = self.negative_cache.start_refresh()
+        if refresh is None:
+            return
+        created_since, started = refresh
+        for row in self.iter_search("product", columns=["SKU", "EAN"],
+                createdOn="{}/".format(created_since.isoformat(timespec="seconds"))):
+            for kind in ("SKU", "EAN"):
+                if row.get(kind):
+                    self.negative_cache.add_known(kind, row[kind])
+        self.negative_cache.finish_refresh(started)
+
+    def negative_key(self, service, kwargs):
+        """
+        (kind, code) for single SKU/EAN product lookups, otherwise None
+        """
+
+        if self.negative_cache is None or service != "product" or len(kwargs) != 1:
+            return None
+        kind, code = next(iter(kwargs.items()))
+        if kind not in ("SKU", "EAN"):
+            return None
+        return kind, str(code)
+
+    def lookup_uri(self, service, **kwargs):
+
+        return self.search_uri(service, **kwargs)
+
+    def parse_lookup(self, response, methods):
+        """
+        maps the first search result of a SKU/EAN lookup onto a dictionary,
+        other lookups return all result rows
+        """
+
+        if response['response']['results'] != []:
+
+            line_items = response['response']['results'][0]
+
+            if "SKU" in methods or "EAN" in methods:
+                return self.product_summary(
+                    line_items, self.search_columns(response['response']))
+        else:
+            return []
+
+        return response['response']['results']
+
+    def product_summary(self, line_items, columns=None):
+        """
+        maps a product-search row onto the dictionary SKU/EAN lookups return
+        columns: list of column names from the search metaData,
+            without them the default product-search column order is assumed
+        """
+
+        data = dict()
+        for key, column, index in PRODUCT_SUMMARY_COLUMNS:
+            if not columns:
+                data[key] = line_items[index]
+            elif column in columns:
+                data[key] = line_items[columns.index(column)]
+            else:
+                data[key] = None
+        return data
+
+    def search_uri(self, service, **kwargs):
+        """
+        builds a <service>-search uri with url encoded filters
+        """
+
+        the_uri = '{0}{1}-service/{1}-search'.format(self.uri, service)
+        if not kwargs:
+            return the_uri
+        return '{}?{}'.format(the_uri, urlencode(kwargs))
+
+    def search_columns(self, page):
+        """
+        returns the column names of a search result page from its metaData
+        """
+
+        return [column.get('name') for column in page.get('metaData', {}).get('columns', [])]
+
+    @operation
+    def iter_search_pages(self, service, page_size=DEFAULT_SEARCH_PAGE_SIZE, workers=None,
+            prefetch=None, **kwargs):
+        """
+        Parameters
+        ----------
+        service: string for the search service, i.e. "order" or "product"
+        page_size: integer for the rows per page, brightpearl allows 500
+        workers, prefetch: concurrency for the remaining pages, see fetch_all
+        kwargs: search filters, i.e. updatedOn="2020-01-01T00:00:00/"
+
+        Returns
+        -------
+        generator of the 'response' part of each result page, in order
+        once the first page reports resultsAvailable the remaining pages
+        are fetched concurrently, otherwise lastResult is followed page by page
+        """
+
+        first_result = 1
+        while True:
+            response = self.get(self.search_uri(
+                service, pageSize=page_size, firstResult=first_result, **kwargs))
+            page = response['response']
+            yield page
+
+            meta_data = page.get('metaData', {})
+            if not meta_data.get('morePagesAvailable') or not page.get('results'):
+                return
+            first_result = meta_data['lastResult'] + 1
+
+            results_available = meta_data.get('resultsAvailable')
+            if results_available is not None:
+                break
+
+        page_uris = [
+            self.search_uri(service, pageSize=page_size, firstResult=each_first, **kwargs)
+            for each_first in range(first_result, results_available + 1, page_size)
+            ]
+        for response in self.fetch_all(page_uris, workers=workers, prefetch=prefetch):
+            yield response['response']
+
+    @operation
+    def iter_search(self, service, columns=None, page_size=DEFAULT_SEARCH_PAGE_SIZE,
+            workers=None, prefetch=None, rows="dict", **kwargs):
+        """
+        Parameters
+        ----------
+        service: string for the search service, i.e. "order" or "product"
+        columns: list of column names to request, i.e. ["productId", "SKU"]
+            default: None (every column brightpearl returns)
+        page_size, workers, prefetch: see iter_search_pages
+        rows: "dict" for dictionaries, "tuple" for namedtuples
+            (much smaller for large result sets)
+        kwargs: search filters, i.e. productGroupId=5
+
+        Returns
+        -------
+        generator of every result row of every page, keyed by
+        the column names in the page's metaData
+        """
+
+        if columns:
+            kwargs['columns'] = ",".join(columns)
+
+        for page in self.iter_search_pages(
+                service, page_size=page_size, workers=workers, prefetch=prefetch, **kwargs):
+            names = self.search_columns(page)
+            if rows == "tuple":
+                row_type = Tools.row_type(names)
+                for row in page['results']:
+                    yield row_type._make(row)
+            else:
+                for row in page['results']:
+                    yield dict(zip(names, row))
+
+
+    @operation
+    def sku_lookup(self, sku_number):
+        if self.product_mirror is not None:
+            product = self.product_mirror.lookup_sku(sku_number)
+            if product is not None:
+                return product
+        return self.lookup_service("product", SKU=sku_number)
+
+    @operation
+    def ean_lookup(self, ean_number):
+        if self.product_mirror is not None:
+            product = self.product_mirror.lookup_ean(ean_number)
+            if product is not None:
+                return product
+        return self.lookup_service("product", EAN=ean_number)
+
+    @operation
+    def order_lookup(self, kwargs):
+        return self.lookup_service("order", **kwargs)
+
+    @operation
+    def product_lookup(self, kwargs):
+        return self.lookup_service("product", **kwargs)
+
+    @operation
+    def get_stock_levels(self, request_range, workers=None):
+        """
+        returns stock levels for products
+        comma separated or range, or any iterable of product ids
+        large requests are split into chunks, see batch_uris
+        the 'errors' of failed chunks are returned next to 'response'
+        """
+
+        errors = list()
+        stock_levels = {"response": self.get_batched(
+            request_range, self.stock_levels_uri, workers=workers, errors=errors)}
+        if errors:
+            stock_levels["errors"] = errors
+        return stock_levels
+
+    def stock_levels_uri(self, request_range):
+
+        return "{}warehouse-service/product-availability/{}".format(self.uri, request_range)
+
+
+class AsyncResponse(object):
+
+    """
+    the parts of an http response that AsyncAPI uses,
+    with the body already read so the connection can return to the pool
+    """
+
+    def __init__(self, status_code, headers, content):
+
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+
+class AsyncTransport(object):
+
+    """
+    asyncio counterpart of Transport built on an aiohttp ClientSession
+    the session is created on first use so it binds to the running loop
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=None):
+        """
+        Parameters
+        ----------
+        pool_size: integer for the max number of connections per host
+            default: DEFAULT_POOL_SIZE
+        timeout: float (seconds) or (connect, read) tuple
+            default: None (wait forever)
+        """
+
+        if aiohttp is None:
+            raise ImportError("AsyncTransport requires aiohttp to be installed")
+
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.session = None
+
+    def get_session(self):
+
+        if self.session is None:
+            if isinstance(self.timeout, tuple):
+                timeout = aiohttp.ClientTimeout(
+                    sock_connect=self.timeout[0], sock_read=self.timeout[1])
+            else:
+                timeout = aiohttp.ClientTimeout(total=self.timeout)
+            connector = aiohttp.TCPConnector(limit_per_host=self.pool_size)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self.session
+
+    async def request(self, method, the_uri, headers=None, data=None):
+        """
+        sends a single request and returns an AsyncResponse
+        """
+
+        session = self.get_session()
+        async with session.request(method, the_uri, headers=headers, data=data) as response:
+            content = await response.read()
+            return AsyncResponse(response.status, response.headers, content)
+
+    async def close(self):
+
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+class AsyncAPI(API):
+
+    """
+    asyncio version of API
+    builds the same uris and parses responses the same way,
+    but every method that talks to brightpearl is a coroutine
+    and chunked requests are fanned out with asyncio.gather
+    """
+
+    def __init__(self, config, transport=None):
+        """
+        config: same dictionary as API, 'workers' caps the number
+            of requests in flight at once (default: pool_size);
+            'record_path' and 'replay_path' are not supported
+        transport: object with coroutine request() and close() methods,
+            replaces the default AsyncTransport when given
+        """
+
+        for key in ('record_path', 'replay_path'):
+            if config.get(key):
+                raise ValueError("{} is only supported by the synchronous API".format(key))
+
+        pool_size = config.get('pool_size', DEFAULT_POOL_SIZE)
+        if transport is None:
+            transport = AsyncTransport(pool_size=pool_size, timeout=config.get('timeout'))
+
+        API.__init__(self, config, transport=transport)
+        self.transport_limit = self.workers or pool_size
+        self.semaphore = asyncio.Semaphore(self.transport_limit)
+
+    async def close(self):
+
+        await self.transport.close()
+
+    def __enter__(self):
+        raise TypeError("AsyncAPI closes its session asynchronously, use 'async with'")
+
+    def __exit__(self, *exc_info):
+        raise TypeError("AsyncAPI closes its session asynchronously, use 'async with'")
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    @operation
+    async def get_brightpearl_staff_token(self, username, password):
+
+        authentication_data = self.staff_authentication_data(username, password)
+
+        async with self.semaphore:
+            start = time.perf_counter()
+            response = await self.transport.request(
+                "POST", self.authentication_uri,
+                headers=self.staff_authentication_headers, data=authentication_data
+                )
+        if self.instrumented():
+            self.record_request("POST", self.authentication_uri, response, start)
+
+        self.set_staff_token(self.decode(response, self.authentication_uri))
+
+    async def request(self, method, the_uri, data=None, headers=None):
+
+        if headers:
+            headers = dict(self.headers, **headers)
+        else:
+            headers = self.headers
+
+        attempt = 0
+        wait_start = time.perf_counter()
+        while True:
+            if self.rate_limiter is not None:
+                wait = self.rate_limiter.reserve_token()
+                while wait > 0:
+                    await asyncio.sleep(wait)
+                    wait = self.rate_limiter.reserve_token()
+
+            async with self.semaphore:
+                start = time.perf_counter()
+                response = await self.transport.request(
+                    method, the_uri, headers=headers, data=data)
+            if self.instrumented():
+                self.record_request(method, the_uri, response, start, waited=start - wait_start)
+
+            if self.rate_limiter is None:
+                return response
+
+            self.rate_limiter.update(response.headers)
+            if response.status_code != THROTTLED_STATUS or attempt >= self.max_retries:
+                return response
+
+            self.finish_request(response)
+            wait_start = time.perf_counter()
+            await asyncio.sleep(self.rate_limiter.throttle_delay(response.headers, attempt))
+            attempt += 1
+
+    async def get(self, the_uri):
+
+        if self.response_cache is None:
+            response = await self.request("GET", the_uri)
+            return self.decode(response, the_uri)
+
+        key = self.response_cache.key(the_uri, self.headers)
+        entry, fresh = self.response_cache.lookup(key)
+        if fresh:
+            return self.loads(entry["body"])
+
+        response = await self.request(
+            "GET", the_uri, headers=self.response_cache.conditional_headers(entry))
+        body = self.response_cache.store(key, the_uri, response, entry)
+        return self.decode(response, the_uri, body)
+
+    async def put(self, the_uri, data):
+
+        self.invalidate_cache(the_uri)
+        self.note_product_write(the_uri, data)
+        response = await self.request("PUT", the_uri, data=data)
+        return self.decode(response, the_uri)
+
+    async def post(self, the_uri, data):
+
+        self.invalidate_cache(the_uri)
+        self.note_product_write(the_uri, data)
+        response = await self.request("POST", the_uri, data=data)
+        return self.decode(response, the_uri)
+
+    async def options(self, the_uri):
+
+        response = await self.request("OPTIONS", the_uri)
+        return self.decode(response, the_uri)
+
+    @operation
+    async def post_by_service(self, service, data):
+
+        service_uri = "{0}{1}-service/{1}".format(self.uri, service)
+        return await self.post(service_uri, data)
+
+    @operation
+    async def post_goods_out(self, order, data):
+
+        response = await self.post(self.goods_out_note_uri(order), data)
+        return response['response'][0]
+
+    async def fetch_all(self, uris, workers=None):
+        """
+        Parameters
+        ----------
+        uris: iterable of uris to GET
+        workers: integer for the number of these requests in flight at once
+            default: None (only limited by self.semaphore)
+
+        Returns
+        -------
+        list of decoded responses, in the same order as uris
+        """
+
+        if workers is None:
+            return await asyncio.gather(*[self.get(each_uri) for each_uri in uris])
+
+        limit = asyncio.Semaphore(workers)
+
+        async def limited_get(each_uri):
+            async with limit:
+                return await self.get(each_uri)
+
+        return await asyncio.gather(*[limited_get(each_uri) for each_uri in uris])
+
+    async def fetch_iter(self, uris, workers=None, prefetch=None):
+        """
+        async generator version of fetch_all
+        yields each decoded response in order, keeping up to prefetch
+        requests running ahead of the one being consumed
+        """
+
+        if prefetch is None:
+            prefetch = self.prefetch
+        if prefetch is None:
+            prefetch = workers or self.workers or self.transport_limit
+
+        uris = iter(uris)
+        tasks = deque()
+        try:
+            for each_uri in uris:
+                tasks.append(asyncio.ensure_future(self.get(each_uri)))
+                if len(tasks) >= prefetch:
+                    break
+
+            while tasks:
+                response_data = await tasks.popleft()
+                for each_uri in uris:
+                    tasks.append(asyncio.ensure_future(self.get(each_uri)))
+                    break
+                yield response_data
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def get_uris_by_service(self, service, reference_number, plan=None):
+
+        if self.resolve_plan(plan) == "local" or not Tools.is_id_string(reference_number):
+            return self.local_uris_by_service(service, reference_number)
+        return await self.get_options_uris_by_service(service, reference_number)
+
+    async def get_options_uris_by_service(self, service, reference_number):
+
+        list_of_uris = self.cached_plan(service, reference_number)
+        if list_of_uris is not None:
+            return list_of_uris
+
+        options_data = await self.options(self.options_uri(service, reference_number))
+        list_of_uris = self.uris_from_options(service, options_data)
+        self.store_plan(service, reference_number, list_of_uris)
+        return list_of_uris
+
+    @operation
+    async def get_order_data(self, request_range, workers=None, plan=None, records=None):
+
+        sales_uris = await self.get_uris_by_service("order", request_range, plan=plan)
+
+        orders_data = list()
+        for response_data in await self.fetch_all(sales_uris, workers=workers):
+            orders_data.extend(self.to_record(Order, each_order, records)
+                    for each_order in response_data['response'])
+        return orders_data
+
+    @operation
+    async def iter_order_data(self, request_range, workers=None, prefetch=None, plan=None,
+            records=None):
+
+        sales_uris = await self.get_uris_by_service("order", request_range, plan=plan)
+
+        async for response_data in self.fetch_iter(sales_uris, workers=workers, prefetch=prefetch):
+            for each_order in response_data['response']:
+                yield self.to_record(Order, each_order, records)
+
+    @operation
+    async def get_order_frame(self, request_range, workers=None, prefetch=None, plan=None):
+
+        builder = OrderFrameBuilder()
+        async for order in self.iter_order_data(
+                request_range, workers=workers, prefetch=prefetch, plan=plan):
+            builder.append(order)
+        return builder.finish()
+
+    @operation
+    async def get_products_data(self, request_range, custom=False, workers=None, plan=None,
+            records=None):
+
+        sales_uris = await self.get_uris_by_service("products", request_range, plan=plan)
+
+        products_data = list()
+        for response_data in await self.fetch_all(self.products_uris(sales_uris, custom), workers=workers):
+            products_data.extend(self.to_record(Product, each_product, records)
+                    for each_product in response_data['response'])
+        return products_data
+
+    @operation
+    async def iter_products_data(self, request_range, custom=False, workers=None, prefetch=None,
+            plan=None, records=None):
+
+        sales_uris = await self.get_uris_by_service("products", request_range, plan=plan)
+
+        async for response_data in self.fetch_iter(self.products_uris(sales_uris, custom), workers=workers, prefetch=prefetch):
+            for each_product in response_data['response']:
+                yield self.to_record(Product, each_product, records)
+
+    @operation
+    async def get_product_prices(self, request_range, price_list=None, plan=None):
+
+        prices_data = dict()
+        async for product_id, prices in self.iter_product_prices(request_range, price_list, plan=plan):
+            prices_data.setdefault(product_id, {}).update(prices)
+        return prices_data
+
+    @operation
+    async def get_price_matrix(self, request_range, price_list=None, workers=None, prefetch=None,
+            plan=None):
+
+        builder = PriceMatrixBuilder()
+        async for product_id, prices in self.iter_product_prices(
+                request_range, price_list, workers=workers, prefetch=prefetch, plan=plan):
+            builder.append(product_id, prices)
+        return builder.finish()
+
+    @operation
+    async def iter_product_prices(self, request_range, price_list=None, workers=None, prefetch=None,
+            plan=None):
+
+        prices_uris = await self.get_uris_by_service("prices", request_range, plan=plan)
+        prices_uris = self.price_list_uris(prices_uris, price_list)
+
+        async for response_data in self.fetch_iter(prices_uris, workers=workers, prefetch=prefetch):
+            for product_prices in self.parse_prices(response_data):
+                yield product_prices
+
+    @operation
+    async def get_product_suppliers(self, request_range="", plan=None, workers=None):
+
+        suppliers_uri = await self.get_uris_by_service("products", request_range, plan=plan)
+        suppliers_uri = [each_uri + "/supplier" for each_uri in suppliers_uri]
+        return self.merge_responses(await self.fetch_all(suppliers_uri, workers=workers))
+
+    @operation
+    async def get_goods_notes(self, orders, note_type="in"):
+
+        # chunks without goods notes are skipped, as in API.iter_goods_notes
+        return self.merge_responses(
+            await self.fetch_all(self.goods_note_uris(orders, note_type)), errors=list())
+
+    @operation
+    async def iter_goods_notes(self, orders, note_type="in", workers=None, prefetch=None):
+
+        async for response in self.fetch_iter(self.goods_note_uris(orders, note_type), workers=workers, prefetch=prefetch):
+            for goods_note in response.get('response', {}).items():
+                yield goods_note
+
+    @operation
+    async def lookup_service(self, service, **kwargs):
+
+        negative_key = self.negative_key(service, kwargs)
+        if negative_key is not None:
+            await self.refresh_negative_cache()
+            if self.negative_cache.is_absent(*negative_key):
+                return []
+
+        response = await self.get(self.lookup_uri(service, **kwargs))
+        data = self.parse_lookup(response, kwargs)
+
+        if negative_key is not None and data == []:
+            self.negative_cache.add_miss(*negative_key)
+        return data
+
+    async def refresh_negative_cache(self):
+
+        refresh = self.negative_cache.start_refresh()
+        if refresh is None:
+            return
+        created_since, started = refresh
+        async for row in self.iter_search("product", columns=["SKU", "EAN"],
+                createdOn="{}/".format(created_since.isoformat(timespec="seconds"))):
+            for kind in ("SKU", "EAN"):
+                if row.get(kind):
+                    self.negative_cache.add_known(kind, row[kind])
+        self.negative_cache.finish_refresh(started)
+
+    @operation
+    async def iter_search_pages(self, service, page_size=DEFAULT_SEARCH_PAGE_SIZE, workers=None,
+            prefetch=None, **kwargs):
+
+        first_result = 1
+        while True:
+            response = await self.get(self.search_uri(
+                service, pageSize=page_size, firstResult=first_result, **kwargs))
+            page = response['response']
+            yield page
+
+            meta_data = page.get('metaData', {})
+            if not meta_data.get('morePagesAvailable') or not page.get('results'):
+                return
+            first_result = meta_data['lastResult'] + 1
+
+            results_available = meta_data.get('resultsAvailable')
+            if results_available is not None:
+                break
+
+        page_uris = [
+            self.search_uri(service, pageSize=page_size, firstResult=each_first, **kwargs)
+            for each_first in range(first_result, results_available + 1, page_size)
+            ]
+        async for response in self.fetch_iter(page_uris, workers=workers, prefetch=prefetch):
+            yield response['response']
+
+    @operation
+    async def iter_search(self, service, columns=None, page_size=DEFAULT_SEARCH_PAGE_SIZE,
+            workers=None, prefetch=None, rows="dict", **kwargs):
+
+        if columns:
+            kwargs['columns'] = ",".join(columns)
+
+        async for page in self.iter_search_pages(
+                service, page_size=page_size, workers=workers, prefetch=prefetch, **kwargs):
+            names = self.search_columns(page)
+            if rows == "tuple":
+                row_type = Tools.row_type(names)
+                for row in page['results']:
+                    yield row_type._make(row)
+            else:
+                for row in page['results']:
+                    yield dict(zip(names, row))
+
+    @operation
+    async def sku_lookup(self, sku_number):
+        if self.product_mirror is not None:
+            product = self.product_mirror.lookup_sku(sku_number)
+            if product is not None:
+                return product
+        return await self.lookup_service("product", SKU=sku_number)
+
+    @operation
+    async def ean_lookup(self, ean_number):
+        if self.product_mirror is not None:
+            product = self.product_mirror.lookup_ean(ean_number)
+            if product is not None:
+                return product
+        return await self.lookup_service("product", EAN=ean_number)
+
+    @operation
+    async def get_stock_levels(self, request_range, workers=None):
+
+        errors = list()
+        stock_levels = {"response": await self.get_batched(
+            request_range, self.stock_levels_uri, workers=workers, errors=errors)}
+        if errors:
+            stock_levels["errors"] = errors
+        return stock_levels
+
+    async def get_batched(self, ids, uri_for, workers=None, errors=None):
+
+        return self.merge_responses(
+            await self.fetch_all(self.batch_uris(ids, uri_for), workers=workers), errors)
+
+
+class OrderStore(object):
+
+    """
+    local copy of brightpearl orders in a SQLite database
+    orders are stored as json keyed by order id, next to the
+    watermarks OrderSync uses to pick up where it left off
+    """
+
+    def __init__(self, path):
+        """
+        path: string for the database file, ":memory:" for a throwaway store
+        """
+
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS orders ("
+                "id INTEGER PRIMARY KEY, updated_on TEXT, data TEXT NOT NULL)")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS sync_state ("
+                "name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def upsert(self, orders):
+        """
+        inserts new orders and replaces existing ones
+
+        Returns
+        -------
+        integer for the number of orders written
+        """
+
+        rows = [(order['id'], order.get('updatedOn'), json.dumps(order))
+                for order in orders]
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO orders (id, updated_on, data) VALUES (?, ?, ?)", rows)
+        return len(rows)
+
+    def get(self, order_id):
+
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT data FROM orders WHERE id = ?", (order_id,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+
+    def get_watermark(self, name="orders"):
+
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM sync_state WHERE name = ?", (name,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_watermark(self, value, name="orders"):
+
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO sync_state (name, value) VALUES (?, ?)", (name, value))
+
+    def close(self):
+
+        self.connection.close()
+
+
+class OrderSync(object):
+
+    """
+    keeps an OrderStore up to date with brightpearl
+    each run asks order-search for the orders updated since the stored
+    watermark, fetches only those through the chunked order GET path
+    and upserts them, then moves the watermark forward
+    """
+
+    def __init__(self, api, store, page_size=DEFAULT_SEARCH_PAGE_SIZE, workers=None,
+            overlap=timedelta(minutes=5), clock=None):
+        """
+        Parameters
+        ----------
+        api: API instance used for the search and order calls
+        store: OrderStore (or any object with upsert/get_watermark/set_watermark)
+        page_size: integer for order-search rows per page
+        workers: integer for concurrent order chunk requests
+        overlap: timedelta subtracted from each watermark to cover clock
+            skew and orders still being written, overlapping orders are
+            simply upserted again
+        clock: function returning an aware utc datetime, replaceable for testing
+        """
+
+        self.api = api
+        self.store = store
+        self.page_size = page_size
+        self.workers = workers
+        self.overlap = overlap
+        self.clock = clock or (lambda: datetime.now(timezone.utc))
+
+    def changed_order_ids(self, since=None):
+        """
+        returns the sorted ids of orders updated since the given
+        iso timestamp, or of all orders when since is None
+        """
+
+        filters = dict()
+        if since is not None:
+            filters['updatedOn'] = "{}/".format(since)
+
+        order_ids = set()
+        for row in self.api.iter_search("order", columns=["orderId"], page_size=self.page_size,
+                workers=self.workers, **filters):
+            order_ids.add(row['orderId'])
+        return sorted(order_ids)
+
+    def run(self):
+        """
+        syncs every order changed since the last run
+
+        Returns
+        -------
+        integer for the number of orders upserted
+        """
+
+        started = self.clock() - self.overlap
+        order_ids = self.changed_order_ids(self.store.get_watermark())
+
+        synced = 0
+        if order_ids:
+            request_range = Tools.searchstringifier(order_ids)
+            batch = list()
+            for order in self.api.iter_order_data(
+                    request_range, workers=self.workers, plan="local"):
+                batch.append(order)
+                if len(batch) >= MAX_IDS_PER_REQUEST:
+                    synced += self.store.upsert(batch)
+                    batch = list()
+            if batch:
+                synced += self.store.upsert(batch)
+
+        self.store.set_watermark(started.isoformat(timespec="seconds"))
+        return synced
+
+
+class ProductMirror(object):
+
+    """
+    local copy of the product catalogue in a SQLite database
+    indexed on SKU, EAN, product id and product group so that
+    API.sku_lookup / ean_lookup can be answered without a product-search
+    """
+
+    def __init__(self, path):
+        """
+        path: string for the database file, ":memory:" for a throwaway mirror
+        """
+
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS products ("
+                "id INTEGER PRIMARY KEY, sku TEXT, ean TEXT, name TEXT, "
+                "stock_tracked INTEGER, category_code TEXT, product_group_id INTEGER, "
+                "data TEXT NOT NULL)")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS prices ("
+                "product_id INTEGER NOT NULL, price_list_id INTEGER NOT NULL, price TEXT, "
+                "PRIMARY KEY (product_id, price_list_id))")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS products_sku ON products (sku)")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS products_ean ON products (ean)")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS products_group ON products (product_group_id)")
+
+    def build(self, api, request_range, price_list=None, workers=None, plan=None):
+        """
+        Parameters
+        ----------
+        api: API instance to read the catalogue from
+        request_range: string with product ids in the format "1-100" or "1,10"
+        price_list: integer for a single price list, None for all of them
+        workers: integer for concurrent chunk requests
+
+        Returns
+        -------
+        integer for the number of products written
+        """
+
+        written = 0
+        batch = list()
+        for product in api.iter_products_data(request_range, workers=workers, plan=plan):
+            batch.append(product)
+            if len(batch) >= MAX_IDS_PER_REQUEST:
+                written += self.upsert_products(batch)
+                batch = list()
+        if batch:
+            written += self.upsert_products(batch)
+
+        self.upsert_prices(api.iter_product_prices(
+            request_range, price_list, workers=workers, plan=plan))
+        return written
+
+    def product_row(self, product):
+        """
+        pulls the indexed columns out of a product-service product
+        """
+
+        identity = product.get('identity', {})
+        sales_channels = product.get('salesChannels') or [{}]
+        categories = sales_channels[0].get('categories') or [{}]
+        return (
+            product['id'],
+            identity.get('sku'),
+            identity.get('ean'),
+            sales_channels[0].get('productName'),
+            product.get('stock', {}).get('stockTracked'),
+            categories[0].get('categoryCode'),
+            product.get('productGroupId'),
+            json.dumps(product),
+            )
+
+    def upsert_products(self, products):
+
+        rows = [self.product_row(product) for product in products]
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO products VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def upsert_prices(self, product_prices, batch_size=MAX_IDS_PER_REQUEST):
+        """
+        product_prices: iterable of (product_id, {price_list_id: price}),
+            as yielded by API.iter_product_prices
+        batch_size: integer for the products written per transaction,
+            so the iterable is consumed without keeping every price around
+        """
+
+        written = 0
+        for batch in Tools.chunked(product_prices, batch_size):
+            rows = [(product_id, price_list_id, price)
+                    for product_id, prices in batch
+                    for price_list_id, price in prices.items()]
+            with self.lock, self.connection:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO prices VALUES (?, ?, ?)", rows)
+            written += len(rows)
+        return written
+
+    def lookup(self, column, value):
+        """
+        same dictionary as API.lookup_service returns for SKU/EAN lookups,
+        or None when the mirror does not know the product
+        """
+
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT id, name, sku, ean, stock_tracked, category_code, product_group_id "
+                "FROM products WHERE {} = ? LIMIT 1".format(column), (value,)).fetchone()
+        if row is None:
+            return None
+
+        stock_tracked = row[4] if row[4] is None else bool(row[4])
+        return {
+            'product_id': row[0],
+            'product_name': row[1],
+            'sku': row[2],
+            'EAN': row[3],
+            'stock_tracked': stock_tracked,
+            'category_code': row[5],
+            'product_group_id': row[6],
+            }
+
+    def lookup_sku(self, sku):
+        return self.lookup("sku", str(sku))
+
+    def lookup_ean(self, ean):
+        return self.lookup("ean", str(ean))
+
+    def get_product(self, product_id):
+        """
+        returns the full product as fetched from brightpearl
+        """
+
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT data FROM products WHERE id = ?", (product_id,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def product_group(self, product_group_id):
+        """
+        returns the ids of all products in a product group
+        """
+
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id FROM products WHERE product_group_id = ? ORDER BY id",
+                (product_group_id,)).fetchall()
+        return [row[0] for row in rows]
+
+    def get_prices(self, product_id):
+        """
+        returns {price_list_id: price} like one entry of API.get_product_prices
+        """
+
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT price_list_id, price FROM prices WHERE product_id = ?",
+                (product_id,)).fetchall()
+        return dict(rows)
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+
+    def close(self):
+
+        self.connection.close()
+
+
+class ProductResolver(object):
+
+    """
+    batches product lookups coming from many threads, dataloader style
+    calls arriving within a short window are collected, repeated keys
+    are deduplicated (also against lookups already in flight), and each
+    batch is resolved with as few requests as possible:
+    product ids share paged product-search calls on a productId id set,
+    SKUs and EANs (which product-search only matches one at a time)
+    are looked up concurrently through API.sku_lookup / ean_lookup
+    """
+
+    def __init__(self, api, window=DEFAULT_RESOLVER_WINDOW, workers=None,
+            timeout=None):
+        """
+        Parameters
+        ----------
+        api: API instance to resolve through
+        window: float for seconds to wait for more calls before a batch is sent
+        workers: integer for concurrent SKU/EAN lookups
+            default: None (api.workers, or DEFAULT_POOL_SIZE)
+        timeout: float for seconds a caller waits for its result
+        """
+
+        self.api = api
+        self.window = window
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers or api.workers or DEFAULT_POOL_SIZE)
+
+        self.pending = {"sku": dict(), "ean": dict(), "product_id": dict()}
+        self.in_flight = {"sku": dict(), "ean": dict(), "product_id": dict()}
+        self.timer = None
+        self.lock = threading.Lock()
+        self.batches = 0
+
+    def load(self, kind, key):
+        """
+        Returns
+        -------
+        Future resolving to the lookup result for key
+        """
+
+        with self.lock:
+            future = self.pending[kind].get(key) or self.in_flight[kind].get(key)
+            if future is not None:
+                return future
+
+            future = Future()
+            self.pending[kind][key] = future
+            if self.timer is None:
+                self.timer = threading.Timer(self.window, self.dispatch)
+                self.timer.daemon = True
+                self.timer.start()
+            return future
+
+    def load_many(self, kind, keys):
+
+        futures = [self.load(kind, key) for key in keys]
+        return [future.result(self.timeout) for future in futures]
+
+    def sku_lookup(self, sku_number):
+        return self.load("sku", str(sku_number)).result(self.timeout)
+
+    def ean_lookup(self, ean_number):
+        return self.load("ean", str(ean_number)).result(self.timeout)
+
+    def product_lookup(self, product_id):
+        return self.load("product_id", int(product_id)).result(self.timeout)
+
+    def dispatch(self):
+        """
+        sends everything collected in the window
+        """
+
+        with self.lock:
+            self.timer = None
+            batch = self.pending
+            self.pending = {kind: dict() for kind in batch}
+            for kind, futures in batch.items():
+                self.in_flight[kind].update(futures)
+
+        for kind, futures in batch.items():
+            if not futures:
+                continue
+            self.batches += 1
+            try:
+                if kind == "product_id":
+                    results = self.resolve_product_ids(list(futures))
+                else:
+                    lookup = self.api.sku_lookup if kind == "sku" else self.api.ean_lookup
+                    results = dict(zip(futures, self.executor.map(lookup, futures)))
+            except Exception as error:
+                for future in futures.values():
+                    future.set_exception(error)
+            else:
+                for key, future in futures.items():
+                    future.set_result(results.get(key, []))
+            finally:
+                with self.lock:
+                    for key in futures:
+                        self.in_flight[kind].pop(key, None)
+
+    def resolve_product_ids(self, product_ids):
+        """
+        one paged product-search per id set chunk instead of one per id
+        """
+
+        results = dict()
+        id_string = Tools.searchstringifier(sorted(product_ids))
+        for request_range in Tools.plan_request_ranges(id_string):
+            for page in self.api.iter_search_pages("product", productId=request_range):
+                columns = self.api.search_columns(page)
+                for row in page['results']:
+                    product = self.api.product_summary(row, columns)
+                    results[product['product_id']] = product
+        return results
+
+    def close(self):
+
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+        self.dispatch()
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Tools(object):
+
+    @staticmethod
+    def list_of_request_ranges(request_range, chunksize=MAX_IDS_PER_REQUEST):
+        """
+        Used when OPTIONS cannot be requested.
+        Splits request range into 200 item chunks for use within
+        brightpearl request limit.
+        """
+
+        return list(Tools.iter_request_ranges(request_range, chunksize))
+
+    @staticmethod
+    def iter_request_ranges(request_range, chunksize=MAX_IDS_PER_REQUEST):
+        """
+        generator version of list_of_request_ranges
+        """
+
+        request_numbers = str(request_range).split("-")
+
+        #for single item requests
+        if len(request_numbers) == 1:
+            yield str(request_range)
+            return
+
+        begin = int(request_numbers[0])
+        end = int(request_numbers[1])
+
+        while begin <= end:
+            last = min(begin + chunksize - 1, end)
+            if begin == last:
+                yield str(begin)
+            else:
+                yield "%d-%d" % (begin, last)
+            begin = last + 1
+
+    row_types = dict()
+
+    @staticmethod
+    def row_type(columns):
+        """
+        returns a namedtuple class for a list of search column names,
+        built once per distinct set of columns
+        """
+
+        columns = tuple(columns)
+        row_type = Tools.row_types.get(columns)
+        if row_type is None:
+            row_type = namedtuple("SearchRow", columns, rename=True)
+            Tools.row_types[columns] = row_type
+        return row_type
+
+    @staticmethod
+    def is_id_string(request_range):
+        """
+        True for an id string such as "1-100,105" (or a single integer id),
+        False for other iterables of ids
+        """
+
+        return isinstance(request_range, (str, int))
+
+    @staticmethod
+    def id_runs(ids):
+        """
+        Parameters
+        ----------
+        ids: iterable of integer ids (or digit strings), any order, repeats allowed
+
+        Returns
+        -------
+        list of (first, last) tuples of contiguous ids, sorted and deduplicated
+        i.e. [9, 3, 1, 2, 3, 5] -> [(1, 3), (5, 5), (9, 9)]
+        """
+
+        # integer ids skip the int() call per id, see benchmark.py --compression
+        # ids may be an iterator, so it is only consumed once, into unique
+        unique = set(ids)
+        try:
+            ordered = sorted(unique)
+        except TypeError:
+            ordered = None
+        if ordered is None or (ordered and not isinstance(ordered[0], int)):
+            ordered = sorted(set(int(each_id) for each_id in unique))
+
+        runs = list()
+        if not ordered:
+            return runs
+
+        append = runs.append
+        start = previous = ordered[0]
+        for each_id in ordered:
+            if each_id - previous > 1:
+                append((start, previous))
+                start = each_id
+            previous = each_id
+        append((start, previous))
+        return runs
+
+    @staticmethod
+    def compress_ids(ids):
+        """
+        Parameters
+        ----------
+        ids: iterable of integer ids (or digit strings), any order, repeats allowed
+
+        Returns
+        -------
+        list of sorted, deduplicated pieces with contiguous runs as "a-b",
+        i.e. [9, 3, 1, 2, 3, 5] -> ["1-3", "5", "9"]
+        """
+
+        return [str(start) if start == last else "%d-%d" % (start, last)
+                for start, last in Tools.id_runs(ids)]
+
+    @staticmethod
+    def batch_ids(ids, chunksize=MAX_IDS_PER_REQUEST, max_length=MAX_ID_STRING_LENGTH):
+        """
+        Parameters
+        ----------
+        ids: iterable of ids, compressed with compress_ids first,
+            or an id string such as "1-100,105", used as it is
+        chunksize, max_length: limits per chunk, see plan_request_ranges
+
+        Returns
+        -------
+        list of id strings, each within brightpearl's per request limits
+        """
+
+        if Tools.is_id_string(ids):
+            return Tools.plan_request_ranges(ids, chunksize, max_length)
+        return list(Tools.pack_runs(Tools.id_runs(ids), chunksize, max_length))
+
+    @staticmethod
+    def plan_request_ranges(request_range, chunksize=MAX_IDS_PER_REQUEST,
+            max_length=MAX_ID_STRING_LENGTH):
+        """
+        Parameters
+        ----------
+        request_range: id string such as "1-1000", "1,5,9" or "1-10,15"
+        chunksize: integer for the max number of ids per chunk
+        max_length: integer for the max number of characters per chunk
+
+        Returns
+        -------
+        list of id strings, each within brightpearl's per request limits
+        """
+
+        runs = list()
+        for fragment in str(request_range).split(","):
+            fragment = fragment.strip()
+            if not fragment:
+                continue
+            if "-" in fragment:
+                begin, end = fragment.split("-")
+                if int(begin) > int(end):
+                    raise ValueError("Reversed id range: {}".format(fragment))
+                runs.append((int(begin), int(end)))
+            else:
+                runs.append((int(fragment), int(fragment)))
+
+        return list(Tools.pack_runs(runs, chunksize, max_length))
+
+    @staticmethod
+    def pack_runs(runs, chunksize=MAX_IDS_PER_REQUEST, max_length=MAX_ID_STRING_LENGTH):
+        """
+        Parameters
+        ----------
+        runs: iterable of (first, last) id tuples, see id_runs
+        chunksize: integer for the max number of ids per chunk
+        max_length: integer for the max number of characters per chunk
+
+        Returns
+        -------
+        generator of id strings such as "1-200" or "201-250,300",
+        runs longer than chunksize are split from their first id
+        """
+
+        current = list()
+        count = 0
+        length = 0
+
+        for begin, end in runs:
+            while begin <= end:
+                last = min(begin + chunksize - 1, end)
+                piece = str(begin) if begin == last else "%d-%d" % (begin, last)
+                size = last - begin + 1
+                begin = last + 1
+
+                if current and (count + size > chunksize
+                        or length + 1 + len(piece) > max_length):
+                    yield ",".join(current)
+                    current = list()
+                    count = 0
+                    length = 0
+
+                length += len(piece) + (1 if current else 0)
+                count += size
+                current.append(piece)
+
+        if current:
+            yield ",".join(current)
+
+    @staticmethod
+    def chunked(iterable, chunksize):
+        """
+        Parameters
+        ----------
+        iterable: any iterable or iterator, consumed lazily
+        chunksize: integer denoting max size of each chunk
+
+        Returns
+        -------
+        generator of lists of up to chunksize items, the last one
+        shorter rather than filled up; items (None included) are kept as is
+        """
+
+        if chunksize < 1:
+            raise ValueError("chunksize must be at least 1: {}".format(chunksize))
+
+        iterator = iter(iterable)
+        while True:
+            chunk = list(islice(iterator, chunksize))
+            if not chunk:
+                return
+            yield chunk
+
+    def grouper(iterable, chunks=None, chunksize=None, fillvalue=None):
+        """
+        Parameters
+        ----------
+        iterable: iterable oblect to be split up
+        chunks: integer denoting how many chunks to produce
+            default: None
+            notes: overrides chunksize if listed, needs the length
+            of iterable, so iterators are read into a list first
+        chunksize: integer denoting max size of each chunk
+            default: None
+        fillvalue: value to fill up the last chunk with
+            default: None (the last chunk is left shorter)
+
+        Returns
+        -------
+        list of chunk lists, see chunked for the lazy version
         """
 
         if chunks is None and chunksize is None:
             raise KeyError("Please enter either chunks or chunksize Parameter")
 
         if chunks is not None:
-            chunksize = int(ceil(len(iterable) / chunks))
+            if not hasattr(iterable, "__len__"):
+                iterable = list(iterable)
+            chunksize = max(int(ceil(len(iterable) / chunks)), 1)
 
-        args = [iter(iterable)] * chunksize
-        list_of_chunks = list(zip_longest(*args, fillvalue=fillvalue))
-        cleaned_list = [[item for item in one_list if item is not None]
-                for one_list in list_of_chunks ]
+        list_of_chunks = list(Tools.chunked(iterable, chunksize))
+        if fillvalue is not None and list_of_chunks:
+            list_of_chunks[-1].extend([fillvalue] * (chunksize - len(list_of_chunks[-1])))
 
-        return cleaned_list
+        return list_of_chunks
 
     def searchstringifier(a_list):
         """
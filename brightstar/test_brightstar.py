@@ -1,8 +1,45 @@
+import asyncio
+import benchmark
+import gzip
+import os
+import tempfile
+import time
 import unittest
 import responses
 import json
+import math
+import pytest
 from brightpearl import API
+from brightpearl import AsyncAPI
+from brightpearl import AsyncResponse
+from brightpearl import Histogram
+from brightpearl import JSONArrayStream
+from brightpearl import LRUCache
+from brightpearl import Metrics
+from brightpearl import RateLimiter
+from brightpearl import ReplayTransport
+from brightpearl import ResponseCache
+from brightpearl import SQLiteCache
 from brightpearl import Tools
+from brightpearl import Tracer
+from brightpearl import Transport
+from brightpearl import Order
+from brightpearl import OrderFrame
+from brightpearl import OrderFrameBuilder
+from brightpearl import PriceMatrix
+from brightpearl import PriceMatrixBuilder
+from brightpearl import OrderStore
+from brightpearl import OrderSync
+from brightpearl import Product
+from brightpearl import ProductMirror
+from brightpearl import ProductResolver
+from brightpearl import BloomFilter
+from brightpearl import NegativeLookupCache
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from itertools import count
+from responses import matchers
+from urllib.parse import urlencode
 
 TEST_CONFIG = { 'datacentre': 'eu1',
                 'api_version': 'public-api',
@@ -107,6 +144,162 @@ class BasicMethodsTest(unittest.TestCase):
             {"response": "options"}
             )
 
+class TransportTest(unittest.TestCase):
+
+    def test_default_transport_from_config(self):
+        config = dict(TEST_CONFIG, pool_size=4, timeout=2.5)
+        instance = API(config)
+
+        self.assertIsInstance(instance.transport, Transport)
+        self.assertEqual(instance.transport.pool_size, 4)
+        self.assertEqual(instance.transport.timeout, 2.5)
+        adapter = instance.transport.session.get_adapter(instance.uri)
+        self.assertEqual(adapter._pool_maxsize, 4)
+
+    @responses.activate
+    def test_connections_are_reused(self):
+        responses.add(responses.GET,
+            'https://ws-eu1.brightpearl.com/public-api/testcompany/',
+            body= json.dumps({"response": "get_test_body"}),
+            status= 200,
+                )
+
+        with API(TEST_CONFIG) as instance:
+            session = instance.transport.session
+            instance.get(instance.uri)
+            instance.get(instance.uri)
+            self.assertIs(instance.transport.session, session)
+
+        self.assertEqual(len(responses.calls), 2)
+
+    def test_custom_transport(self):
+
+        class FakeResponse(object):
+            status_code = 200
+            headers = {}
+
+            def json(self):
+                return {"response": "fake"}
+
+        class FakeTransport(object):
+            def __init__(self):
+                self.calls = []
+                self.closed = False
+
+            def request(self, method, the_uri, headers=None, data=None):
+                self.calls.append((method, the_uri, headers, data))
+                return FakeResponse()
+
+            def close(self):
+                self.closed = True
+
+        fake = FakeTransport()
+        with API(TEST_CONFIG, transport=fake) as instance:
+            self.assertEqual(instance.options(instance.uri), {"response": "fake"})
+
+        self.assertEqual(fake.calls[0][0], "OPTIONS")
+        self.assertEqual(fake.calls[0][2], instance.headers)
+        self.assertTrue(fake.closed)
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.time = FakeClock()
+        self.limiter = RateLimiter(capacity=3, period=60.0,
+            clock=self.time.clock, sleep=self.time.sleep)
+
+    def test_waits_for_next_period_when_empty(self):
+        for each_request in range(3):
+            self.limiter.acquire()
+        self.assertEqual(self.time.sleeps, [])
+
+        self.limiter.acquire()
+        self.assertEqual(self.time.sleeps, [60.0])
+        self.assertEqual(self.limiter.remaining, 2)
+
+    def test_resyncs_from_headers(self):
+        self.limiter.acquire()
+        self.limiter.update({
+            "brightpearl-requests-remaining": "0",
+            "brightpearl-next-throttle-period": "1500",
+            })
+
+        self.limiter.acquire()
+        self.assertEqual(self.time.sleeps, [1.5])
+
+    def test_shared_per_account(self):
+        self.addCleanup(RateLimiter.reset_accounts)
+        config = dict(TEST_CONFIG, rate_limit=True)
+        first = API(config)
+        second = API(config)
+        other = API(dict(config, account_code="othercompany"))
+
+        self.assertIs(first.rate_limiter, second.rate_limiter)
+        self.assertIsNot(first.rate_limiter, other.rate_limiter)
+        self.assertIsNone(API(TEST_CONFIG).rate_limiter)
+
+        RateLimiter.reset_accounts()
+        self.assertIsNot(API(config).rate_limiter, first.rate_limiter)
+
+    def test_throttled_stream_is_closed_before_retry(self):
+        closed = []
+
+        class ThrottledResponse(object):
+            status_code = 503
+            headers = {"brightpearl-next-throttle-period": "1000"}
+
+            def close(self):
+                closed.append(self)
+
+        class ThrottledTransport(object):
+            def request(self, method, the_uri, headers=None, data=None, stream=False):
+                return ThrottledResponse()
+
+        instance = API(dict(TEST_CONFIG, rate_limit=self.limiter, max_retries=2),
+            transport=ThrottledTransport())
+
+        response = instance.request("GET", instance.uri, stream=True)
+
+        self.assertEqual(len(closed), 2)
+        self.assertNotIn(response, closed)
+
+    @responses.activate
+    def test_throttled_response_is_retried(self):
+        responses.add(responses.GET,
+            'https://ws-eu1.brightpearl.com/public-api/testcompany/',
+            body= json.dumps({"response": "You have sent too many requests"}),
+            status= 503,
+            headers={"brightpearl-next-throttle-period": "2000"},
+                )
+        responses.add(responses.GET,
+            'https://ws-eu1.brightpearl.com/public-api/testcompany/',
+            body= json.dumps({"response": "get_test_body"}),
+            status= 200,
+            headers={"brightpearl-requests-remaining": "150"},
+                )
+
+        instance = API(dict(TEST_CONFIG, rate_limit=self.limiter))
+
+        self.assertEqual(instance.get(instance.uri), {"response": "get_test_body"})
+        self.assertEqual(self.time.sleeps, [2.0])
+        self.assertEqual(self.limiter.remaining, 150)
+
+
 class GetMethodsTest(unittest.TestCase):
 
     def setUp(self):
@@ -218,6 +411,1421 @@ class OrderSearchTest(unittest.TestCase):
         assert searched_orders == expected_results
 
 
+def add_order_responses(order_uri):
+    responses.add(responses.OPTIONS,
+        order_uri + "1-6",
+        body= json.dumps({"response": {"getUris": [
+            "/order/1-2", "/order/3-4", "/order/5-6"]}}),
+        status= 200,
+    )
+    for first in (1, 3, 5):
+        responses.add(responses.GET,
+            "{}{}-{}".format(order_uri, first, first + 1),
+            body= json.dumps({"response": [{"id": first}, {"id": first + 1}]}),
+            status= 200,
+        )
+
+
+class FanOutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.instance = API(TEST_CONFIG)
+        self.order_uri = self.instance.uri + "order-service/order/"
+
+    @responses.activate
+    def test_get_order_data_serial(self):
+        add_order_responses(self.order_uri)
+        orders = self.instance.get_order_data("1-6")
+        assert [order["id"] for order in orders] == [1, 2, 3, 4, 5, 6]
+
+    @responses.activate
+    def test_get_order_data_workers_keeps_order(self):
+        add_order_responses(self.order_uri)
+        orders = self.instance.get_order_data("1-6", workers=3)
+        assert [order["id"] for order in orders] == [1, 2, 3, 4, 5, 6]
+
+    @responses.activate
+    def test_get_products_data_workers_custom(self):
+        product_uri = self.instance.uri + "product-service/product/"
+        responses.add(responses.OPTIONS,
+            product_uri + "1-4",
+            body= json.dumps({"response": {"getUris": [
+                "/product/1-2", "/product/3-4"]}}),
+            status= 200,
+        )
+        for first in (1, 3):
+            responses.add(responses.GET,
+                "{}{}-{}?includeOptional=customFields".format(
+                    product_uri, first, first + 1),
+                body= json.dumps({"response": [{"id": first}, {"id": first + 1}]}),
+                status= 200,
+                match_querystring=True,
+            )
+
+        products = self.instance.get_products_data("1-4", custom=True, workers=2)
+        assert [product["id"] for product in products] == [1, 2, 3, 4]
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.time = FakeClock()
+        self.cache = LRUCache(maxsize=2, ttl=10, clock=self.time.clock)
+
+    def test_evicts_least_recently_used(self):
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.get("a")
+        self.cache.set("c", 3)
+
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(self.cache.stats(),
+            {"hits": 2, "misses": 1, "size": 2, "bytes": 0})
+
+    def test_entries_expire(self):
+        self.cache.set("a", 1)
+        self.time.now = 9.9
+        self.assertEqual(self.cache.get("a"), 1)
+        self.time.now = 10
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(len(self.cache), 0)
+
+
+    def test_evicts_by_bytes(self):
+        cache = LRUCache(maxsize=10, maxbytes=10)
+        cache.set("a", "aaaaaa", size=6)
+        cache.set("b", "bbbbbb", size=6)
+
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("b"), "bbbbbb")
+        self.assertEqual(cache.size, 6)
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.time = FakeClock()
+        self.cache = ResponseCache(ttl=30, service_ttls={"products": 300},
+            clock=self.time.clock)
+        self.instance = API(dict(TEST_CONFIG, response_cache=self.cache))
+        self.product_uri = self.instance.uri + "product-service/product/1001"
+
+    @responses.activate
+    def test_fresh_response_served_locally(self):
+        responses.add(responses.GET, self.product_uri,
+            body= json.dumps({"response": [{"id": 1001}]}),
+            status= 200,
+        )
+
+        self.assertEqual(self.instance.get(self.product_uri), {"response": [{"id": 1001}]})
+        self.time.now = 299
+        self.assertEqual(self.instance.get(self.product_uri), {"response": [{"id": 1001}]})
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    def test_size_counts_encoded_bytes(self):
+        body = json.dumps({"response": [{"name": "Größe €"}]}, ensure_ascii=False)
+        responses.add(responses.GET, self.product_uri, body= body.encode('utf-8'), status= 200)
+
+        self.instance.get(self.product_uri)
+
+        self.assertEqual(self.cache.backend.stats()["bytes"], len(body.encode('utf-8')))
+        self.assertGreater(self.cache.backend.stats()["bytes"], len(body))
+
+    @responses.activate
+    def test_stale_response_revalidated_with_etag(self):
+        responses.add(responses.GET, self.product_uri,
+            body= json.dumps({"response": [{"id": 1001}]}),
+            status= 200,
+            headers={"ETag": '"v1"'},
+        )
+        responses.add(responses.GET, self.product_uri,
+            body= "",
+            status= 304,
+        )
+
+        self.instance.get(self.product_uri)
+        self.time.now = 301
+
+        self.assertEqual(self.instance.get(self.product_uri), {"response": [{"id": 1001}]})
+        self.assertEqual(responses.calls[1].request.headers["If-None-Match"], '"v1"')
+        self.assertEqual(self.cache.revalidated, 1)
+
+    @responses.activate
+    def test_keyed_by_token(self):
+        staff_instance = API(dict(TEST_CONFIG, response_cache=self.cache))
+        staff_instance.headers = {"brightpearl-app-ref": "testcompany_testapp",
+                                  "brightpearl-staff-token": "St4ffT0K3n"}
+        responses.add(responses.GET, self.product_uri,
+            body= json.dumps({"response": [{"id": 1001}]}),
+            status= 200,
+        )
+
+        self.instance.get(self.product_uri)
+        staff_instance.get(self.product_uri)
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_put_invalidates_resource(self):
+        responses.add(responses.GET, self.product_uri,
+            body= json.dumps({"response": [{"id": 1001}]}),
+            status= 200,
+        )
+        responses.add(responses.PUT, self.product_uri,
+            body= json.dumps({"response": 1001}),
+            status= 200,
+        )
+
+        self.instance.get(self.product_uri)
+        self.instance.put(self.product_uri, data="{}")
+        self.instance.get(self.product_uri)
+
+        self.assertEqual([call.request.method for call in responses.calls],
+            ["GET", "PUT", "GET"])
+
+
+class SQLiteCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "cache.db")
+        self.time = FakeClock()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_shared_between_instances(self):
+        writer = SQLiteCache(self.path, namespace="plans")
+        reader = SQLiteCache(self.path, namespace="plans")
+
+        writer.set("order/1-6", ["/order/1-2", "/order/3-4"])
+
+        self.assertEqual(reader.get("order/1-6"), ["/order/1-2", "/order/3-4"])
+        self.assertIsNone(SQLiteCache(self.path, namespace="responses").get("order/1-6"))
+
+    def test_entries_expire(self):
+        cache = SQLiteCache(self.path, ttl=10, clock=self.time.clock)
+        cache.set("a", 1)
+        self.time.now = 10
+
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 0)
+
+    def test_evicts_least_recently_used(self):
+        cache = SQLiteCache(self.path, maxsize=2, maxbytes=10, clock=self.time.clock)
+        cache.set("a", "a", size=4)
+        self.time.now = 1
+        cache.set("b", "b", size=4)
+        self.time.now = 2
+        cache.get("a")
+        self.time.now = 3
+        cache.set("c", "c", size=4)
+
+        self.assertEqual(sorted(cache.keys()), ["a", "c"])
+        self.assertEqual(cache.stats()["bytes"], 8)
+
+    @responses.activate
+    def test_api_plans_in_shared_cache(self):
+        config = dict(TEST_CONFIG, cache_path=self.path, plan_cache=True)
+        first = API(config)
+        add_order_responses(first.uri + "order-service/order/")
+
+        first.get_order_data("1-6")
+        API(config).get_order_data("1-6")
+
+        methods = [call.request.method for call in responses.calls]
+        self.assertIsInstance(first.plan_cache, SQLiteCache)
+        self.assertEqual(methods.count("OPTIONS"), 1)
+
+    @responses.activate
+    def test_accounts_sharing_cache_get_own_plans(self):
+        config = dict(TEST_CONFIG, cache_path=self.path, plan_cache=True)
+        first = API(config)
+        second = API(dict(config, account_code="companyb"))
+        for instance in (first, second):
+            responses.add(responses.OPTIONS, instance.uri + "order-service/order/1-2",
+                body= json.dumps({"response": {"getUris": ["/order/1-2"]}}),
+                status= 200,
+            )
+
+        first.get_options_uris_by_service("order", "1-2")
+        uris = second.get_options_uris_by_service("order", "1-2")
+
+        self.assertEqual(uris, [second.uri + "order-service/order/1-2"])
+        self.assertEqual(len(responses.calls), 2)
+
+
+class PlanCacheTest(unittest.TestCase):
+
+    @responses.activate
+    def test_repeated_range_skips_options(self):
+        instance = API(dict(TEST_CONFIG, plan_cache=True))
+        add_order_responses(instance.uri + "order-service/order/")
+
+        instance.get_order_data("1-6")
+        instance.get_order_data("1-6")
+
+        methods = [call.request.method for call in responses.calls]
+        self.assertEqual(methods.count("OPTIONS"), 1)
+        self.assertEqual(methods.count("GET"), 6)
+        self.assertEqual(instance.plan_cache.hits, 1)
+        self.assertEqual(instance.plan_cache.misses, 1)
+
+    def test_unknown_plan_is_rejected(self):
+        instance = API(TEST_CONFIG)
+
+        with self.assertRaises(ValueError):
+            instance.get_uris_by_service("order", "1-6", plan="remote")
+        with self.assertRaises(ValueError):
+            API(dict(TEST_CONFIG, plan="remote"))
+
+    @responses.activate
+    def test_plan_cache_is_off_by_default(self):
+        self.assertIsNone(API(dict(TEST_CONFIG, plan_cache=True, plan_cache_size=0)).plan_cache)
+        instance = API(TEST_CONFIG)
+        add_order_responses(instance.uri + "order-service/order/")
+
+        instance.get_order_data("1-6")
+        instance.get_order_data("1-6")
+
+        methods = [call.request.method for call in responses.calls]
+        self.assertIsNone(instance.plan_cache)
+        self.assertEqual(methods.count("OPTIONS"), 2)
+
+
+class LocalPlanTest(unittest.TestCase):
+
+    @responses.activate
+    def test_local_plan_skips_options(self):
+        instance = API(TEST_CONFIG)
+        order_uri = instance.uri + "order-service/order/"
+        responses.add(responses.GET,
+            order_uri + "1-200",
+            body= json.dumps({"response": [{"id": 1}]}),
+            status= 200,
+        )
+        responses.add(responses.GET,
+            order_uri + "201-250",
+            body= json.dumps({"response": [{"id": 201}]}),
+            status= 200,
+        )
+
+        orders = instance.get_order_data("1-250", plan="local")
+
+        assert [order["id"] for order in orders] == [1, 201]
+        assert [call.request.method for call in responses.calls] == ["GET", "GET"]
+
+
+class StreamingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.instance = API(TEST_CONFIG)
+
+    @responses.activate
+    def test_iter_order_data_is_lazy(self):
+        add_order_responses(self.instance.uri + "order-service/order/")
+
+        orders = self.instance.iter_order_data("1-6")
+        self.assertEqual(next(orders)["id"], 1)
+        # the OPTIONS call and the first chunk only
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual([order["id"] for order in orders], [2, 3, 4, 5, 6])
+        self.assertEqual(len(responses.calls), 4)
+
+    @responses.activate
+    def test_prefetch_is_bounded(self):
+        add_order_responses(self.instance.uri + "order-service/order/")
+
+        orders = self.instance.iter_order_data("1-6", prefetch=1)
+        self.assertEqual(next(orders)["id"], 1)
+        time.sleep(0.05)
+        # OPTIONS, the chunk being consumed and one chunk read ahead
+        self.assertEqual(len(responses.calls), 3)
+        self.assertEqual([order["id"] for order in orders], [2, 3, 4, 5, 6])
+        self.assertEqual(len(responses.calls), 4)
+
+    @responses.activate
+    def test_iter_goods_notes(self):
+        responses.add(responses.GET,
+            self.instance.uri + "warehouse-service/order/1-2/goods-note/goods-out/",
+            body= json.dumps({"response": {
+                "11": {"orderId": 1}, "12": {"orderId": 2}}}),
+            status= 200,
+        )
+
+        goods_notes = list(self.instance.iter_goods_notes([1, 2], note_type="out"))
+        self.assertEqual(goods_notes, [("11", {"orderId": 1}), ("12", {"orderId": 2})])
+
+
+class FakeAsyncTransport(object):
+
+    def __init__(self, bodies):
+        self.bodies = bodies
+        self.calls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.closed = False
+
+    async def request(self, method, the_uri, headers=None, data=None):
+        self.calls.append((method, the_uri))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0)
+        self.in_flight -= 1
+        body = json.dumps(self.bodies[(method, the_uri)]).encode('utf-8')
+        return AsyncResponse(200, {}, body)
+
+    async def close(self):
+        self.closed = True
+
+
+class AsyncAPITest(unittest.TestCase):
+
+    def setUp(self):
+        self.order_uri = API(TEST_CONFIG).uri + "order-service/order/"
+
+    def test_get_order_data_gathers_in_order(self):
+        bodies = {("OPTIONS", self.order_uri + "1-6"): {"response": {"getUris": [
+            "/order/1-2", "/order/3-4", "/order/5-6"]}}}
+        for first in (1, 3, 5):
+            bodies[("GET", "{}{}-{}".format(self.order_uri, first, first + 1))] = {
+                "response": [{"id": first}, {"id": first + 1}]}
+        transport = FakeAsyncTransport(bodies)
+
+        async def run():
+            async with AsyncAPI(dict(TEST_CONFIG, workers=2), transport=transport) as instance:
+                return await instance.get_order_data("1-6")
+
+        orders = asyncio.run(run())
+        assert [order["id"] for order in orders] == [1, 2, 3, 4, 5, 6]
+        assert transport.max_in_flight == 2
+        assert transport.closed
+
+    def test_record_and_replay_are_refused(self):
+        for key in ("record_path", "replay_path"):
+            with self.assertRaises(ValueError):
+                AsyncAPI(dict(TEST_CONFIG, **{key: "cassette.jsonl.gz"}),
+                    transport=FakeAsyncTransport({}))
+
+    def test_plain_with_is_refused(self):
+        transport = FakeAsyncTransport({})
+
+        with self.assertRaises(TypeError):
+            with AsyncAPI(TEST_CONFIG, transport=transport):
+                pass
+        assert not transport.closed
+
+    def test_sku_lookup(self):
+        instance_uri = API(TEST_CONFIG).uri
+        bodies = {("GET", instance_uri + "product-service/product-search?SKU=ABC"): {
+            "response": {"results": [
+                [1001, "Thing", "ABC", None, "4000000000001", None, None, True,
+                 None, None, None, 7, 3]]}}}
+        instance = AsyncAPI(TEST_CONFIG, transport=FakeAsyncTransport(bodies))
+
+        product = asyncio.run(instance.sku_lookup("ABC"))
+        assert product["product_id"] == 1001
+        assert product["EAN"] == "4000000000001"
+        assert product["product_group_id"] == 3
+
+    def test_iter_search_pages_concurrently(self):
+        search_uri = API(TEST_CONFIG).uri + "product-service/product-search?"
+        bodies = dict()
+        for first_result, results in ((1, [[1, "A"], [2, "B"]]), (3, [[3, "C"]])):
+            bodies[("GET", search_uri + urlencode({"pageSize": 2,
+                "firstResult": first_result, "columns": "productId,SKU"}))] = {"response": {
+                    "metaData": {"resultsAvailable": 3, "morePagesAvailable": first_result == 1,
+                        "lastResult": first_result + len(results) - 1,
+                        "columns": [{"name": "productId"}, {"name": "SKU"}]},
+                    "results": results}}
+        instance = AsyncAPI(TEST_CONFIG, transport=FakeAsyncTransport(bodies))
+
+        async def run():
+            return [row async for row in instance.iter_search(
+                "product", columns=["productId", "SKU"], page_size=2)]
+
+        rows = asyncio.run(run())
+        assert [row["SKU"] for row in rows] == ["A", "B", "C"]
+
+
+class SearchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.instance = API(TEST_CONFIG)
+        self.search_uri = self.instance.uri + "product-service/product-search"
+
+    def add_page(self, first_result, results):
+        responses.add(responses.GET, self.search_uri,
+            body= json.dumps({"response": {
+                "metaData": {
+                    "resultsAvailable": 5,
+                    "resultsReturned": len(results),
+                    "morePagesAvailable": first_result + len(results) <= 5,
+                    "firstResult": first_result,
+                    "lastResult": first_result + len(results) - 1,
+                    "columns": [{"name": "productId"}, {"name": "SKU"}],
+                    },
+                "results": results}}),
+            status= 200,
+            match=[matchers.query_param_matcher({"columns": "productId,SKU",
+                "productGroupId": "5", "pageSize": "2", "firstResult": str(first_result)})],
+        )
+
+    @responses.activate
+    def test_iter_search_walks_every_page(self):
+        self.add_page(1, [[1, "A"], [2, "B"]])
+        self.add_page(3, [[3, "C"], [4, "D"]])
+        self.add_page(5, [[5, "E"]])
+
+        rows = list(self.instance.iter_search("product", columns=["productId", "SKU"],
+            page_size=2, workers=2, productGroupId=5))
+
+        self.assertEqual([row["productId"] for row in rows], [1, 2, 3, 4, 5])
+        self.assertEqual(rows[4], {"productId": 5, "SKU": "E"})
+        self.assertEqual(len(responses.calls), 3)
+
+    @responses.activate
+    def test_iter_search_as_tuples(self):
+        self.add_page(1, [[1, "A"], [2, "B"]])
+        self.add_page(3, [[3, "C"], [4, "D"]])
+        self.add_page(5, [[5, "E"]])
+
+        rows = list(self.instance.iter_search("product", columns=["productId", "SKU"],
+            page_size=2, workers=2, rows="tuple", productGroupId=5))
+
+        self.assertEqual([row.productId for row in rows], [1, 2, 3, 4, 5])
+        self.assertEqual(rows[4], (5, "E"))
+        self.assertIs(type(rows[0]), type(rows[4]))
+
+    @responses.activate
+    def test_lookup_with_several_filters(self):
+        responses.add(responses.GET, self.search_uri,
+            body= json.dumps({"response": {
+                "metaData": {"columns": [{"name": "SKU"}, {"name": "productId"},
+                                         {"name": "EAN"}]},
+                "results": [["ABC", 1001, "400"]]}}),
+            status= 200,
+            match=[matchers.query_param_matcher({"SKU": "ABC", "productGroupId": "5"})],
+        )
+
+        product = self.instance.lookup_service("product", SKU="ABC", productGroupId=5)
+
+        self.assertEqual(product["product_id"], 1001)
+        self.assertEqual(product["EAN"], "400")
+        self.assertIsNone(product["product_group_id"])
+
+
+class RecordTest(unittest.TestCase):
+
+    order = {
+        "id": 1, "orderTypeCode": "SO", "reference": "ref-1",
+        "orderStatus": {"orderStatusId": 4, "name": "Shipped"},
+        "placedOn": "2026-10-01T10:00:00.000+01:00",
+        "currency": {"orderCurrencyCode": "EUR"},
+        "totalValue": {"net": "10.00", "taxAmount": "1.90", "total": "11.90"},
+        "parties": {"customer": {"contactId": 7}},
+        "orderRows": {"11": {"productId": 1001, "productSku": "ABC",
+            "quantity": {"magnitude": "2.0000"},
+            "rowValue": {"taxCode": "T20", "rowNet": {"value": "10.00"},
+                         "rowTax": {"value": "1.90"}}}},
+        }
+
+    def setUp(self):
+        self.instance = API(TEST_CONFIG)
+
+    def test_eager_order(self):
+        order = Order.from_json(self.order)
+
+        self.assertEqual(order.id, 1)
+        self.assertEqual(order.order_status_id, 4)
+        self.assertEqual(order.currency_code, "EUR")
+        self.assertEqual(order.total_value, "11.90")
+        self.assertIsNone(order.warehouse_id)
+        self.assertIsNone(order.delivery)
+        self.assertEqual(order.rows[0].row_id, 11)
+        self.assertEqual(order.rows[0].sku, "ABC")
+        self.assertEqual(order.rows[0].tax_code, "T20")
+        self.assertFalse(hasattr(order, "__dict__"))
+
+    def test_lazy_order_decodes_on_access(self):
+        order = Order.from_json(self.order, lazy=True)
+
+        self.assertIsInstance(order._rows, str)
+        self.assertEqual(order.rows[0].net, "10.00")
+        self.assertIsInstance(order._rows, list)
+        self.assertEqual(order.parties["customer"]["contactId"], 7)
+
+    def test_product(self):
+        product = Product.from_json({"id": 1001,
+            "identity": {"sku": "ABC", "ean": "400"}, "stock": {"stockTracked": True}},
+            lazy=True)
+
+        self.assertEqual(product.sku, "ABC")
+        self.assertEqual(product.stock, {"stockTracked": True})
+
+    @responses.activate
+    def test_get_order_data_records(self):
+        order_uri = self.instance.uri + "order-service/order/"
+        add_order_responses(order_uri)
+
+        orders = self.instance.get_order_data("1-6", records="lazy")
+
+        self.assertTrue(all(isinstance(order, Order) for order in orders))
+        with self.assertRaises(ValueError):
+            self.instance.to_record(Order, {}, records="compact")
+
+
+class OrderSyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.instance = API(TEST_CONFIG)
+        self.store = OrderStore(":memory:")
+        self.now = datetime(2026, 10, 17, 12, 0, tzinfo=timezone.utc)
+        self.sync = OrderSync(self.instance, self.store, page_size=2,
+            clock=lambda: self.now)
+        self.search_uri = self.instance.uri + "order-service/order-search"
+        self.order_uri = self.instance.uri + "order-service/order/"
+
+    def add_search_page(self, first_result, results, more, **filters):
+        query = dict(filters, columns="orderId", pageSize="2",
+            firstResult=str(first_result))
+        responses.add(responses.GET, self.search_uri,
+            body= json.dumps({"response": {
+                "metaData": {
+                    "morePagesAvailable": more,
+                    "firstResult": first_result,
+                    "lastResult": first_result + len(results) - 1,
+                    "columns": [{"name": "orderId"}],
+                    },
+                "results": results}}),
+            status= 200,
+            match=[matchers.query_param_matcher(query)],
+        )
+
+    @responses.activate
+    def test_first_run_then_incremental(self):
+        self.add_search_page(1, [[1], [2]], True)
+        self.add_search_page(3, [[3]], False)
+        responses.add(responses.GET, self.order_uri + "1,2,3",
+            body= json.dumps({"response": [
+                {"id": 1, "updatedOn": "a"}, {"id": 2}, {"id": 3}]}),
+            status= 200,
+        )
+
+        self.assertEqual(self.sync.run(), 3)
+        self.assertEqual(len(self.store), 3)
+        self.assertEqual(self.store.get(1), {"id": 1, "updatedOn": "a"})
+        self.assertEqual(self.store.get_watermark(), "2026-10-17T11:55:00+00:00")
+
+        self.add_search_page(1, [[2]], False, updatedOn="2026-10-17T11:55:00+00:00/")
+        responses.add(responses.GET, self.order_uri + "2",
+            body= json.dumps({"response": [{"id": 2, "orderStatusId": 4}]}),
+            status= 200,
+        )
+        self.now = datetime(2026, 10, 17, 13, 0, tzinfo=timezone.utc)
+
+        self.assertEqual(self.sync.run(), 1)
+        self.assertEqual(self.store.get(2), {"id": 2, "orderStatusId": 4})
+        self.assertEqual(self.store.get_watermark(), "2026-10-17T12:55:00+00:00")
+
+
+class ProductMirrorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mirror = ProductMirror(":memory:")
+        self.instance = API(dict(TEST_CONFIG, product_mirror=self.mirror, plan="local"))
+        product_uri = self.instance.uri + "product-service/"
+        self.search_uri = product_uri + "product-search"
+
+        responses.start()
+        self.addCleanup(responses.stop)
+        self.addCleanup(responses.reset)
+
+        responses.add(responses.GET, product_uri + "product/1001-1002",
+            body= json.dumps({"response": [
+                {"id": 1001, "productGroupId": 5,
+                 "identity": {"sku": "ABC", "ean": "4000000000001"},
+                 "stock": {"stockTracked": True},
+                 "salesChannels": [{"productName": "Thing",
+                                    "categories": [{"categoryCode": "276"}]}]},
+                {"id": 1002, "productGroupId": 5,
+                 "identity": {"sku": "DEF"}},
+                ]}),
+            status= 200,
+        )
+        responses.add(responses.GET, product_uri + "product-price/1001-1002",
+            body= json.dumps({"response": [
+                {"productId": 1001, "priceLists": [
+                    {"priceListId": 0, "quantityPrice": {"1": "5.00"}}]}]}),
+            status= 200,
+        )
+        self.mirror.build(self.instance, "1001-1002")
+
+    def test_build(self):
+        self.assertEqual(len(self.mirror), 2)
+        self.assertEqual(self.mirror.product_group(5), [1001, 1002])
+        self.assertEqual(self.mirror.get_prices(1001), {0: "5.00"})
+        self.assertEqual(self.mirror.get_product(1002)["identity"], {"sku": "DEF"})
+
+    def test_prices_written_in_batches(self):
+        product_prices = ((product_id, {0: "1.00", 1: "2.00"}) for product_id in range(5))
+
+        self.assertEqual(self.mirror.upsert_prices(product_prices, batch_size=2), 10)
+        self.assertEqual(self.mirror.get_prices(4), {0: "1.00", 1: "2.00"})
+
+    def test_lookups_answered_locally(self):
+        calls = len(responses.calls)
+        expected = {
+            'product_id': 1001,
+            'product_name': "Thing",
+            'sku': "ABC",
+            'EAN': "4000000000001",
+            'stock_tracked': True,
+            'category_code': "276",
+            'product_group_id': 5,
+            }
+
+        self.assertEqual(self.instance.sku_lookup("ABC"), expected)
+        self.assertEqual(self.instance.ean_lookup(4000000000001), expected)
+        self.assertEqual(len(responses.calls), calls)
+
+    def test_miss_falls_back_to_network(self):
+        responses.add(responses.GET, self.search_uri + "?SKU=XYZ",
+            body= json.dumps({"response": {"results": []}}),
+            status= 200,
+        )
+
+        self.assertEqual(self.instance.sku_lookup("XYZ"), [])
+        self.assertEqual(responses.calls[-1].request.url, self.search_uri + "?SKU=XYZ")
+
+
+class ProductResolverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.instance = API(TEST_CONFIG)
+        self.search_uri = self.instance.uri + "product-service/product-search"
+        self.resolver = ProductResolver(self.instance, window=0.05)
+        self.addCleanup(self.resolver.close)
+
+    @responses.activate
+    def test_concurrent_skus_are_deduplicated(self):
+        for sku, product_id in (("ABC", 1001), ("DEF", 1002)):
+            responses.add(responses.GET, self.search_uri,
+                body= json.dumps({"response": {"results": [
+                    [product_id, "Thing", sku, None, None, None, None, True,
+                     None, None, None, 7, 3]]}}),
+                status= 200,
+                match=[matchers.query_param_matcher({"SKU": sku})],
+            )
+
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            products = list(executor.map(self.resolver.sku_lookup,
+                ["ABC", "DEF", "ABC", "ABC", "DEF", "ABC"]))
+
+        self.assertEqual([product["product_id"] for product in products],
+            [1001, 1002, 1001, 1001, 1002, 1001])
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(self.resolver.batches, 1)
+
+    @responses.activate
+    def test_product_ids_share_one_search(self):
+        responses.add(responses.GET, self.search_uri,
+            body= json.dumps({"response": {
+                "metaData": {"morePagesAvailable": False,
+                             "columns": [{"name": "productId"}, {"name": "SKU"}]},
+                "results": [[1001, "ABC"], [1003, "GHI"]]}}),
+            status= 200,
+            match=[matchers.query_param_matcher({
+                "productId": "1001,1003,1004", "pageSize": "500", "firstResult": "1"})],
+        )
+
+        products = self.resolver.load_many("product_id", [1003, 1001, 1004, 1001])
+
+        self.assertEqual(products[0]["sku"], "GHI")
+        self.assertEqual(products[1]["sku"], "ABC")
+        self.assertEqual(products[2], [])
+        self.assertEqual(len(responses.calls), 1)
+
+
+class NegativeLookupCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.time = FakeClock()
+        self.negative_cache = NegativeLookupCache(ttl=60, clock=self.time.clock)
+        self.instance = API(dict(TEST_CONFIG, negative_cache=self.negative_cache))
+        self.search_uri = self.instance.uri + "product-service/product-search"
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000, error_rate=0.01)
+        for number in range(1000):
+            bloom.add(number)
+
+        assert all(number in bloom for number in range(1000))
+        false_positives = sum(number in bloom for number in range(1000, 11000))
+        assert false_positives < 300
+
+    @responses.activate
+    def test_misses_are_remembered(self):
+        responses.add(responses.GET, self.search_uri + "?SKU=NOPE",
+            body= json.dumps({"response": {"results": []}}),
+            status= 200,
+        )
+
+        self.assertEqual(self.instance.sku_lookup("NOPE"), [])
+        self.assertEqual(self.instance.sku_lookup("NOPE"), [])
+        self.assertEqual(len(responses.calls), 1)
+
+        self.time.now = 61
+        self.instance.sku_lookup("NOPE")
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_seeded_filter_rejects_unknown_codes(self):
+        self.negative_cache.seed([{"id": 1001, "identity": {"sku": "ABC", "ean": "400"}}])
+        responses.add(responses.GET, self.search_uri + "?SKU=ABC",
+            body= json.dumps({"response": {"results": [
+                [1001, "Thing", "ABC", None, "400", None, None, True,
+                 None, None, None, 7, 3]]}}),
+            status= 200,
+        )
+
+        self.assertEqual(self.instance.ean_lookup("999"), [])
+        self.assertEqual(self.instance.sku_lookup("ABC")["product_id"], 1001)
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(self.negative_cache.rejected, 1)
+
+    @responses.activate
+    def test_seeded_filter_expires(self):
+        self.negative_cache.max_age = 600
+        self.negative_cache.seed([])
+        responses.add(responses.GET, self.search_uri + "?SKU=ELSEWHERE",
+            body= json.dumps({"response": {"results": [
+                [1002, "Thing", "ELSEWHERE", None, None, None, None, True,
+                 None, None, None, 7, 3]]}}),
+            status= 200,
+        )
+
+        self.assertEqual(self.instance.sku_lookup("ELSEWHERE"), [])
+        self.time.now = 600
+        self.assertEqual(self.instance.sku_lookup("ELSEWHERE")["product_id"], 1002)
+        self.assertIsNone(self.negative_cache.known)
+
+    @responses.activate
+    def test_products_created_elsewhere_are_picked_up(self):
+        self.negative_cache.seed([], seeded_on=datetime(2026, 10, 17, 12, 0, tzinfo=timezone.utc))
+        responses.add(responses.GET, self.search_uri,
+            body= json.dumps({"response": {
+                "metaData": {"resultsAvailable": 1, "morePagesAvailable": False,
+                    "lastResult": 1, "columns": [{"name": "SKU"}, {"name": "EAN"}]},
+                "results": [["ELSEWHERE", None]]}}),
+            status= 200,
+            match=[matchers.query_param_matcher({"columns": "SKU,EAN", "pageSize": "500",
+                "firstResult": "1", "createdOn": "2026-10-17T11:55:00+00:00/"})],
+        )
+        responses.add(responses.GET, self.search_uri + "?SKU=ELSEWHERE",
+            body= json.dumps({"response": {"results": [
+                [1002, "Thing", "ELSEWHERE", None, None, None, None, True,
+                 None, None, None, 7, 3]]}}),
+            status= 200,
+        )
+
+        self.assertEqual(self.instance.sku_lookup("ELSEWHERE"), [])
+        self.assertEqual(len(responses.calls), 0)
+
+        self.time.now = 60
+        self.assertEqual(self.instance.sku_lookup("ELSEWHERE")["product_id"], 1002)
+        self.assertEqual(len(responses.calls), 2)
+        self.assertFalse(self.negative_cache.is_absent("SKU", "ELSEWHERE"))
+        self.assertTrue(self.negative_cache.is_absent("SKU", "NOWHERE"))
+
+    @responses.activate
+    def test_created_product_is_no_longer_rejected(self):
+        self.negative_cache.seed([])
+        self.negative_cache.add_miss("SKU", "NEW")
+        responses.add(responses.POST, self.instance.uri + "product-service/product",
+            body= json.dumps({"response": 1002}),
+            status= 200,
+        )
+
+        self.assertTrue(self.negative_cache.is_absent("SKU", "NEW"))
+        self.instance.post_by_service("product",
+            json.dumps({"identity": {"sku": "NEW"}}))
+        self.assertFalse(self.negative_cache.is_absent("SKU", "NEW"))
+
+
+class PriceMatrixTest(unittest.TestCase):
+
+    prices = [
+        (1001, {0: "10.00", 1: "6.00"}),
+        (1003, {0: "20.00"}),
+        (1002, {0: "0.00", 1: None, 2: "4.00"}),
+        ]
+
+    def test_from_prices_grows_while_streaming(self):
+        matrix = PriceMatrix.from_prices(iter(self.prices), rows=1)
+
+        self.assertEqual(matrix.product_ids.tolist(), [1001, 1003, 1002])
+        self.assertEqual(matrix.price_list_ids.tolist(), [0, 1, 2])
+        self.assertEqual(matrix.prices.shape, (3, 3))
+        self.assertTrue(math.isnan(matrix.prices[1, 1]))
+        self.assertEqual(matrix.to_dict(),
+            {1001: {0: 10.0, 1: 6.0}, 1003: {0: 20.0}, 1002: {0: 0.0, 2: 4.0}})
+
+    def test_async_get_price_matrix(self):
+        prices_uri = API(TEST_CONFIG).uri + "product-service/product-price/"
+        bodies = {("OPTIONS", prices_uri + "1001-1002"): {"response": {"getUris": [
+                "/product-price/1001", "/product-price/1002"]}}}
+        for product_id, price in ((1001, "10.00"), (1002, "4.00")):
+            bodies[("GET", prices_uri + str(product_id))] = {"response": [
+                {"productId": product_id, "priceLists": [
+                    {"priceListId": 0, "quantityPrice": {"1": price}}]}]}
+        instance = AsyncAPI(TEST_CONFIG, transport=FakeAsyncTransport(bodies))
+
+        matrix = asyncio.run(instance.get_price_matrix("1001-1002"))
+
+        self.assertEqual(matrix.to_dict(), {1001: {0: 10.0}, 1002: {0: 4.0}})
+
+    def test_builder_merges_repeated_products(self):
+        builder = PriceMatrixBuilder(rows=1)
+        builder.append(1001, {0: "10.00"})
+        builder.append(1002, {0: "4.00"})
+        builder.append(1001, {1: "6.00"})
+
+        self.assertEqual(builder.finish().to_dict(),
+            {1001: {0: 10.0, 1: 6.0}, 1002: {0: 4.0}})
+
+    def test_lookup(self):
+        matrix = PriceMatrix.from_prices(self.prices)
+
+        looked_up = matrix.lookup([1002, 9999, 1001], 0)
+
+        self.assertEqual(looked_up[0], 0.0)
+        self.assertTrue(math.isnan(looked_up[1]))
+        self.assertEqual(looked_up[2], 10.0)
+        with self.assertRaises(KeyError):
+            matrix.column(5)
+
+    def test_diff_and_changed(self):
+        old = PriceMatrix.from_prices(self.prices)
+        new = PriceMatrix.from_prices([
+            (1002, {0: "0.00", 2: "4.00"}),
+            (1001, {0: "12.00", 1: "6.00"}),
+            ])
+
+        diff = new.diff(old)
+
+        self.assertEqual(diff.lookup([1001], 0)[0], 2.0)
+        self.assertEqual(diff.lookup([1001], 1)[0], 0.0)
+        self.assertEqual(new.changed(old).tolist(), [1001])
+        self.assertEqual(sorted(old.changed(new).tolist()), [1001, 1003])
+
+    def test_margin(self):
+        matrix = PriceMatrix.from_prices(self.prices)
+
+        margin = matrix.margin(0, 1)
+
+        self.assertAlmostEqual(margin[0], 0.4)
+        self.assertTrue(math.isnan(margin[1]))
+        self.assertTrue(math.isnan(margin[2]))
+
+    @responses.activate
+    def test_get_price_matrix(self):
+        instance = API(TEST_CONFIG)
+        price_uri = instance.uri + "product-service/product-price/"
+        responses.add(responses.OPTIONS, price_uri + "1001-1002",
+            body= json.dumps({"response": {"getUris": ["/product-price/1001-1002"]}}),
+            status= 200,
+        )
+        responses.add(responses.GET, price_uri + "1001-1002",
+            body= json.dumps({"response": [
+                {"productId": 1001, "priceLists": [
+                    {"priceListId": 0, "quantityPrice": {"1": "5.00"}}]},
+                {"productId": 1002, "priceLists": [
+                    {"priceListId": 1, "quantityPrice": {"1": "7.50"}}]}]}),
+            status= 200,
+        )
+
+        matrix = instance.get_price_matrix("1001-1002")
+
+        self.assertEqual(matrix.lookup([1001, 1002], 1)[1], 7.5)
+        self.assertTrue(math.isnan(matrix.lookup([1001], 1)[0]))
+
+
+class OrderFrameTest(unittest.TestCase):
+
+    def order(self, order_id, placed_on, rows):
+        return {"id": order_id, "orderTypeCode": "SO", "placedOn": placed_on,
+            "orderStatus": {"orderStatusId": 4},
+            "assignment": {"current": {"channelId": 2}},
+            "orderRows": {str(row_id): {"productId": product_id, "productSku": sku,
+                "quantity": {"magnitude": quantity},
+                "rowValue": {"rowNet": {"value": net}, "rowTax": {"value": "1.00"}}}
+                for row_id, product_id, sku, quantity, net in rows}}
+
+    def setUp(self):
+        self.orders = [
+            self.order(1, "2026-10-01T10:00:00.000+01:00",
+                [(11, 1001, "ABC", "2.0000", "10.00"), (12, 1002, "DEF", "1.0000", "3.00")]),
+            self.order(2, "2026-10-01T18:00:00.000+01:00",
+                [(21, 1001, "ABC", "1.0000", "5.00")]),
+            self.order(3, "2026-10-02T09:00:00.000+01:00",
+                [(31, 1001, "ABC", "4.0000", None)]),
+            ]
+
+    def test_from_orders(self):
+        frame = OrderFrame.from_orders(iter(self.orders))
+
+        self.assertEqual(len(frame), 4)
+        self.assertEqual(frame["order_id"].tolist(), [1, 1, 2, 3])
+        self.assertEqual(frame["sku"].tolist(), ["ABC", "DEF", "ABC", "ABC"])
+        self.assertEqual(frame["channel_id"].tolist(), [2, 2, 2, 2])
+        self.assertEqual(str(frame["placed_on"][3]), "2026-10-02")
+        self.assertTrue(math.isnan(frame["net"][3]))
+
+    def test_sales_per_sku_per_day(self):
+        frame = OrderFrame.from_orders(self.orders)
+
+        sales = frame.sales_per_sku_per_day()
+
+        self.assertEqual(sales["sku"].tolist(), ["ABC", "ABC", "DEF"])
+        self.assertEqual([str(day) for day in sales["placed_on"]],
+            ["2026-10-01", "2026-10-02", "2026-10-01"])
+        self.assertEqual(sales["quantity"].tolist(), [3.0, 4.0, 1.0])
+        self.assertEqual(sales["net"].tolist(), [15.0, 0.0, 3.0])
+        self.assertEqual(sales["rows"].tolist(), [2, 1, 1])
+
+    def test_select(self):
+        frame = OrderFrame.from_orders(self.orders)
+
+        abc = frame.select(frame["sku"] == "ABC")
+
+        self.assertEqual(abc.aggregate(("product_id",), sums=("quantity",))["quantity"].tolist(),
+            [7.0])
+
+    def test_async_get_order_frame(self):
+        order_uri = API(TEST_CONFIG).uri + "order-service/order/"
+        bodies = {("OPTIONS", order_uri + "1-3"): {"response": {"getUris": ["/order/1-2", "/order/3"]}},
+            ("GET", order_uri + "1-2"): {"response": self.orders[:2]},
+            ("GET", order_uri + "3"): {"response": self.orders[2:]}}
+        instance = AsyncAPI(TEST_CONFIG, transport=FakeAsyncTransport(bodies))
+
+        frame = asyncio.run(instance.get_order_frame("1-3"))
+
+        self.assertEqual(frame["order_id"].tolist(), [1, 1, 2, 3])
+
+    def test_builder_appends_one_order_at_a_time(self):
+        builder = OrderFrameBuilder()
+        builder.append(self.orders[0])
+        self.assertEqual(builder.finish()["order_id"].tolist(), [1, 1])
+
+        builder.append(Order.from_json(self.orders[1]))
+        self.assertEqual(builder.finish()["row_id"].tolist(), [11, 12, 21])
+
+
+class JSONDecodingTest(unittest.TestCase):
+
+    body = json.dumps({"metaData": {"pages": [1, 2]}, "response": [
+        {"id": 1, "reference": "café"}, {"id": 22, "total": 12.5}, 333]},
+        ensure_ascii=False).encode('utf-8')
+
+    def chunks(self, size):
+        return [self.body[start:start + size] for start in range(0, len(self.body), size)]
+
+    def test_stream_items_from_small_chunks(self):
+        for size in (1, 2, 7, len(self.body)):
+            items = list(JSONArrayStream(self.chunks(size)))
+            self.assertEqual(items, [{"id": 1, "reference": "café"},
+                {"id": 22, "total": 12.5}, 333])
+        for chunks in ([b'{"response": [1.', b'5]}'], [b'{"response": [1', b'e2, -', b'3]}'],
+                [b'{"response": [2.5e', b'-1]}']):
+            self.assertEqual(list(JSONArrayStream(chunks)),
+                json.loads(b"".join(chunks))["response"])
+
+    def test_stream_other_key(self):
+        self.assertEqual(list(JSONArrayStream(self.chunks(3), key="missing")), [])
+        self.assertEqual(list(JSONArrayStream([b'{"response": []}'])), [])
+        with self.assertRaises(ValueError):
+            list(JSONArrayStream([b'{"response": [{"id": 1}, {"id"']))
+
+    @responses.activate
+    def test_incremental_iter_order_data(self):
+        instance = API(dict(TEST_CONFIG, incremental=True))
+        add_order_responses(instance.uri + "order-service/order/")
+
+        orders = list(instance.iter_order_data("1-6"))
+
+        self.assertEqual([order["id"] for order in orders], [1, 2, 3, 4, 5, 6])
+
+    @responses.activate
+    def test_incremental_leaves_get_order_data_concurrent(self):
+        instance = API(dict(TEST_CONFIG, incremental=True))
+        add_order_responses(instance.uri + "order-service/order/")
+        streamed = []
+        instance.stream_items = streamed.append
+
+        orders = instance.get_order_data("1-6", workers=2)
+
+        self.assertEqual([order["id"] for order in orders], [1, 2, 3, 4, 5, 6])
+        self.assertEqual(streamed, [])
+
+    @responses.activate
+    def test_json_loads(self):
+        order_uri = "https://ws-eu1.brightpearl.com/public-api/testcompany/order-service/order/1"
+        responses.add(responses.GET, order_uri,
+            body= json.dumps({"response": [{"id": 1}]}),
+            status= 200,
+        )
+        bodies = []
+
+        def loads(body):
+            bodies.append(body)
+            return json.loads(body)
+
+        self.assertEqual(API(dict(TEST_CONFIG, json_loads=loads)).get(order_uri),
+            {"response": [{"id": 1}]})
+        self.assertEqual(bodies, [b'{"response": [{"id": 1}]}'])
+        self.assertEqual(API(dict(TEST_CONFIG, json_loads=True)).get(order_uri),
+            {"response": [{"id": 1}]})
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    def test_run_against_stand_in(self):
+        results = benchmark.run(orders=250, products=20, workers=2, repeat=1,
+            methods=["get_order_data", "iter_search"], search_results=30)
+
+        self.assertEqual([result["name"] for result in results],
+            ["get_order_data", "iter_search"])
+        self.assertEqual(results[0]["requests"], 3)
+        self.assertGreater(results[0]["rps"], 0)
+        self.assertGreater(results[1]["peak_memory"], 0)
+
+    def test_every_api_method_is_benchmarked(self):
+        names = [name for name, method in benchmark.benchmark_methods(10, 10, 2)]
+
+        for name in ("lookup_service", "sku_lookup", "ean_lookup", "get_stock_levels"):
+            self.assertIn(name, names)
+
+    def test_stand_in_search_filters(self):
+        with benchmark.BrightpearlStandIn(search_results=30) as stand_in:
+            instance = API(dict(TEST_CONFIG, rate_limit=False),
+                transport=benchmark.LocalTransport(stand_in.base_uri))
+
+            product = instance.sku_lookup("SKU-12")
+            group = instance.lookup_service("product", productGroupId=3)
+            stock = instance.get_stock_levels("1-2")
+
+        self.assertEqual(product["product_id"], 12)
+        self.assertEqual([row[0] for row in group], [3, 13, 23])
+        self.assertEqual(sorted(stock["response"]), ["1", "2"])
+
+    def test_stand_in_throttles(self):
+        with benchmark.BrightpearlStandIn(rate_limit=2) as stand_in:
+            transport = benchmark.LocalTransport(stand_in.base_uri)
+            the_uri = API(TEST_CONFIG).uri + "order-service/order/1-2"
+            statuses = [transport.request("GET", the_uri).status_code for each in range(3)]
+            response = transport.request("GET", the_uri)
+
+        self.assertEqual(statuses, [200, 200, 503])
+        self.assertEqual(response.headers["brightpearl-requests-remaining"], "0")
+        self.assertEqual(len(transport.latencies), 4)
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.instance = API(dict(TEST_CONFIG, metrics=True))
+        self.order_uri = self.instance.uri + "order-service/order/"
+
+    def test_histogram(self):
+        histogram = Histogram(buckets=(0.01, 0.1, 1.0))
+        for value in (0.005, 0.05, 0.05, 0.5, 5.0):
+            histogram.observe(value)
+
+        snapshot = histogram.snapshot()
+
+        self.assertEqual(snapshot["count"], 5)
+        self.assertEqual(snapshot["p50"], 0.1)
+        self.assertEqual(snapshot["p99"], 5.0)
+        self.assertEqual(list(snapshot["buckets"].values()), [1, 2, 1, 1])
+
+    @responses.activate
+    def test_requests_recorded_per_operation(self):
+        add_order_responses(self.order_uri)
+
+        self.instance.get_order_data("1-6", workers=2)
+        self.instance.get(self.order_uri + "1-2")
+
+        snapshot = self.instance.metrics.snapshot()
+        orders = snapshot["get_order_data order/order"]
+        self.assertEqual(orders["requests"], 4)
+        self.assertEqual(orders["methods"], {"OPTIONS": 1, "GET": 3})
+        self.assertEqual(orders["statuses"], {200: 4})
+        self.assertGreater(orders["bytes"], 0)
+        self.assertEqual(orders["latency"]["count"], 4)
+        self.assertEqual(orders["decode"]["count"], 4)
+        self.assertEqual(snapshot["get order/order"]["requests"], 1)
+
+    @responses.activate
+    def test_outer_operation_and_exporters(self):
+        responses.add(responses.GET, self.instance.uri + "product-service/product-search",
+            body= json.dumps({"response": {"results": []}}),
+            status= 200,
+        )
+        exported = []
+        self.instance.metrics.exporters.append(exported.append)
+
+        self.instance.sku_lookup("ABC")
+        self.instance.metrics.export()
+
+        self.assertEqual(list(exported[0]), ["sku_lookup product/product-search"])
+
+    @responses.activate
+    def test_staff_authentication_recorded(self):
+        responses.add(responses.POST, self.instance.authentication_uri,
+            body= json.dumps({"response": "St4ffT0K3n"}),
+            status= 200,
+        )
+
+        self.instance.get_brightpearl_staff_token("username", "password")
+
+        auth = self.instance.metrics.snapshot()["get_brightpearl_staff_token auth/"]
+        self.assertEqual(auth["requests"], 1)
+        self.assertEqual(auth["methods"], {"POST": 1})
+        self.assertEqual(auth["statuses"], {200: 1})
+        self.assertEqual(auth["latency"]["count"], 1)
+        self.assertEqual(auth["decode"]["count"], 1)
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(API(TEST_CONFIG).metrics)
+
+    def test_async_operation(self):
+        bodies = {("GET", self.order_uri + "1-2"): {"response": [{"id": 1}, {"id": 2}]},
+            ("OPTIONS", self.order_uri + "1-2"): {"response": {"getUris": ["/order/1-2"]}},
+            ("POST", self.instance.authentication_uri): {"response": "St4ffT0K3n"}}
+        instance = AsyncAPI(dict(TEST_CONFIG, metrics=Metrics()),
+            transport=FakeAsyncTransport(bodies))
+
+        asyncio.run(instance.get_order_data("1-2"))
+        asyncio.run(instance.get_brightpearl_staff_token("username", "password"))
+
+        snapshot = instance.metrics.snapshot()
+        self.assertEqual(snapshot["get_order_data order/order"]["requests"], 2)
+        self.assertEqual(snapshot["get_brightpearl_staff_token auth/"]["requests"], 1)
+
+
+class SpanRecorder(object):
+
+    def __init__(self):
+        self.started = []
+        self.ended = []
+
+    def on_start(self, span):
+        self.started.append(span)
+
+    def on_end(self, span):
+        self.ended.append(span)
+
+
+class TracingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.recorder = SpanRecorder()
+        self.instance = API(dict(TEST_CONFIG, tracer=Tracer(hooks=[self.recorder])))
+        self.order_uri = self.instance.uri + "order-service/order/"
+
+    @responses.activate
+    def test_operation_span_with_request_children(self):
+        add_order_responses(self.order_uri)
+
+        self.instance.get_order_data("1-6", workers=2)
+
+        *requests, iter_span, operation_span = self.recorder.ended
+        self.assertEqual(operation_span.name, "get_order_data")
+        self.assertIsNone(operation_span.parent_id)
+        self.assertEqual(iter_span.name, "iter_order_data")
+        self.assertEqual(iter_span.parent_id, operation_span.span_id)
+        self.assertEqual(sorted(span.name for span in requests),
+            ["GET order/order"] * 3 + ["OPTIONS order/order"])
+        for span in requests:
+            self.assertEqual(span.parent_id, iter_span.span_id)
+            self.assertEqual(span.trace_id, operation_span.trace_id)
+            self.assertEqual(span.attributes["status"], 200)
+            self.assertIn("decode", span.attributes)
+            self.assertGreaterEqual(span.attributes["queue_wait"], 0)
+            self.assertGreaterEqual(span.attributes["network"], 0)
+
+    @responses.activate
+    def test_nested_operations(self):
+        responses.add(responses.GET, self.instance.uri + "product-service/product-search",
+            body= json.dumps({"response": {"results": []}}),
+            status= 200,
+        )
+
+        self.instance.sku_lookup("ABC")
+
+        request, lookup, sku = self.recorder.ended
+        self.assertEqual([sku.name, lookup.name, request.name],
+            ["sku_lookup", "lookup_service", "GET product/product-search"])
+        self.assertEqual(lookup.parent_id, sku.span_id)
+        self.assertEqual(request.parent_id, lookup.span_id)
+
+    @responses.activate
+    def test_generator_span_ends_when_closed(self):
+        add_order_responses(self.order_uri)
+
+        orders = self.instance.iter_order_data("1-6")
+        next(orders)
+        self.assertNotIn("iter_order_data", [span.name for span in self.recorder.ended])
+        orders.close()
+
+        self.assertEqual(self.recorder.ended[-1].name, "iter_order_data")
+        self.assertEqual(len(self.recorder.started), len(self.recorder.ended))
+
+    @responses.activate
+    def test_trace_path(self):
+        add_order_responses(self.order_uri)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "spans.jsonl")
+
+            API(dict(TEST_CONFIG, trace_path=path)).get_order_data("1-6")
+
+            with open(path) as trace_file:
+                spans = [json.loads(line) for line in trace_file]
+
+        self.assertEqual(len(spans), 6)
+        self.assertEqual(spans[-1]["name"], "get_order_data")
+        self.assertGreater(spans[-1]["duration"], 0)
+
+
+class CassetteTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "cassette.jsonl.gz")
+        self.order_uri = API(TEST_CONFIG).uri + "order-service/order/"
+
+    @responses.activate
+    def record(self):
+        add_order_responses(self.order_uri)
+        with API(dict(TEST_CONFIG, record_path=self.path, rate_limit=False)) as instance:
+            return instance.get_order_data("1-6")
+
+    def test_record_and_replay(self):
+        recorded = self.record()
+
+        with API(dict(TEST_CONFIG, replay_path=self.path, replay_latency=0)) as instance:
+            replayed = instance.get_order_data("1-6")
+            replayed_again = instance.get_order_data("1-6")
+
+        self.assertEqual(replayed, recorded)
+        self.assertEqual(replayed_again, recorded)
+        self.assertEqual(instance.transport.replayed, 8)
+        with gzip.open(self.path, "rt") as archive:
+            self.assertNotIn(TEST_CONFIG['brightpearl_account_token'], archive.read())
+
+    def test_replay_incremental(self):
+        recorded = self.record()
+
+        with API(dict(TEST_CONFIG, replay_path=self.path, replay_latency=0,
+                incremental=True)) as instance:
+            replayed = list(instance.iter_order_data("1-6"))
+
+        self.assertEqual(replayed, recorded)
+
+    def test_scaled_latency(self):
+        self.record()
+        slept = []
+        transport = ReplayTransport(self.path, latency=2.0, sleep=slept.append)
+
+        response = transport.request("GET", self.order_uri + "1-2")
+
+        self.assertEqual(response.json(), {"response": [{"id": 1}, {"id": 2}]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(slept), 1)
+        self.assertGreater(slept[0], 0)
+        with self.assertRaises(KeyError):
+            transport.request("GET", self.order_uri + "7-8")
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.instance = API(TEST_CONFIG)
+
+    @responses.activate
+    def test_stock_levels_batched_and_merged(self):
+        stock_uri = self.instance.uri + "warehouse-service/product-availability/"
+        responses.add(responses.GET, stock_uri + "1-200",
+            body= json.dumps({"response": {"1": {"total": {"inStock": 1}}}}),
+            status= 200,
+        )
+        responses.add(responses.GET, stock_uri + "201-203,500",
+            body= json.dumps({"response": {"500": {"total": {"inStock": 5}}}}),
+            status= 200,
+        )
+
+        stock = self.instance.get_stock_levels([500] + list(range(203, 0, -1)) + [7], workers=2)
+
+        self.assertEqual(stock, {"response": {
+            "1": {"total": {"inStock": 1}}, "500": {"total": {"inStock": 5}}}})
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_failing_chunk_errors_are_kept(self):
+        stock_uri = self.instance.uri + "warehouse-service/product-availability/"
+        error = {"code": "WHSC-035", "message": "Invalid product ids"}
+        responses.add(responses.GET, stock_uri + "1-200",
+            body= json.dumps({"response": {"1": {"total": {"inStock": 1}}}}),
+            status= 200,
+        )
+        responses.add(responses.GET, stock_uri + "201",
+            body= json.dumps({"errors": [error]}),
+            status= 400,
+        )
+
+        stock = self.instance.get_stock_levels(range(1, 202))
+
+        self.assertEqual(stock, {"response": {"1": {"total": {"inStock": 1}}}, "errors": [error]})
+        with self.assertRaises(ValueError):
+            self.instance.merge_responses([{"response": {"1": [4]}}, {"errors": [error]}])
+
+    @responses.activate
+    def test_suppliers_from_id_list(self):
+        product_uri = self.instance.uri + "product-service/product/"
+        responses.add(responses.GET, product_uri + "1-2,9/supplier",
+            body= json.dumps({"response": {"1": [4], "2": [4], "9": [5]}}),
+            status= 200,
+        )
+
+        suppliers = self.instance.get_product_suppliers([9, 2, 1, 2])
+
+        self.assertEqual(suppliers, {"1": [4], "2": [4], "9": [5]})
+
+    def test_goods_note_uris(self):
+        uris = self.instance.goods_note_uris(list(range(450, 0, -1)))
+
+        self.assertEqual([uri.split("/")[-4] for uri in uris], ["1-200", "201-400", "401-450"])
+        self.assertEqual(self.instance.merge_responses([{"response": [1]}, {"errors": []},
+            {"response": [2]}]), [1, 2])
+
+
+class CompressionBenchmarkTest(unittest.TestCase):
+
+    def test_run_compression(self):
+        results = benchmark.run_compression(count=1000, density=0.5, repeat=1)
+
+        self.assertIn("compress_ids", [result["name"] for result in results])
+        self.assertTrue(all(result["seconds"] >= 0 for result in results))
+
+    def test_baseline_matches(self):
+        ids = [9, 3, 1, 2, 3, 5, 10, 11]
+
+        self.assertEqual(benchmark.compression_baseline(ids), Tools.compress_ids(ids))
+
+
 class TestGrouper:
 
     def test_grouper_one_chunk(self):
@@ -276,6 +1884,70 @@ class TestGrouper:
         returned_chunks = Tools.grouper(test_list, chunksize=10)
         assert expected_chunks == returned_chunks
 
+    def test_grouper_keeps_none_and_reads_iterators(self):
+        assert Tools.grouper([1, None, 0, 4, 5], chunksize=2) == [[1, None], [0, 4], [5]]
+        assert Tools.grouper(iter(range(1, 8)), chunks=2) == [[1, 2, 3, 4], [5, 6, 7]]
+        assert Tools.grouper([1, 2, 3], chunksize=2, fillvalue=0) == [[1, 2], [3, 0]]
+
+    def test_chunked_is_lazy(self):
+        chunks = Tools.chunked(count(1), 3)
+        assert next(chunks) == [1, 2, 3]
+        assert next(chunks) == [4, 5, 6]
+        assert list(Tools.chunked([], 3)) == []
+        with pytest.raises(ValueError):
+            next(Tools.chunked([1], 0))
+
+
+class TestRequestRanges:
+
+    def test_single_id(self):
+        assert Tools.list_of_request_ranges("5") == ["5"]
+
+    def test_range_under_chunksize(self):
+        assert Tools.list_of_request_ranges("5-5") == ["5"]
+        assert Tools.list_of_request_ranges("1-100") == ["1-100"]
+
+    def test_range_over_chunksize(self):
+        assert Tools.list_of_request_ranges("1-201") == ["1-200", "201"]
+        assert Tools.list_of_request_ranges("1-401") == ["1-200", "201-400", "401"]
+
+    def test_plan_comma_list(self):
+        ids = ",".join(str(number) for number in range(1, 251))
+        chunks = Tools.plan_request_ranges(ids)
+        assert [len(chunk.split(",")) for chunk in chunks] == [200, 50]
+
+    def test_plan_mixed_ranges_and_ids(self):
+        assert Tools.plan_request_ranges("1-250,300") == ["1-200", "201-250,300"]
+
+    def test_plan_rejects_reversed_range(self):
+        with pytest.raises(ValueError):
+            Tools.plan_request_ranges("5-1")
+
+    def test_plan_respects_max_length(self):
+        chunks = Tools.plan_request_ranges("1000,1001,1002,1003", max_length=10)
+        assert chunks == ["1000,1001", "1002,1003"]
+
+    def test_compress_ids(self):
+        assert Tools.compress_ids([9, 3, 1, 2, 3, "5", 6]) == ["1-3", "5-6", "9"]
+        assert Tools.compress_ids([]) == []
+
+    def test_id_runs_and_pack_runs(self):
+        assert Tools.id_runs(["3", "1", "2", "7"]) == [(1, 3), (7, 7)]
+        assert Tools.id_runs([2, "1"]) == [(1, 2)]
+        assert Tools.id_runs(iter([2, "1", 3])) == [(1, 3)]
+        assert Tools.batch_ids(each_id for each_id in [5, "4", 6]) == ["4-6"]
+        assert list(Tools.pack_runs([(1, 250), (300, 300)])) == ["1-200", "201-250,300"]
+        assert list(Tools.pack_runs(iter([(1, 3)]), chunksize=2)) == ["1-2", "3"]
+
+    def test_batch_ids(self):
+        ids = list(range(1, 301)) + list(range(1000, 2000, 2))
+        chunks = Tools.batch_ids(reversed(ids))
+        assert chunks[0] == "1-200"
+        assert chunks[1].startswith("201-300,1000,1002")
+        assert sum(len(chunk.split(",")) for chunk in chunks[1:]) == 501
+        assert all(len(chunk) <= 1500 for chunk in chunks)
+        assert Tools.batch_ids("1-250") == ["1-200", "201-250"]
+
 
 class TestSearchStringifier:
 